@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/12/012 20:10
+# @Author : 不归
+# @FileName: __init__.py
+"""
+离线性能基准：不访问网络及数据库，使用合成数据测试下载规划、进度缓存、日期工具及数据整理等热点函数。
+    python -m bench.run                     # 运行全部用例，结果保存到 bench/results/
+    python -m bench.run plan normalize      # 只运行名称包含 plan 或 normalize 的用例
+    python -m bench.compare a.json b.json   # 对比两次结果
+"""
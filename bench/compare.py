@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/12/012 21:20
+# @Author : 不归
+# @FileName: compare.py
+"""
+对比两次基准结果：python -m bench.compare 旧.json 新.json，省略参数时对比 bench/results 中最近两次
+"""
+import sys
+
+from orjson import orjson
+
+from bench.run import RESULT_PATH
+from conf.constants import *
+
+THRESHOLD = 0.05  # 变化超过该比例时标记
+
+
+def compare(old: Path, new: Path, threshold: float = THRESHOLD) -> dict:
+    """
+    :return: dict {名称: 新ops / 旧ops}，大于1表示变快
+    """
+    a, b = orjson.loads(Path(old).read_bytes()), orjson.loads(Path(new).read_bytes())
+    print(f"旧：{old}（{a['env']['commit']}）\n新：{new}（{b['env']['commit']}）")
+    print(f"{'用例':<16}{'旧 ops/s':>16}{'新 ops/s':>16}{'速度':>10}{'旧 MB':>10}{'新 MB':>10}")
+    res = {}
+    for name in sorted(set(a['results']) | set(b['results'])):
+        ra, rb = a['results'].get(name), b['results'].get(name)
+        if not ra or not rb:
+            print(f"{name:<16}{'仅存在于' + ('新' if rb else '旧') + '结果中':>32}")
+            continue
+        res[name] = ratio = rb['ops'] / ra['ops']
+        mark = '' if abs(ratio - 1) < threshold else (' ↑' if ratio > 1 else ' ↓')
+        print(f"{name:<16}{ra['ops']:>16,.0f}{rb['ops']:>16,.0f}{ratio:>9.2f}x{ra['peak_mb']:>10.1f}"
+              f"{rb['peak_mb']:>10.1f}{mark}")
+    return res
+
+
+if __name__ == '__main__':
+    files = sys.argv[1:3] or sorted(RESULT_PATH.glob("*.json"))[-2:]
+    assert len(files) == 2, "需要两个结果文件"
+    compare(*files)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/12/012 20:15
+# @Author : 不归
+# @FileName: data.py
+"""
+合成数据：股票列表、交易日历、下载进度及TS格式的原始K线，固定随机种子，每次运行结果相同
+"""
+import numpy as np
+import pandas as pd
+
+from db.trade_cal import TradeCal
+
+SEED = 0
+CODES = 5000  # 股票数量
+YEARS = 30  # 历史年数
+EDT = "20231010"
+
+
+def codes(n: int = CODES) -> list[str]:
+    return [f"{i:06d}.{'SH' if i % 2 else 'SZ'}" for i in range(n)]
+
+
+def trade_cal(years: int = YEARS, edt: str = EDT) -> TradeCal:
+    """
+    按工作日生成的交易日历
+    """
+    end = np.datetime64(f"{edt[:4]}-{edt[4:6]}-{edt[6:]}") + 1
+    dts = np.arange(end - np.timedelta64(years * 365, 'D'), end)
+    dts = dts[np.is_busday(dts)]
+    return TradeCal(days=pd.DatetimeIndex(dts).strftime("%Y%m%d").astype(np.int64).to_numpy())
+
+
+def symbols(cal: TradeCal, n: int = CODES) -> list[list[str]]:
+    """
+    带上市日期的股票列表 [['code', 'sdt'], ...]，上市日期在日历中均匀分布
+    """
+    rng = np.random.default_rng(SEED)
+    opendt = rng.choice(cal.days[:-250], n)
+    return [[c, str(d)] for c, d in zip(codes(n), opendt)]
+
+
+def over_map(symbols: list, cal: TradeCal, done: float = 0.9, holes: float = 0.2) -> dict:
+    """
+    下载进度：每支股票完成上市后 done 比例的交易日，holes 比例的股票中间缺一段
+    :return: dict {'code': [['sdt', 'edt'], ...]}
+    """
+    rng = np.random.default_rng(SEED)
+    days = cal.days
+    res = {}
+    for code, sdt in symbols:
+        i = int(np.searchsorted(days, int(sdt)))
+        j = i + int((len(days) - 1 - i) * done)
+        if j <= i + 2:
+            continue
+        if rng.random() < holes:
+            k = int(rng.integers(i + 1, j - 1))
+            res[code] = [[str(days[i]), str(days[k])], [str(days[k + 1]), str(days[j])]]
+        else:
+            res[code] = [[str(days[i]), str(days[j])]]
+    return res
+
+
+def ts_frames(kind: str, n_codes: int, n_rows: int) -> list[pd.DataFrame]:
+    """
+    TS接口格式的原始数据，每支股票一个 DataFrame，参照 db.source.ts.TS_SPECS
+    :param kind: str day/min/adj
+    :param n_codes: int 股票数量
+    :param n_rows: int 每支股票的行数
+    """
+    rng = np.random.default_rng(SEED)
+    if kind == 'min':
+        # 每天240分钟，不含午休
+        day = pd.date_range("2023-01-02 09:31", periods=120, freq="min").append(
+            pd.date_range("2023-01-02 13:01", periods=120, freq="min"))
+        dates = (day.values[None, :] + np.arange(-(-n_rows // 240))[:, None] * np.timedelta64(1, 'D')).ravel()
+        dates = pd.DatetimeIndex(dates[:n_rows]).strftime("%Y-%m-%d %H:%M:%S")
+        time_field = 'trade_time'
+    else:
+        dates = pd.bdate_range(end="2023-10-10", periods=n_rows).strftime("%Y%m%d")
+        time_field = 'trade_date'
+    frames = []
+    for code in codes(n_codes):
+        if kind == 'adj':
+            frames.append(pd.DataFrame({'ts_code': code, 'trade_date': dates,
+                                        'adj_factor': np.round(rng.uniform(1, 100, n_rows), 3)}))
+            continue
+        close = np.round(rng.uniform(1, 100, n_rows), 2)
+        frames.append(pd.DataFrame({
+            'ts_code': code, time_field: dates, 'open': close, 'high': close + 0.1, 'low': close - 0.1,
+            'close': close, 'vol': rng.uniform(0, 1e6, n_rows), 'amount': rng.uniform(0, 1e8, n_rows),
+        }))
+    return frames
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/12/012 20:40
+# @Author : 不归
+# @FileName: run.py
+"""
+基准用例及运行器：每个用例重复执行至少 MIN_TIME 秒，统计每秒操作数；再单独执行一次，用 tracemalloc 统计内存峰值。
+结果保存为 bench/results/{时间}_{提交}.json，用 bench.compare 对比。
+"""
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from orjson import orjson
+
+from bench import data
+from conf.constants import *
+from db.planner import plan
+from db.source.base import ADJ, DAY, MIN, DataSource
+from db.source.ts import TS_SPECS
+from libs.cache import Cache, home
+from libs.dtTools import delta_datetime
+from libs.journal import Journal
+from libs.tools import diff_date, diff_intervals, merge_interval, paging
+
+RESULT_PATH = BASE_PATH / "bench/results"
+MIN_TIME = 1.0  # 每个用例的最短计时秒数
+MAX_RUNS = 1000
+
+"""
+用例注册表 {名称: (准备函数, 每次调用包含的操作数)}，准备函数不计时，返回被测函数
+"""
+CASES: dict[str, tuple[Callable[[], Callable], int]] = {}
+
+
+def case(name: str, number: int = 1):
+    def deco(setup):
+        CASES[name] = (setup, number)
+        return setup
+
+    return deco
+
+
+_ctx = {}
+
+
+def ctx() -> SimpleNamespace:
+    """各用例共用的合成数据，首次使用时生成"""
+    if not _ctx:
+        cal = data.trade_cal()
+        symbols = data.symbols(cal)
+        _ctx.update(cal=cal, symbols=symbols, over_map=data.over_map(symbols, cal))
+    return SimpleNamespace(**_ctx)
+
+
+def _plan_case(dtype, limit: int):
+    c = ctx()
+    ds = SimpleNamespace(dtype=dtype, limit=limit, source_date="19900101")
+    return lambda: plan(c.symbols, c.over_map, "19900101", data.EDT, ds, c.cal)
+
+
+@case("plan_day")
+def _():
+    return _plan_case(DAY, 6000)
+
+
+@case("plan_min")
+def _():
+    return _plan_case(MIN, 32400)
+
+
+@case("diff_date", number=10000)
+def _():
+    rng = np.random.default_rng(data.SEED)
+    days = ctx().cal.days.astype(str)
+    args = [sorted(rng.choice(days, 4)) for _ in range(10000)]
+    args = [(a, c, b, d) if i % 2 else (a, b, c, d) for i, (a, b, c, d) in enumerate(args)]
+    return lambda: [diff_date(*a) for a in args]
+
+
+@case("diff_intervals", number=data.CODES)
+def _():
+    ivs = list(ctx().over_map.values())
+    return lambda: [diff_intervals(iv, "19900101", data.EDT) for iv in ivs]
+
+
+@case("merge_interval", number=data.CODES)
+def _():
+    ivs = list(ctx().over_map.values())
+    return lambda: [merge_interval(iv, iv[-1][1], data.EDT) for iv in ivs]
+
+
+@case("paging", number=10000)
+def _():
+    args = [(("20100101", "20230415"), (DAY, MIN, ADJ)[i % 3], 32400) for i in range(10000)]
+    return lambda: [paging(*a) for a in args]
+
+
+@case("delta_datetime", number=10000)
+def _():
+    days = ctx().cal.days[-10000:].astype(str).tolist()
+    return lambda: [delta_datetime(strdt=d, _format=dt_format, days=1) for d in days]
+
+
+@case("cache_set")
+def _():
+    cache = Cache(filepath=Path(tempfile.mkdtemp()) / "over_map")
+    values = ctx().over_map
+    return lambda: cache.set(values)
+
+
+@case("cache_get")
+def _():
+    cache = Cache(filepath=Path(tempfile.mkdtemp()) / "over_map")
+    cache.set(ctx().over_map)
+    return cache.get
+
+
+@case("journal_add", number=1000)
+def _():
+    name = f"bench/journal_{time.time_ns()}"
+    (home / ".czsc/bench").mkdir(parents=True, exist_ok=True)
+    journal = Journal(name, compact_size=10 ** 9)
+    codes = data.codes(1000)
+    return lambda: [journal.add([c], "20200101", "20230101") for c in codes]
+
+
+def _transform_case(dtype, n_codes: int, n_rows: int):
+    frames = data.ts_frames(dtype.sql, n_codes, n_rows)
+    ds = DataSource(dtype=dtype)
+    ds.specs = TS_SPECS
+    symbols = data.codes(n_codes)
+    return lambda: ds.transform(frames, symbols, "19900101", "20991231")
+
+
+@case("transform_day", number=200 * 250)
+def _():
+    return _transform_case(DAY, 200, 250)
+
+
+@case("transform_min", number=20 * 4800)
+def _():
+    return _transform_case(MIN, 20, 4800)
+
+
+@case("transform_adj", number=2000 * 250)
+def _():
+    return _transform_case(ADJ, 2000, 250)
+
+
+def measure(fn: Callable, number: int = 1) -> dict:
+    """
+    :param fn: 被测函数
+    :param number: int 每次调用包含的操作数
+    :return: dict {'ops': 每秒操作数, 'mean': 每次调用秒数, 'runs': 调用次数, 'peak_mb': 内存峰值MB}
+    """
+    fn()  # 预热
+    runs, costs = 0, []
+    while sum(costs) < MIN_TIME and runs < MAX_RUNS:
+        t1 = time.perf_counter()
+        fn()
+        costs.append(time.perf_counter() - t1)
+        runs += 1
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total = sum(costs)
+    return {'ops': runs * number / total, 'mean': total / runs, 'min': min(costs), 'runs': runs,
+            'number': number, 'peak_mb': peak / 2 ** 20}
+
+
+def env_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_PATH, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+def run(patterns: list[str] = None, save: bool = True) -> dict:
+    """
+    运行用例
+    :param patterns: list 名称包含任一字符串的用例，默认全部
+    :param save: bool 是否保存结果
+    :return: dict {'env': {...}, 'results': {名称: {...}}}
+    """
+    res = {'env': env_info(), 'results': {}}
+    for name, (setup, number) in CASES.items():
+        if patterns and not any(p in name for p in patterns):
+            continue
+        r = measure(setup(), number)
+        res['results'][name] = r
+        print(f"{name:<16}{r['ops']:>16,.0f} ops/s{r['mean'] * 1e3:>12.3f} ms/次{r['peak_mb']:>10.1f} MB")
+    shutil.rmtree(home / ".czsc/bench", ignore_errors=True)
+    if save:
+        RESULT_PATH.mkdir(parents=True, exist_ok=True)
+        path = RESULT_PATH / f"{time.strftime('%Y%m%d_%H%M%S')}_{res['env']['commit'] or 'local'}.json"
+        path.write_bytes(orjson.dumps(res, option=orjson.OPT_INDENT_2))
+        print(f"结果已保存：{path}")
+    return res
+
+
+if __name__ == '__main__':
+    log.remove()
+    run(sys.argv[1:])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/7/007 20:15
+# @Author : 不归
+# @FileName: adjust.py
+"""
+复权查询：在 ClickHouse 中用 ASOF JOIN 关联 quant.ts_adj，取每根K线当日（或之前最近）的复权因子
+- 后复权：价格 * 当日因子
+- 前复权：价格 * 当日因子 / 最新因子，最新因子按股票缓存在进程内，以 transform 常量数组写入SQL，一次查询完成
+复权后价格为 Float64（保留2位小数）或放大100倍的 Int64，成交量、成交额不复权。
+"""
+import threading
+import time
+
+from conf.constants import *
+from db.source.base import DECIMAL_COLS, FQ, NONE, PRE, PRICE_COLS, DataSource
+
+LATEST_TTL = 600  # 最新复权因子缓存的有效秒数，下载复权因子后立即失效
+
+lock = threading.Lock()
+_latest: dict[str, tuple[float, float]] = {}  # {'000001.SZ': (最新因子, 缓存时间)}
+
+ALL_COLS = ['date', 'code', 'open', 'high', 'low', 'close', 'volume', 'amount']
+
+
+def latest_factors(symbols: list[str]) -> dict[str, float]:
+    """
+    每支股票最新的复权因子，没有复权因子的股票为1
+    :param symbols: list 股票代码
+    :return: dict {'000001.SZ': 108.031, ...}
+    """
+    now = time.time()
+    with lock:
+        miss = [s for s in symbols if s not in _latest or now - _latest[s][1] > LATEST_TTL]
+    if miss:
+        codes = ','.join(f"'{s}'" for s in miss)
+        sql = f"SELECT code, argMax(num, date) AS num FROM quant.ts_adj WHERE code IN ({codes}) GROUP BY code"
+        df = DataSource._query_clickhouse(sql)
+        found = dict(zip(df['code'], df['num']))
+        with lock:
+            _latest.update({s: (float(found.get(s, 1.0)), now) for s in miss})
+        log.debug(f"已加载{len(miss)}支股票的最新复权因子，其中{len(miss) - len(found)}支没有复权因子")
+    with lock:
+        return {s: _latest[s][0] for s in symbols}
+
+
+def clear():
+    """下载复权因子后清空缓存"""
+    with lock:
+        _latest.clear()
+
+
+def adjust_sql(raw: str, kind: str, fq: FQ, symbols: list[str], columns: list[str] = None,
+               price: str = None) -> str:
+    """
+    拼接复权查询
+    :param raw: str 原始K线查询，需返回全部字段
+    :param kind: str 原始K线的数据类型，day/min
+    :param fq: FQ 复权方式，PRE/POST
+    :param symbols: list 查询的股票代码
+    :param columns: list 需要查询的字段，默认全部字段
+    :param price: str 价格类型，None/float: float64，int: 放大100倍的int64
+    :return: str 按 code,date 排序的查询语句
+    """
+    assert fq is not NONE, "不复权时无需关联复权因子"
+    codes = ','.join(f"'{s}'" for s in symbols)
+    # 复权因子为日期，分钟K线按当日0点关联；早于第一个复权因子的K线按1计算
+    adj_date = "toDateTime(date)" if kind == 'min' else "date"
+    factor = "if(a.num = 0, 1, a.num)"
+    if fq is PRE:
+        latest = latest_factors(symbols)
+        factor += f" / transform(k.code, [{codes}], [{','.join(repr(latest[s]) for s in symbols)}], 1.0)"
+
+    fields = []
+    for col in columns or ALL_COLS:
+        if col in PRICE_COLS:
+            expr = f"toFloat64({col}) * f"
+            fields.append(f"toInt64(round({expr} * 100)) AS {col}" if price == 'int' else f"round({expr}, 2) AS {col}")
+        elif price and col in DECIMAL_COLS.get(kind, ()):
+            fields.append(f"toFloat64({col}) AS {col}")
+        else:
+            fields.append(col)
+
+    k_cols = ', '.join(f"k.{c} AS {c}" for c in ALL_COLS)
+    return f"SELECT {', '.join(fields)} FROM (" \
+           f"SELECT {k_cols}, {factor} AS f FROM ({raw}) AS k " \
+           f"ASOF LEFT JOIN (SELECT code, {adj_date} AS adj_date, num FROM quant.ts_adj " \
+           f"WHERE code IN ({codes})) AS a " \
+           f"ON k.code = a.code AND k.date >= a.adj_date" \
+           f") ORDER BY code, date"
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/6/006 21:10
+# @Author : 不归
+# @FileName: bars.py
+"""
+服务端多周期K线：由物化视图在写入 ts_min / ts_day 时增量聚合到 AggregatingMergeTree 表
+- 5/15/30/60分钟：quant.ts_min5 ... ts_min60，date 为K线结束时间，按交易分钟序号分组，不跨午休
+- 周线/月线：quant.ts_week、ts_month，date 为周一 / 每月1日
+- open/close 使用 argMinState/argMaxState，查询时 argMinMerge/argMaxMerge；high/low/volume/amount 使用 SimpleAggregateFunction
+原表重复写入时物化视图会重复累加 volume/amount，下载任务结束合并原表后，用 rebuild 按分区重建涉及的聚合数据。
+DDL 由本模块生成：python -m db.bars 写入 script/bars.sql，通过 script/1.init_db.py 的 create_bars 执行。
+"""
+import time
+from collections import namedtuple
+
+from conf.constants import *
+from db.db_conn import get_conn
+
+"""
+freq: 周期，tab: 聚合表，src: 原表，part: 聚合表分区（按原表的 date 计算），bar: K线日期（按原表的 date 计算）
+"""
+Bar = namedtuple('Bar', ['freq', 'tab', 'src', 'part', 'bar'])
+
+# 交易分钟序号：09:30->0，11:30->120，13:01->121，15:00->240；按 n 分钟向上取整后换算回时间，K线不会跨越午休
+_SESSION = "if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, " \
+           "toHour(date) * 60 + toMinute(date) - 660)"
+_MIN_BAR = "toStartOfDay(date) + toIntervalMinute(if(greatest(intDiv({s} + {n} - 1, {n}), 1) * {n} <= 120, " \
+           "greatest(intDiv({s} + {n} - 1, {n}), 1) * {n} + 570, greatest(intDiv({s} + {n} - 1, {n}), 1) * {n} + 660))"
+
+BARS = {
+    **{f"{n}min": Bar(f"{n}min", f"quant.ts_min{n}", "quant.ts_min", "toYYYYMM(date)", _MIN_BAR.format(s=_SESSION, n=n))
+       for n in (5, 15, 30, 60)},
+    'W': Bar('W', "quant.ts_week", "quant.ts_day", "toYear(toMonday(date))", "toMonday(date)"),
+    'M': Bar('M', "quant.ts_month", "quant.ts_day", "toYear(date)", "toStartOfMonth(date)"),
+}
+
+_TYPES = {
+    'quant.ts_min': ('DateTime', 'Decimal(38, 2)'),
+    'quant.ts_day': ('Date', 'UInt64'),
+}
+
+_SELECT = """SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT {bar} AS bar, date AS t, code, open, high, low, close, volume, amount FROM {src}{where})
+GROUP BY code, bar"""
+
+
+def create_sql(b: Bar) -> list[str]:
+    dt, num = _TYPES[b.src]
+    # 聚合表的 date 即K线日期，周线的 toYear(toMonday(原表date)) 等于 toYear(周一)
+    part = "toYear(date)" if b.freq == 'W' else b.part
+    table = f"""CREATE TABLE IF NOT EXISTS {b.tab}
+(
+    `date` {dt},
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), {dt}),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), {dt}),
+    `volume` SimpleAggregateFunction(sum, {num}),
+    `amount` SimpleAggregateFunction(sum, {num})
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY {part}
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192"""
+    view = f"CREATE MATERIALIZED VIEW IF NOT EXISTS {b.tab}_mv TO {b.tab} AS\n" \
+           f"{_SELECT.format(bar=b.bar, src=b.src, where='')}"
+    return [table, view]
+
+
+def query_sql(b: Bar, fields: str, where: str) -> str:
+    """
+    聚合表查询，合并同一K线的多行中间状态
+    :param fields: str 外层查询字段，参照 DataSource._select_fields
+    :param where: str 查询条件
+    """
+    return f"SELECT {fields} FROM (SELECT date, code, argMinMerge(open) AS open, max(high) AS high, " \
+           f"min(low) AS low, argMaxMerge(close) AS close, sum(volume) AS volume, sum(amount) AS amount " \
+           f"FROM {b.tab} WHERE {where} GROUP BY code, date) ORDER BY code, date"
+
+
+def _affected(b: Bar, key: str, parts: set | None) -> list | None:
+    """
+    原表分区对应的聚合表分区，None 表示无法对应，需要整表重建
+    """
+    if parts is None or key not in ('toYYYYMM(date)', 'toYear(date)'):
+        return None
+    if b.freq == 'W':
+        # 1月初的几天属于上一年的最后一周
+        return sorted({y for p in parts for y in (int(p) - 1, int(p))})
+    return sorted(int(p) for p in parts)
+
+
+def rebuild(src: str, key: str, parts: set | None):
+    """
+    按原表写入涉及的分区重建聚合表，应在原表合并（dedup.optimize）之后执行
+    :param src: str 原表，quant.ts_min / quant.ts_day
+    :param key: str 原表分区表达式，参照 dedup.partition_key
+    :param parts: set 原表写入涉及的分区值，None 表示整表
+    """
+    for b in BARS.values():
+        if b.src != src:
+            continue
+        t1 = time.time()
+        todo = _affected(b, key, parts)
+        with get_conn() as conn:
+            if not conn.command(f"EXISTS TABLE {b.tab}"):
+                continue
+            if todo is None:
+                log.warning(f"{src}的分区无法对应到{b.tab}，整表重建")
+                conn.command(f"TRUNCATE TABLE {b.tab}")
+                conn.command(f"INSERT INTO {b.tab} {_SELECT.format(bar=b.bar, src=src + ' FINAL', where='')}")
+            for p in todo or []:
+                conn.command(f"ALTER TABLE {b.tab} DROP PARTITION {p}")
+                where = f" WHERE {b.part} = {p}"
+                conn.command(f"INSERT INTO {b.tab} {_SELECT.format(bar=b.bar, src=src + ' FINAL', where=where)}")
+        log.info(f"已重建{b.tab}的{'全部' if todo is None else len(todo)}个分区，耗时{time.time() - t1:.1f}秒")
+
+
+if __name__ == '__main__':
+    # 生成 script/bars.sql
+    sqls = [s for b in BARS.values() for s in create_sql(b)]
+    with open(BASE_PATH / "script/bars.sql", 'w', encoding='utf-8') as f:
+        f.write(";\n\n".join(sqls) + ";\n")
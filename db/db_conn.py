@@ -2,15 +2,18 @@
 # @Time : 2023/3/13/013 21:42
 # @Author : 不归
 # @FileName: db_conn.py
+import threading
 import time
 from contextlib import contextmanager
 from http.client import RemoteDisconnected
-from queue import Empty, Queue
 
 import clickhouse_connect
+from clickhouse_connect.driver.exceptions import OperationalError
 from singleton_decorator import singleton
+from urllib3.exceptions import ProtocolError
 
 from conf.constants import *
+from libs import metrics, trace
 
 
 class DB(object):
@@ -20,35 +23,164 @@ class DB(object):
         self.port = os.getenv("db_port", "8123")
         self.user = os.getenv("db_user", "default")
         self.password = os.getenv("db_pass", "")
+        self.compress = os.getenv("db_compress", "lz4")  # 传输压缩：lz4/zstd/gzip，关闭设为 none
 
     def __repr__(self):
         return f"DB(host={self.host}, port={self.port}, user={self.user}, password={self.password})"
 
     def create_conn(self) -> clickhouse_connect.driver.httpclient.HttpClient:
-        conn = clickhouse_connect.get_client(host=self.host, port=self.port, user=self.user, password=self.password)
+        compress = False if self.compress == "none" else self.compress
+        conn = clickhouse_connect.get_client(host=self.host, port=self.port, user=self.user, password=self.password,
+                                             compress=compress)
         assert isinstance(conn, clickhouse_connect.driver.httpclient.HttpClient), "连接出错，请检查"
         return conn
 
 
+class PoolTimeout(TimeoutError):
+    """等待可用连接超时"""
+
+
 @singleton
 class DBPool:
-    maxsize = 10
-    db = DB()
-    q = Queue(maxsize)
+    """
+    有上限的连接池：
+    - 连接总数不超过 maxsize，用完后等待归还，超过 timeout 秒抛出 PoolTimeout
+    - 首次获取连接时预热 prewarm 个连接
+    - 空闲超过 ping_interval 秒的连接取出时先 ping，失效则透明替换
+    - 使用中出错的连接不再放回连接池
+    """
 
-    def get_conn(self):
+    def __init__(self):
+        self.db = DB()
+        self.maxsize = int(os.getenv("db_pool_size", 10))
+        self.timeout = float(os.getenv("db_pool_timeout", 30))
+        self.prewarm = min(int(os.getenv("db_pool_prewarm", 2)), self.maxsize)
+        self.ping_interval = float(os.getenv("db_pool_ping", 30))
+
+        self.cond = threading.Condition()
+        self.idle: list[tuple] = []  # [(conn, 归还时间), ...]
+        self.size = 0  # 已创建（含创建中）的连接数
+        self.warmed = False
+        self.counter = {'in_use': 0, 'waiters': 0, 'creations': 0, 'failures': 0, 'replaced': 0, 'broken': 0,
+                        'wait_time': 0.0}
+
+    def _create(self):
         try:
-            conn = self.q.get_nowait()
-        except Empty:
-            conn = self.db.create_conn()
-        except RemoteDisconnected:
-            time.sleep(0.5)
-            log.error("conn errors - RemoteDisconnected")
             conn = self.db.create_conn()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.counter['failures'] += 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.counter['creations'] += 1
         return conn
 
-    def put_conn(self, con):
-        self.q.put(con)
+    def _warm(self):
+        with self.cond:
+            if self.warmed:
+                return
+            self.warmed = True
+        for _ in range(self.prewarm):
+            with self.cond:
+                if self.size >= self.prewarm:
+                    break
+                self.size += 1
+            try:
+                self.put_conn(self._create(), checkout=False)
+            except Exception as e:
+                log.error(f"连接池预热失败：{e}")
+                break
+        log.debug(f"连接池预热完成：{self.stats()}")
+
+    def get_conn(self, timeout: float = None):
+        """
+        获取连接，无空闲连接且未达到上限时新建，否则等待
+        :param timeout: float 最长等待秒数，默认使用 db_pool_timeout
+        :return: HttpClient
+        """
+        self._warm() if not self.warmed else None
+        t1 = time.monotonic()
+        deadline = t1 + (timeout or self.timeout)
+        conn, last = None, 0
+        with self.cond:
+            self.counter['waiters'] += 1
+            try:
+                while True:
+                    if self.idle:
+                        conn, last = self.idle.pop()
+                        break
+                    if self.size < self.maxsize:
+                        self.size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"等待数据库连接超时：{self.stats()}")
+                    self.cond.wait(remaining)
+            finally:
+                self.counter['waiters'] -= 1
+            self.counter['in_use'] += 1
+            wait = time.monotonic() - t1
+            self.counter['wait_time'] += wait
+        metrics.pool_wait.observe(wait)
+
+        try:
+            if conn is None:
+                return self._create()
+            if time.monotonic() - last > self.ping_interval and not self._alive(conn):
+                log.warning("数据库连接已失效，自动替换")
+                self._discard(conn, checkout=False)
+                with self.cond:
+                    self.size += 1
+                    self.counter['replaced'] += 1
+                return self._create()
+        except Exception:
+            with self.cond:
+                self.counter['in_use'] -= 1
+            raise
+        return conn
+
+    @staticmethod
+    def _alive(conn) -> bool:
+        try:
+            return bool(conn.ping())
+        except Exception:
+            return False
+
+    def _discard(self, conn, checkout: bool = True):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            self.size -= 1
+            self.counter['in_use'] -= checkout
+            self.cond.notify()
+
+    def put_conn(self, con, broken: bool = False, checkout: bool = True):
+        """
+        归还连接
+        :param con: HttpClient
+        :param broken: bool 连接在使用中出错时为True，直接关闭不再放回
+        :param checkout: bool 是否为 get_conn 取出的连接
+        """
+        if broken:
+            log.error("conn errors - 连接已关闭")
+            with self.cond:
+                self.counter['broken'] += 1
+            self._discard(con, checkout)
+            return
+        with self.cond:
+            self.idle.append((con, time.monotonic()))
+            self.counter['in_use'] -= checkout
+            self.cond.notify()
+
+    def stats(self) -> dict:
+        """
+        :return: dict 连接总数、空闲数、使用中、等待中、累计创建、创建失败、失效替换、出错关闭、累计等待秒数
+        """
+        return {'size': self.size, 'idle': len(self.idle), **self.counter}
 
 
 db_pool = DBPool()
@@ -56,11 +188,16 @@ db_pool = DBPool()
 
 @contextmanager
 def get_conn(pool=db_pool):
-    conn = pool.get_conn()
+    with trace.span('pool_wait'):
+        conn = pool.get_conn()
+    broken = False
     try:
         yield conn
+    except (OperationalError, RemoteDisconnected, ProtocolError):
+        broken = True
+        raise
     finally:
-        pool.put_conn(conn)
+        pool.put_conn(conn, broken)
 
 
 if __name__ == '__main__':
@@ -68,3 +205,4 @@ if __name__ == '__main__':
         sql = "show databases;"
         res = conn.command(sql)
         print(res)
+    print(db_pool.stats())
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/5/005 19:50
+# @Author : 不归
+# @FileName: dedup.py
+"""
+ReplacingMergeTree 去重：
+- 写入时记录每个表涉及的分区，下载任务结束后只对这些分区执行 OPTIMIZE ... FINAL
+- 查询时按环境变量 db_final_mode 决定是否使用 FINAL：
+  auto：查询涉及的分区都只有一个活动数据块（已合并，不存在重复行）时不使用 FINAL，默认方式
+  final：始终使用 FINAL；none：始终不使用
+  auto 模式的判断结果按表缓存 MERGED_TTL 秒，写入该表时清除
+重复写入的行内容相同，不需要版本字段，合并后保留任意一行即可。
+"""
+import threading
+import time
+
+import pandas as pd
+
+from conf.constants import *
+from db.db_conn import get_conn
+
+# 新旧表结构中同一 (code, date) 都在同一分区内，FINAL 无需跨分区合并
+FINAL_SETTINGS = " SETTINGS do_not_merge_across_partitions_select_final = 1"
+MERGED_TTL = 30  # 分区合并状态缓存的有效秒数
+
+lock = threading.Lock()
+touched: dict[str, set] = {}  # {'quant.ts_day': {'2023', ...}}，None 表示整表
+_keys: dict[str, str] = {}  # 分区表达式缓存
+_merged: dict[str, dict] = {}  # {'quant.ts_day': {(分区值, ...) 或 None: (是否需要FINAL, 缓存时间)}}
+
+
+def partition_key(db_tab: str) -> str:
+    """
+    表的分区表达式，如：code、toYYYYMM(date)、toYear(date)，未分区时为空字符串
+    """
+    if db_tab not in _keys:
+        database, table = db_tab.split('.')
+        sql = f"SELECT partition_key FROM system.tables WHERE database = '{database}' AND name = '{table}'"
+        with get_conn() as conn:
+            _keys[db_tab] = conn.command(sql) or ''
+    return _keys[db_tab]
+
+
+def _partitions(key: str, dataf: pd.DataFrame) -> set | None:
+    """
+    数据涉及的分区值，未分区（整表只有一个分区 tuple()，ID 为 all）或无法识别的分区表达式返回 None，即整表
+    """
+    if key == 'code':
+        return set(dataf['code'].unique())
+    if key == 'toYYYYMM(date)':
+        return set(dataf['date'].dt.strftime('%Y%m').unique())
+    if key == 'toYear(date)':
+        return set(dataf['date'].dt.strftime('%Y').unique())
+    return None
+
+
+def _covered(key: str, symbols: list[str] | None, sdt: str | None, edt: str | None) -> list | None:
+    """
+    查询涉及的分区值，None 表示整表
+    :param sdt: str 开始日期 "19900101"
+    :param edt: str 结束日期
+    """
+    if key == 'code' and symbols:
+        return list(symbols)
+    if key in ('toYYYYMM(date)', 'toYear(date)') and sdt and edt:
+        fmt = ('%Y', '%Y%m')[key == 'toYYYYMM(date)']
+        return pd.period_range(sdt, edt, freq=fmt[-1].upper()).strftime(fmt).tolist()
+    return None
+
+
+def touch(db_tab: str, dataf: pd.DataFrame):
+    """
+    记录写入涉及的分区
+    """
+    parts = _partitions(partition_key(db_tab), dataf)
+    with lock:
+        _merged.pop(db_tab, None)
+        if parts is None or touched.get(db_tab, set()) is None:
+            touched[db_tab] = None
+        else:
+            touched.setdefault(db_tab, set()).update(parts)
+
+
+def _merged_filter(parts: list | None) -> str:
+    # 字符串分区值在 system.parts 中可能带引号，统一去掉后比较
+    if parts is None:
+        return ""
+    return " AND replaceAll(partition, '''', '') IN ({})".format(','.join(f"'{p}'" for p in parts))
+
+
+def _unmerged(db_tab: str, parts: list | None) -> list[str]:
+    """
+    存在多个活动数据块（可能有重复行）的分区
+    :return: list 分区ID，字符串分区的ID为哈希值，用于 OPTIMIZE ... PARTITION ID
+    """
+    database, table = db_tab.split('.')
+    sql = f"SELECT partition_id FROM system.parts " \
+          f"WHERE database = '{database}' AND table = '{table}' AND active{_merged_filter(parts)} " \
+          f"GROUP BY partition_id HAVING count() > 1"
+    with get_conn() as conn:
+        return [r[0] for r in conn.query(sql).result_rows]
+
+
+def need_final(db_tab: str, symbols: list[str] = None, sdt: str = None, edt: str = None) -> bool:
+    """
+    查询是否需要 FINAL
+    :param db_tab: str 表名
+    :param symbols: list 查询的股票代码
+    :param sdt: str 开始日期 "19900101"
+    :param edt: str 结束日期
+    """
+    mode = os.getenv("db_final_mode", "auto")
+    if mode in ('final', 'none'):
+        return mode == 'final'
+    try:
+        parts = _covered(partition_key(db_tab), symbols, sdt, edt)
+        key = None if parts is None else tuple(sorted(parts))
+        now = time.time()
+        with lock:
+            hit = _merged.get(db_tab, {}).get(key)
+        if hit and now - hit[1] < MERGED_TTL:
+            return hit[0]
+        res = bool(_unmerged(db_tab, parts))
+        with lock:
+            _merged.setdefault(db_tab, {})[key] = (res, now)
+        return res
+    except Exception as e:
+        log.warning(f"读取{db_tab}分区信息失败，使用FINAL查询：{e}")
+        return True
+
+
+def final_clause(db_tab: str, symbols: list[str] = None, sdt: str = None, edt: str = None) -> tuple[str, str]:
+    """
+    :return: (FROM 后的修饰, 查询末尾的 SETTINGS)，如：('FINAL', ' SETTINGS ...') 或 ('', '')
+    """
+    if need_final(db_tab, symbols, sdt, edt):
+        return 'FINAL', FINAL_SETTINGS
+    return '', ''
+
+
+def optimize(db_tab: str = None) -> dict[str, set | None]:
+    """
+    合并写入涉及且存在多个活动数据块的分区，完成后清除记录
+    :param db_tab: str 表名，默认全部已记录的表
+    :return: dict 写入涉及的分区值 {'quant.ts_day': {'2023', ...}}，None 表示整表，供重建下游的聚合表
+    """
+    with lock:
+        tabs = {k: touched.pop(k) for k in ([db_tab] if db_tab else list(touched)) if k in touched}
+
+    for tab, parts in tabs.items():
+        t1 = time.time()
+        try:
+            todo = _unmerged(tab, None if parts is None else sorted(parts))
+            with get_conn() as conn:
+                for p in todo:
+                    conn.command(f"OPTIMIZE TABLE {tab} PARTITION ID '{p}' FINAL")
+        except Exception as e:
+            log.error(f"合并{tab}失败，下次查询将使用FINAL：{e}")
+            continue
+        finally:
+            with lock:
+                _merged.pop(tab, None)
+        log.info(f"已合并{tab}的{len(todo)}个分区，耗时{time.time() - t1:.1f}秒")
+    return tabs
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/10/010 20:40
+# @Author : 不归
+# @FileName: engine.py
+"""
+asyncio 下载引擎，KlineBase.download 的另一种执行方式（engine='async'）：
+- 每个下载任务依次经过 获取（fetch）、整理（transform）、入库（insert）三个阶段，每个阶段单独限制并发数
+- 数据源SDK、pandas 整理、clickhouse 写入均为阻塞调用，放到各阶段独立的线程池中执行
+- 同时处理的任务数等于三个阶段并发数之和，未开始的任务不占用内存
+- Ctrl-C 时不再启动新任务，取消处理中的任务，已完成的进度写入日志，处理中及未开始的任务保存到错误列表，可用 load_err 继续，
+  KlineBase 随后抛出 DownloadStopped，不再执行后续下载
+- 超时或取消的任务在线程中的阻塞调用无法中断，线程结束后才释放所在阶段的并发名额，线程数不会超出阶段并发数
+"""
+import asyncio
+import contextvars
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from tqdm import tqdm
+
+from conf.constants import *
+from db.writer import BatchWriter
+from libs import metrics, trace
+
+if TYPE_CHECKING:
+    from db.kline import KlineBase
+
+TRANSFORM_NUM = 2  # 整理阶段的并发数
+INSERT_NUM = 2  # 入库阶段的并发数
+TIMEOUT = 15 * 60  # 单个任务的超时秒数，与线程池方式一致
+
+STAGES = ('fetch', 'transform', 'insert')
+
+
+@dataclass
+class AsyncEngine:
+    """
+    :param kline: KlineBase 下载任务所属的K线管理对象，使用其数据源及进度记录
+    :param fetch_num: int 获取阶段的并发数，默认数据源允许的线程数
+    :param transform_num: int 整理阶段的并发数
+    :param insert_num: int 入库阶段的并发数，流水线模式下为放入批量写入器的并发数
+    :param timeout: float 单个任务的超时秒数
+    """
+    kline: 'KlineBase' = None
+    fetch_num: int = None
+    transform_num: int = TRANSFORM_NUM
+    insert_num: int = INSERT_NUM
+    timeout: float = TIMEOUT
+    costs: dict = field(default_factory=lambda: {s: 0.0 for s in STAGES})  # 各阶段累计耗时
+
+    def __post_init__(self):
+        self.fetch_num = self.fetch_num or self.kline.ds.thread_num
+
+    def run(self, down_list: list, err_ls: list, writer: BatchWriter = None) -> bool:
+        """
+        执行下载任务，出错、超时、被中断的任务追加到 err_ls
+        :param down_list: list [(['601882.SH'], '20200207', '20200621'), ...]
+        :param err_ls: list 错误列表
+        :param writer: BatchWriter 流水线模式下的批量写入器，为None时直接入库
+        :return: bool 是否被手动中断
+        """
+        return asyncio.run(self._main(down_list, err_ls, writer))
+
+    async def _stage(self, stage: str, func, *args):
+        # 等待阶段并发名额的时间单独记录，区分排队与执行
+        sem = self.sems[stage]
+        with trace.span(f'queue.{stage}'):
+            await sem.acquire()
+        loop = asyncio.get_running_loop()
+        t1 = time.time()
+
+        def release(_):
+            self.costs[stage] += time.time() - t1
+            sem.release()
+
+        # 线程池不传递 contextvars，复制当前上下文使线程中的阶段归属到当前任务
+        ctx = contextvars.copy_context()
+        fut = self.pools[stage].submit(ctx.run, func, *args)
+        # 超时或取消时只取消等待，线程中的调用结束（或未开始即取消）后才在事件循环中释放名额
+        fut.add_done_callback(lambda f: loop.call_soon_threadsafe(release, f))
+        return await asyncio.wrap_future(fut)
+
+    async def _task(self, codes_n, err_ls: list, writer: BatchWriter):
+        ds = self.kline.ds
+        symbol, sdt, edt = codes_n
+        frames = await self._stage('fetch', ds.fetch, symbol, sdt, edt)
+        df, max_edt = await self._stage('transform', ds.transform, frames, symbol, sdt, edt)
+        if df is None:
+            self.kline._done(codes_n, max_edt, err_ls)
+            return
+        db_tab = ds.db_tab
+        del frames
+        if writer:
+            # 写入完成后才记录进度
+            await self._stage('insert', writer.put, db_tab, df,
+                              lambda ok: self.kline._done(codes_n, max_edt if ok else 0, err_ls))
+            return
+        ok = await self._stage('insert', ds._to_clickhouse, db_tab, df)
+        self.kline._done(codes_n, max_edt if ok else 0, err_ls)
+
+    async def _worker(self, it, err_ls: list, writer: BatchWriter, bar: tqdm):
+        for codes_n in it:
+            try:
+                with trace.task(codes_n):
+                    # asyncio.timeout 需要 3.11，wait_for 兼容 3.10；新建的任务复制当前上下文，阶段仍归属到当前任务
+                    await asyncio.wait_for(self._task(codes_n, err_ls, writer), self.timeout)
+            except asyncio.TimeoutError:
+                log.error(f"{codes_n}下载超时（{self.timeout}秒），已加入错误列表")
+                err_ls.append(codes_n)
+            except asyncio.CancelledError:
+                # 中断时处理中的任务加入错误列表，已执行完成的阶段由 ReplacingMergeTree 去重，重复下载无影响
+                err_ls.append(codes_n)
+                raise
+            except Exception as e:
+                log.exception(f"{codes_n}下载出错，已加入错误列表：{e}")
+                err_ls.append(codes_n)
+            bar.update()
+            metrics.tasks_left.dec(self.kline.ds.dtype.sql)
+
+    async def _main(self, down_list: list, err_ls: list, writer: BatchWriter) -> bool:
+        loop = asyncio.get_running_loop()
+        nums = dict(zip(STAGES, (self.fetch_num, self.transform_num, self.insert_num)))
+        self.sems = {s: asyncio.Semaphore(n) for s, n in nums.items()}
+        self.pools = {s: ThreadPoolExecutor(n, thread_name_prefix=s) for s, n in nums.items()}
+        log.info(f"asyncio下载引擎已启动：{nums}，共{len(down_list)}个任务")
+
+        stop = asyncio.Event()
+        handler = signal.signal(signal.SIGINT, lambda signum, frame: loop.call_soon_threadsafe(stop.set))
+        it = iter(down_list)
+        bar = tqdm(total=len(down_list), desc="数据更新进度")
+        workers = [asyncio.create_task(self._worker(it, err_ls, writer, bar)) for _ in range(sum(nums.values()))]
+        stopping = asyncio.create_task(stop.wait())
+        finished = asyncio.gather(*workers)
+        try:
+            await asyncio.wait([stopping, finished], return_when=asyncio.FIRST_COMPLETED)
+            if stop.is_set():
+                log.error("已手动终止程序，正在取消处理中的任务...")
+                finished.cancel()
+                with suppress(asyncio.CancelledError):
+                    await finished
+                # 未开始的任务与处理中的任务一起保存到错误列表
+                err_ls.extend(it)
+            else:
+                finished.result()
+        finally:
+            stopping.cancel()
+            signal.signal(signal.SIGINT, handler)
+            bar.close()
+            # 已在线程中执行的阻塞调用无法中断，等待其结束，未执行的直接取消
+            for pool in self.pools.values():
+                pool.shutdown(wait=True, cancel_futures=True)
+        log.info("各阶段累计耗时：" + "，".join(f"{s}: {c:.1f}秒" for s, c in self.costs.items()))
+        return stop.is_set()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/11/011 20:30
+# @Author : 不归
+# @FileName: export.py
+"""
+将 quant.ts_day / ts_min / ts_adj 导出为 Hive 分区的 Parquet 数据集，供无法访问数据库的离线回测使用
+- 目录：{out}/{表名}/year=2023/part.parquet（按年）、year=2023/month=01/（按月）、code=000001.SZ/（按股票，文件中不含code字段）
+- 每个分区一个文件，由多个线程并行导出，每个线程从连接池获取连接，流式读取并逐个行组写入，内存占用与分区大小无关
+- {out}/{表名}/_manifest.json 记录每个分区导出时的行数及最大日期，再次导出时只重写行数或最大日期变化的分区，
+  并删除数据库中已不存在的分区
+- 导出结束后逐个分区核对 Parquet 文件的行数与数据库的行数
+"""
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from orjson import orjson
+
+from conf.constants import *
+from db import dedup
+from db.source.base import DataSource as ds
+from libs.cache import home
+
+EXPORT_PATH = Path(os.getenv("export_path") or home / ".czsc/parquet")
+THREAD_NUM = 4  # 并行导出的分区数量
+ROW_GROUP = 1_000_000  # Parquet 行组的行数
+BLOCK_ROWS = 65536  # 流式读取每块的行数
+
+"""
+分区方式：(分区表达式, 分区值对应的目录)
+"""
+UNITS = {
+    'year': ("toYear(date)", lambda v: f"year={v}"),
+    'month': ("toYYYYMM(date)", lambda v: f"year={v[:4]}/month={v[4:]}"),
+    'code': ("code", lambda v: f"code={v}"),
+}
+DEFAULT_BY = {'quant.ts_day': 'year', 'quant.ts_min': 'month', 'quant.ts_adj': 'year'}
+
+lock = Lock()
+
+
+def _read_manifest(root: Path) -> dict:
+    try:
+        return orjson.loads((root / "_manifest.json").read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def _write_manifest(root: Path, manifest: dict):
+    tmp = root / "_manifest.tmp"
+    tmp.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    os.replace(tmp, root / "_manifest.json")
+
+
+def db_stats(db_tab: str, by: str) -> dict[str, dict]:
+    """
+    数据库中每个分区去重后的行数及最大日期
+    :return: dict {'2023': {'rows': 1234, 'max_date': '2023-10-11'}, ...}
+    """
+    final, settings = dedup.final_clause(db_tab)
+    sql = f"SELECT toString({UNITS[by][0]}) AS p, count() AS n, toString(max(date)) AS max_date " \
+          f"FROM {db_tab} {final} GROUP BY p{settings}"
+    df = ds._query_clickhouse(sql)
+    return {p: {'rows': int(n), 'max_date': m} for p, n, m in zip(df['p'], df['n'], df['max_date'])}
+
+
+def export_part(db_tab: str, by: str, value: str, root: Path) -> int:
+    """
+    导出单个分区，先写入临时文件，完成后替换
+    :return: int 写入的行数
+    """
+    expr, to_dir = UNITS[by]
+    path = root / to_dir(value)
+    path.mkdir(parents=True, exist_ok=True)
+    final, settings = dedup.final_clause(db_tab)
+    literal = f"'{value}'" if by == 'code' else value
+    sql = f"SELECT * FROM {db_tab} {final} WHERE {expr} = {literal} ORDER BY code, date{settings}"
+
+    rows, buf, writer = 0, [], None
+    tmp = path / "part.parquet.tmp"
+    try:
+        for block in ds._stream_clickhouse(sql, 'arrow', {'max_block_size': BLOCK_ROWS}):
+            # LowCardinality 的 code 为字典编码，各块的字典不同，统一转换为字符串
+            for i, field in enumerate(block.schema):
+                if pa.types.is_dictionary(field.type):
+                    block = block.set_column(i, field.name, block.column(i).cast(pa.string()))
+            if by == 'code':
+                block = block.drop(['code'])
+            if writer is None:
+                writer = pq.ParquetWriter(str(tmp), block.schema, compression='zstd')
+            buf.append(block.cast(writer.schema))
+            if sum(b.num_rows for b in buf) >= ROW_GROUP:
+                writer.write_table(pa.concat_tables(buf), row_group_size=ROW_GROUP)
+                rows, buf = rows + sum(b.num_rows for b in buf), []
+        if buf:
+            writer.write_table(pa.concat_tables(buf), row_group_size=ROW_GROUP)
+            rows += sum(b.num_rows for b in buf)
+    finally:
+        writer.close() if writer else None
+    if writer is None:
+        shutil.rmtree(path, ignore_errors=True)
+        return 0
+    os.replace(tmp, path / "part.parquet")
+    return rows
+
+
+def check(root: Path, by: str, stats: dict[str, dict]) -> bool:
+    """
+    核对每个分区 Parquet 文件的行数与数据库的行数
+    """
+    bad = []
+    for value, s in stats.items():
+        f = root / UNITS[by][1](value) / "part.parquet"
+        n = pq.read_metadata(str(f)).num_rows if f.exists() else 0
+        if n != s['rows']:
+            bad.append((value, n, s['rows']))
+    if bad:
+        log.error(f"{root.name} 有{len(bad)}个分区行数不一致（分区, 文件, 数据库）：{bad[:20]}")
+        return False
+    log.success(f"{root.name} 行数核对一致：{len(stats)}个分区，共{sum(s['rows'] for s in stats.values())}条")
+    return True
+
+
+def export(db_tab: str, by: str = None, out: Path = EXPORT_PATH, thread_num: int = THREAD_NUM,
+           full: bool = False) -> bool:
+    """
+    导出单个表，只重写变化的分区
+    :param db_tab: str 表名，如：quant.ts_day
+    :param by: str 分区方式，year/month/code，默认日线及复权因子按年、分钟按月
+    :param out: Path 导出目录
+    :param thread_num: int 并行导出的分区数量
+    :param full: bool 是否忽略清单全部重新导出
+    :return: bool 行数核对是否一致
+    """
+    t1 = time.time()
+    by = by or DEFAULT_BY[db_tab]
+    assert by in UNITS, f"分区方式仅支持：{list(UNITS)}"
+    root = Path(out) / db_tab
+    root.mkdir(parents=True, exist_ok=True)
+    manifest = _read_manifest(root)
+    if manifest.get('by') != by:
+        # 分区方式变化时旧目录无法复用
+        if manifest:
+            log.warning(f"{db_tab} 分区方式由 {manifest.get('by')} 改为 {by}，清空后全部重新导出")
+        for p in root.iterdir():
+            shutil.rmtree(p) if p.is_dir() else None
+        manifest = {}
+    parts = manifest.get('parts', {})
+
+    stats = db_stats(db_tab, by)
+    for value in set(parts) - set(stats):
+        shutil.rmtree(root / UNITS[by][1](value), ignore_errors=True)
+        parts.pop(value)
+    todo = sorted(v for v, s in stats.items() if full or parts.get(v) != s)
+    log.info(f"开始导出 {db_tab}：共{len(stats)}个分区，待导出{len(todo)}个，目录：{root}")
+
+    def run(value: str) -> tuple[str, int]:
+        n = export_part(db_tab, by, value, root)
+        with lock:
+            # 每个分区完成后即记录，中断后再次运行时跳过；记录实际写入的行数，导出期间有新写入时下次重写
+            parts[value] = {**stats[value], 'rows': n}
+            _write_manifest(root, {'by': by, 'parts': parts, 'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+        return value, n
+
+    with ThreadPool(thread_num) as pool:
+        for i, (value, n) in enumerate(pool.imap_unordered(run, todo), 1):
+            log.debug(f"{db_tab} 分区 {value} 导出{n}条（{i}/{len(todo)}）")
+    _write_manifest(root, {'by': by, 'parts': parts, 'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+    log.info(f"{db_tab} 导出完成，耗时{time.time() - t1:.1f}秒")
+    return check(root, by, stats)
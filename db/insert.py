@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/3/003 21:20
+# @Author : 不归
+# @FileName: insert.py
+"""
+写入方式，由环境变量 db_insert_mode 选择，db_async_insert=1 时由服务端合并小批量写入（async_insert）：
+- df：conn.insert_df，由驱动逐列推断类型，默认方式
+- np：conn.insert 按列写入 numpy 数组，使用显式类型，省去 DESCRIBE 查询；Decimal 字段仍由驱动逐个单元格转换
+- arrow：由 numpy 数组直接构造 Arrow 表（Decimal 字段按整数缓冲区构造，不经过 Python 对象），conn.insert_arrow 写入
+未配置显式类型的表统一使用 df 方式。每种方式的写入行数、耗时、字节数累计在 stats 中，report 输出每秒行数。
+"""
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from conf.constants import *
+from libs import metrics
+
+INSERT_MODES = ('df', 'np', 'arrow')
+
+"""
+显式类型，与 script/init.sql 中各表的字段顺序及类型对应
+"""
+_KLINE = {'date': 'Date', 'code': 'LowCardinality(String)', 'open': 'Decimal(9, 2)', 'high': 'Decimal(9, 2)',
+          'low': 'Decimal(9, 2)', 'close': 'Decimal(9, 2)'}
+DB_TYPES = {
+    'quant.ts_day': {**_KLINE, 'volume': 'UInt64', 'amount': 'UInt64'},
+    'quant.ts_min': {**_KLINE, 'date': 'DateTime', 'volume': 'Decimal(18, 2)', 'amount': 'Decimal(18, 2)'},
+    'quant.ts_adj': {'date': 'Date', 'code': 'LowCardinality(String)', 'num': 'Float64'},
+}
+
+lock = threading.Lock()
+stats: dict[str, dict] = {}
+
+
+def _decimal(values: np.ndarray, precision: int, scale: int) -> pa.Array:
+    """
+    按 decimal128 的内存布局（小端的低64位 + 符号扩展的高64位）直接构造，四舍五入到 scale 位小数
+    """
+    v = np.round(np.asarray(values, dtype=np.float64) * 10 ** scale).astype(np.int64)
+    buf = np.empty((len(v), 2), dtype=np.int64)
+    buf[:, 0] = v
+    buf[:, 1] = v >> 63
+    return pa.Array.from_buffers(pa.decimal128(precision, scale), len(v), [None, pa.py_buffer(buf)])
+
+
+def _arrow_col(values: np.ndarray, tp: str) -> pa.Array:
+    if tp.startswith('Decimal'):
+        precision, scale = map(int, tp[8:-1].split(','))
+        return _decimal(values, precision, scale)
+    if tp == 'Date':
+        return pa.array(values.astype('datetime64[D]'))
+    if tp == 'DateTime':
+        return pa.array(values.astype('datetime64[s]'))
+    if tp in ('String', 'LowCardinality(String)'):
+        return pa.array(values, type=pa.string())
+    return pa.array(values, type=getattr(pa, tp.lower())())
+
+
+def _np_col(values: np.ndarray, tp: str):
+    # 驱动只把 Python int 识别为已转换的日期，日期先整体转为天数/秒数
+    if tp == 'Date':
+        return values.astype('datetime64[D]').astype(np.int64).tolist()
+    if tp == 'DateTime':
+        return values.astype('datetime64[s]').astype(np.int64).tolist()
+    return values
+
+
+def to_arrow(db_tab: str, dataf: pd.DataFrame) -> pa.Table:
+    """
+    按显式类型将 DataFrame 转换为 Arrow 表
+    :param db_tab: str 表名，需在 DB_TYPES 中
+    :param dataf: pd.DataFrame 入库格式的数据，参照 normalize
+    :return: pa.Table
+    """
+    types = DB_TYPES[db_tab]
+    return pa.table({col: _arrow_col(dataf[col].to_numpy(), tp) for col, tp in types.items()})
+
+
+def get_mode(mode: str | None = None) -> str:
+    mode = mode or os.getenv("db_insert_mode", "df")
+    if mode not in INSERT_MODES:
+        log.warning(f"未知的写入方式 {mode}，使用 df 方式写入。")
+        return 'df'
+    return mode
+
+
+def insert(conn, db_tab: str, dataf: pd.DataFrame, mode: str | None = None, async_insert: bool | None = None) -> int:
+    """
+    写入数据
+    :param conn: HttpClient 数据库连接
+    :param db_tab: str 表名
+    :param dataf: pd.DataFrame 数据
+    :param mode: str 写入方式，df/np/arrow，默认读取环境变量 db_insert_mode
+    :param async_insert: bool 是否使用服务端异步写入，默认读取环境变量 db_async_insert
+    :return: int 写入行数
+    """
+    mode = get_mode(mode) if db_tab in DB_TYPES else 'df'
+    if async_insert is None:
+        async_insert = os.getenv("db_async_insert", "0") == "1"
+    # 等待服务端落盘后再返回，保证下载进度只记录已写入的数据
+    settings = {'async_insert': 1, 'wait_for_async_insert': 1} if async_insert else None
+
+    t1 = time.perf_counter()
+    if mode == 'arrow':
+        table = to_arrow(db_tab, dataf)
+        nbytes = table.nbytes
+        conn.insert_arrow(db_tab, table, settings=settings)
+    elif mode == 'np':
+        types = DB_TYPES[db_tab]
+        nbytes = int(dataf[list(types)].memory_usage(index=False).sum())
+        data = [_np_col(dataf[col].to_numpy(), tp) for col, tp in types.items()]
+        conn.insert(db_tab, data, column_names=list(types), column_type_names=list(types.values()),
+                    column_oriented=True, settings=settings)
+    else:
+        nbytes = int(dataf.memory_usage(index=False).sum())
+        conn.insert_df(db_tab, dataf, settings=settings)
+    cost = time.perf_counter() - t1
+
+    key = f"{mode}+async" if async_insert else mode
+    with lock:
+        s = stats.setdefault(key, {'num': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0})
+        s['num'] += 1
+        s['rows'] += len(dataf)
+        s['bytes'] += nbytes
+        s['seconds'] += cost
+    metrics.insert_seconds.observe(cost, db_tab, key)
+    metrics.insert_rows.inc(db_tab, n=len(dataf))
+    metrics.insert_bytes.inc(db_tab, n=nbytes)
+    log.debug(f"写入{db_tab} {len(dataf)}行，方式{key}，耗时{cost:.3f}秒，{len(dataf) / max(cost, 1e-9):.0f}行/秒")
+    return len(dataf)
+
+
+def report():
+    """
+    输出每种写入方式的累计统计
+    """
+    with lock:
+        items = {k: dict(v) for k, v in stats.items()}
+    for key, s in items.items():
+        log.info(f"写入方式{key}：{s['num']}次，{s['rows']}行，{s['bytes'] / 2 ** 20:.1f}MB，"
+                 f"耗时{s['seconds']:.2f}秒，{s['rows'] / max(s['seconds'], 1e-9):.0f}行/秒")
+    return items
+
+
+if __name__ == '__main__':
+    from db.db_conn import get_conn
+
+    # 各写入方式的基准：写入与 quant.ts_min 结构相同的临时表，结束后删除
+    n = 500000
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'date': pd.date_range("2020-01-01 09:31", periods=n, freq="min"),
+        'code': np.array([f"{i:06d}.SZ" for i in range(100)])[rng.integers(0, 100, n)].astype(object),
+        **{col: rng.uniform(1, 100, n).round(2) for col in ('open', 'high', 'low', 'close')},
+        'volume': rng.uniform(0, 1e6, n).round(2), 'amount': rng.uniform(0, 1e8, n).round(2),
+    })
+    DB_TYPES['quant.ts_min_bench'] = DB_TYPES['quant.ts_min']
+    with get_conn() as conn:
+        conn.command("CREATE TABLE IF NOT EXISTS quant.ts_min_bench AS quant.ts_min")
+        try:
+            for m in INSERT_MODES:
+                for a in (False, True):
+                    conn.command("TRUNCATE TABLE quant.ts_min_bench")
+                    insert(conn, 'quant.ts_min_bench', df, m, a)
+        finally:
+            conn.command("DROP TABLE IF EXISTS quant.ts_min_bench")
+    report()
@@ -9,23 +9,44 @@ import signal
 import time
 from dataclasses import dataclass
 from datetime import datetime
-from multiprocessing import Lock, Manager, TimeoutError
+from multiprocessing import TimeoutError
 from multiprocessing.pool import ThreadPool
+from threading import Lock
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from conf.constants import *
-from db.source.base import ADJ, DAY, MIN
+from db import adjust, bars, dedup, insert, local_cache
+from db.bars import BARS
+from db.engine import AsyncEngine
+from db.local_cache import KlineStore, convert
+from db.query_cache import query_cache
+from db.planner import plan
+from db.source.base import ADJ, DAY, FQ, MIN, NONE
 from db.source.base import DataSource
+from db.trade_cal import TradeCal
+from db.writer import BatchWriter
+from libs import metrics, trace
 from libs.cache import Cache
 from libs.dtTools import delta_datetime
-from libs.tools import diff_date, paging
+from libs.journal import Journal, get_journal
 
-CPU_SIZE = 4  # 并发计算的核心数量
 loc = Lock()
 
 
+class DownloadStopped(Exception):
+    """
+    asyncio 方式下载时手动终止（Ctrl-C），进度及未完成的任务已保存，调用方不应继续后续下载
+    :param err_cache: Cache 未完成任务的错误列表
+    """
+
+    def __init__(self, err_cache):
+        super().__init__(f"已手动终止下载，未完成的任务：{err_cache.path if err_cache else None}")
+        self.err_cache = err_cache
+
+
 @dataclass
 class KlineBase:
     """
@@ -33,8 +54,12 @@ class KlineBase:
     :param ds: DataSource  # 传入的数据源，可以是GMSource
     :param sdt: str 字符串格式19900101 格式
     :param edt: str
-    :param over_map: dict 用于装入已完成的股票代码及历史数据进度
-    :param cache: Cache 缓存类读写进度
+    :param over_map: dict 用于装入已完成的股票代码及历史数据进度 {'code': [['sdt', 'edt'], ...]}
+    :param cache: Journal 追加写的进度日志
+    :param pipeline: bool 是否使用流水线模式，下载线程只获取数据，由批量写入线程合并入库
+    :param reconcile: bool 是否根据数据库中已入库的数据重建下载进度，本地进度为空时自动重建
+    :param cal: TradeCal 交易日历，用于按交易日计算缺口及分页
+    :param engine: str 下载方式，thread: 线程池，async: asyncio 分阶段限流，参照 db.engine，默认读取环境变量 download_engine
     """
 
     ds: DataSource = None
@@ -42,10 +67,16 @@ class KlineBase:
     edt: str = ''
     over_map = None
     all_num = 0
-    cache: Cache = None
+    cache: Journal = None
+    pipeline: bool = False
+    reconcile: bool = False
+    cal: TradeCal = None
+    engine: str = None
 
     def __post_init__(self):
         assert self.ds, "ds 数据源不能为空"
+        self.engine = self.engine or os.getenv("download_engine", "thread")
+        assert self.engine in ('thread', 'async'), f"不支持的下载方式：{self.engine}"
         self.edt = datetime.now().strftime(dt_format)
 
         assert self.edt >= self.sdt, "结束日期必须大于开始日期！"
@@ -55,19 +86,53 @@ class KlineBase:
             self.edt = delta_datetime(strdt=self.edt, _format=dt_format, days=-1)
             log.warning(f"当天17点前,数据未更新,已将结束日期自动调整到前一天,调整后{self.edt=}")
 
-        # 如果是周末，日期自动回调到周五，防止不必要的重复下载覆盖
-        week = datetime.strptime(self.edt, dt_format).weekday() + 1
-        if week > 5:
-            self.edt = delta_datetime(strdt=self.edt, _format=dt_format, days=-week + 5)
-            log.warning(f"周末日期自动调整：{week=},调整后：{self.edt=}")
+    def load_cal(self):
+        """
+        加载交易日历，并将结束日期调整为最近的交易日，防止周末、节假日不必要的重复下载覆盖
+        """
+        if self.cal is None:
+            self.cal = TradeCal(ds=self.ds).load()
+        edt = self.cal.last(self.edt)
+        if edt != self.edt:
+            log.warning(f"非交易日日期自动调整：{self.edt=},调整后：{edt}")
+            self.edt = edt
 
     def load_cache(self):
+        self.load_cal()
         cache_name = f"{self.ds.__class__.__name__}_{self.ds.dtype.sql}"
-        self.cache = Cache(cache_name)
-        load_cache = self.cache.get()
+        self.cache = get_journal(cache_name)
         # 进度条读取
-        self.over_map, self.all_num = load_cache if load_cache else [{}, 0]
+        self.over_map = self.cache.data
         log.info(f"读取缓存{cache_name}数据，已发现{len(self.over_map)}条。")
+        if self.reconcile or not self.over_map:
+            self.reconcile_cache()
+
+    def reconcile_cache(self):
+        """
+        根据数据库中每支股票的最小、最大日期及按交易日历找到的中间缺失段重建下载进度，覆盖本地进度
+        """
+        df = self.ds.sel_progress()
+        if df.empty:
+            log.info(f"数据库中未发现{self.ds.dtype.sql}数据，无需重建进度。")
+            return
+        edt = df['edt']
+        if self.ds.dtype is MIN:
+            # 与分钟数据下载保持一致，已完成日期为最大日期+1
+            edt = (pd.to_datetime(edt, format=dt_format) + pd.Timedelta(days=1)).dt.strftime(dt_format)
+        data = {code: [[s, e]] for code, s, e in zip(df['code'], df['sdt'], edt)}
+
+        # 按缺失段拆分已完成的日期段
+        holes = self.ds.sel_holes()
+        for code, s, e in zip(holes['code'], holes['sdt'], holes['edt']):
+            if code not in data:
+                continue
+            last = data[code].pop()
+            data[code].extend([[last[0], s], [e, last[1]]])
+        log.info(f"数据库中发现{len(holes)}个缺失日期段。")
+
+        self.cache.reset(data)
+        self.over_map = self.cache.data
+        log.info(f"已根据数据库重建{self.ds.dtype.sql}下载进度，共{len(self.over_map)}条。")
 
     def save_err(self, ls: list) -> Cache | None:
         """
@@ -92,110 +157,147 @@ class KlineBase:
         """
         log.warning(f"加载出错缓存并重新下载:{err_cache.path}")
         err_ls = err_cache.get()
-        self.download(err_ls)
+        try:
+            self.download(err_ls)
+        except DownloadStopped:
+            # 未完成的任务已保存到新的错误列表
+            err_cache.remove()
+            raise
         err_cache.remove()
 
-    def _download_k(self, codes_n, dic, err_ls: list):
+    def _download_k(self, codes_n, err_ls: list, writer: BatchWriter = None):
         """
         多线程调用的K线下载函数
         :param codes_n: 需要下载的股票代码，开始时间，结束时间
-        :param dic: 加载进多线程缓存的over_map，用于更新下载进度
         :param err_ls: 加载进多线程的错误列表，用于接收保存出错的标的
+        :param writer: 流水线模式下的批量写入器，为None时直接入库
         :return:
         """
+        with trace.task(codes_n):
+            self._download_one(codes_n, err_ls, writer)
+
+    def _download_one(self, codes_n, err_ls: list, writer: BatchWriter = None):
         symbol, sdt, edt = codes_n
-        if self.ds.dtype is ADJ:
+        if writer:
+            get = self.ds.get_adjust if self.ds.dtype is ADJ else self.ds.get_hist
+            df, max_edt = get(symbol, sdt, edt)
+            if df is not None:
+                # 写入完成后才记录进度
+                writer.put(self.ds.db_tab, df,
+                           callback=lambda ok: self._done(codes_n, max_edt if ok else 0, err_ls))
+                return
+        elif self.ds.dtype is ADJ:
             max_edt = self.ds.update_adjust(symbol, sdt, edt)
         else:
             max_edt = self.ds.update_hist(symbol, sdt, edt)
+        self._done(codes_n, max_edt, err_ls)
 
+    def _done(self, codes_n, max_edt, err_ls: list):
+        """
+        记录单个下载任务的结果
+        :param codes_n: 需要下载的股票代码，开始时间，结束时间
+        :param max_edt: 已完成的最大日期，为0时代表失败
+        :param err_ls: 加载进多线程的错误列表，用于接收保存出错的标的
+        """
+        symbol, sdt, edt = codes_n
+        metrics.tasks_done.inc(self.ds.dtype.sql, 'ok' if max_edt else 'error')
         if not max_edt:
             log.error(f"{symbol}.{self.ds.dtype.sql}.{sdt}~{edt}插入数据库失败")
             with loc:
                 err_ls.append(codes_n)
             return
 
-        with loc:
-            for key in symbol:
-                old_sdt, old_edt = dic.get(key, ("99999999", "0"))
-                end_edt = max(old_edt, max_edt)
-                dic[key] = (min(old_sdt, sdt), end_edt)
-            self.cache.set([dic.copy(), len(dic)])
-            log.success(f"已完成{symbol}.{self.ds.dtype.sql}的数据下载更新,更新后日期{end_edt}。")
+        self.cache.add(symbol, sdt, max_edt)
+        local_cache.invalidate(self.ds.db_tab, symbol, sdt, max_edt)
+        # 复权因子变化后该股票所有表的复权查询结果都需要重新获取
+        for code in symbol:
+            query_cache.invalidate(None if self.ds.dtype is ADJ else self.ds.db_tab, code)
+        log.success(f"已完成{symbol}.{self.ds.dtype.sql}的数据下载更新,更新后日期{max_edt}。")
 
     def download(self, down_list: list) -> Cache:
         """
         下载方法，传入list可以直接调用 [(['code'],'sdt','edt'), ...] 具体格式参照参数示例
         :param down_list: list [(['601882.SH'], '20200207', '20200621'), (['601882.SH'], '20200621', '20201103'),  ...]
-        :return: 返回出错的cache对象
+        :return: 返回出错的cache对象，asyncio 方式下手动终止时抛出 DownloadStopped
         """
 
-        with Manager() as manager:
+        metrics.tasks_left.set(len(down_list), self.ds.dtype.sql)
+        if self.engine == 'async':
+            return self._download_async(down_list)
 
-            dic = manager.dict(self.over_map)
-            thread_list = []
-            err_ls = manager.list()
-            log.info(f"当前数据源允许线程数：{self.ds.thread_num}")
+        thread_list = []
+        err_ls = []
+        log.info(f"当前数据源允许线程数：{self.ds.thread_num}")
 
-            def signal_handler(signum, frame):
-                self.over_map = dict(dic)
-                err = self.save_err(err_ls)
-                log.error(f"已手动终止程序,程序将自动保存错误列表,如有请使用load({err})加载处理")
-                exit()
+        def signal_handler(signum, frame):
+            self.cache.compact()
+            err = self.save_err(err_ls)
+            log.error(f"已手动终止程序,程序将自动保存错误列表,如有请使用load({err})加载处理")
+            exit()
 
-            signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGINT, signal_handler)
 
-            pool = ThreadPool(self.ds.thread_num)
-            for d in down_list:
-                thread_list.append(pool.apply_async(self._download_k, args=(d, dic, err_ls)))
+        writer = BatchWriter(self.ds).start() if self.pipeline else None
+        pool = ThreadPool(self.ds.thread_num)
+        for d in down_list:
+            thread_list.append(pool.apply_async(self._download_k, args=(d, err_ls, writer)))
 
-            # 定义超时及进度条
-            for t in tqdm(thread_list, desc="数据更新进度"):
-                try:
-                    t.get(timeout=15 * 60)
-                except TimeoutError:
-                    print("线程超时错误，已中断所有线程，请稍后重试...")
-                    pool.terminate()
+        # 定义超时及进度条
+        for t in tqdm(thread_list, desc="数据更新进度"):
+            try:
+                t.get(timeout=15 * 60)
+            except TimeoutError:
+                print("线程超时错误，已中断所有线程，请稍后重试...")
+                pool.terminate()
+            metrics.tasks_left.dec(self.ds.dtype.sql)
 
-            pool.close()
-            pool.join()
-            self.over_map = dic.copy()
-            err_cache = self.save_err(err_ls)
-            return err_cache
+        pool.close()
+        pool.join()
+        return self._finish(writer, err_ls)
 
-    def _pre_check(self, symbol: list[str, str]):
+    def _download_async(self, down_list: list) -> Cache:
         """
-        多线程调用的预处理方法
-        :param symbol: 传入的带日期的单支股票
-        :return:
+        asyncio 方式下载，Ctrl-C 时保存进度及未完成的任务后抛出 DownloadStopped，不退出进程
         """
+        err_ls = []
+        writer = BatchWriter(self.ds).start() if self.pipeline else None
+        stopped = AsyncEngine(self).run(down_list, err_ls, writer)
+        err_cache = self._finish(writer, err_ls)
+        if stopped:
+            log.error(f"已手动终止程序,进度已保存,未完成的任务请使用load_err({err_cache})加载处理")
+            raise DownloadStopped(err_cache)
+        return err_cache
 
-        # 如果是分钟，日期自动+1，避免当日数据获取不到
-        edt = delta_datetime(strdt=self.edt, _format=dt_format,
-                             days=1) if self.ds.dtype is MIN else self.edt
-
-        # 此处opendt=上市时间
-        code, opendt = symbol
-        if opendt > edt:
-            log.warning(f"上市时间 > 结束时间 错误：{code=},{opendt=},{edt=}")
-            return []
-        # 增加(数据源，上市时间，开始时间)判断
-        opendt = max(self.ds.source_date, opendt, self.sdt)
-
-        # if opendt != self.sdt:
-        #     # log.debug(f"当前开始时间已调整：{code=}, {self.ds.source_date=}，{opendt=}，{self.sdt=}")
-        #     self.sdt = opendt
-
-        up1, up2 = self.over_map.get(code, (None, None))
-        if not up2 or not up1:
-            # log.debug([[code, (opendt, edt)]])
-            return [[code, (opendt, edt)]]
-        else:
-            up_ls = diff_date(up1, up2, opendt, edt)
-            if not up_ls:
-                # log.debug(f"数据已存在，自动跳过： {code=} - {up1=}~{up2=}, {opendt=}~{self.edt=}")
-                return []
-            return [[code, (up[0], up[1])] for up in up_ls]
+    def _finish(self, writer: BatchWriter | None, err_ls: list) -> Cache:
+        """
+        下载结束后写入剩余数据、合并分区、重建多周期K线并保存进度及错误列表
+        """
+        writer.close() if writer else None
+        # 只合并本次写入涉及的分区，之后的查询可以不使用 FINAL；再按分区重建多周期K线，去掉重复写入的累加
+        parts = dedup.optimize(self.ds.db_tab)
+        if self.ds.db_tab in parts:
+            bars.rebuild(self.ds.db_tab, dedup.partition_key(self.ds.db_tab), parts[self.ds.db_tab])
+            # 重建期间读取的多周期K线可能不完整
+            query_cache.invalidate(self.ds.db_tab)
+        if self.ds.dtype is ADJ:
+            adjust.clear()
+        if self.ds.dtype is not MIN:
+            # 按交易日下载的进度为逐日的日期段，合并之间没有交易日的日期段，避免进度碎片化
+            joined = {code: self.cal.join(iv) for code, iv in self.cache.data.items() if len(iv) > 1}
+            if any(len(iv) < len(self.cache.data[code]) for code, iv in joined.items()):
+                self.cache.reset({**self.cache.data, **joined})
+                self.over_map = self.cache.data
+        self.cache.compact()
+        self.cache.close()
+        self.ds.limiter.report() if self.ds.limiter else None
+        insert.report()
+        trace.tracer.report()
+        if os.getenv("trace_dir"):
+            name = f"trace_{self.ds.dtype.sql}_{datetime.now():%Y%m%d_%H%M%S}.json"
+            trace.tracer.export(Path(os.getenv("trace_dir")) / name)
+        trace.tracer.reset()
+        err_cache = self.save_err(err_ls)
+        return err_cache
 
     def pre(self, symbols: list):
         """
@@ -204,55 +306,11 @@ class KlineBase:
         :return: list [(['code'], 'sdt', 'edt'), (['601882.SH'], '20200621', '20201103'),  ...]
         """
         self.ds.set_source()
+        self.load_cal()
         assert symbols, "没有获取到沪深A股，请重新确认。"
         self.all_num = len(symbols)
         log.debug(f"当前共获取到{self.all_num}支股票。")
-
-        pool = ThreadPool(CPU_SIZE)
-        res = pool.map(self._pre_check, symbols)
-        pre_list = []
-        for tmp in res:
-            pre_list.extend(tmp)
-
-        pool.close()
-        pool.join()
-
-        df = pd.DataFrame(pre_list, columns=["code", "date"])
-        # 查看有几种不同的日期段
-        # date_kind = df['date'].unique()
-        # 输出为字典
-        date_kind = df['date'].value_counts().to_dict()
-        log.debug(f"{date_kind=}")
-
-        down_list = []
-        # 遍历每一个日期段
-        for k in date_kind:
-            codes = df[(df['date'] == k)].code.to_list()
-            pg = paging(k, self.ds.dtype, self.ds.limit)
-            tmp, num = 0, len(codes)
-            if pg > 1:
-                while tmp < num:
-                    next_tmp = tmp + pg
-                    i1 = min(next_tmp, num)
-                    codes_n = codes[tmp:i1]
-                    down_list.append((codes_n, k[0], k[1]))
-                    tmp = i1
-            else:
-                for code in codes:
-                    _sdt, _edt = k[0], k[0]
-                    while _edt < k[1]:
-                        # 如果频率为F1
-                        if self.ds.dtype is MIN:
-                            _edt = delta_datetime(_sdt, int(self.ds.limit / 240))
-                        else:
-                            _edt = delta_datetime(_sdt, int(self.ds.limit))
-
-                        # 如果日期段小于等于给定的日期段，则跳过
-                        _edt = min(_edt, k[1])
-                        down_list.append(([code], _sdt, _edt))
-                        _sdt = _edt
-                # log.warning(f"当前下载列表：{down_list}")
-        return down_list
+        return plan(symbols, self.over_map, self.sdt, self.edt, self.ds, self.cal)
 
     def download_day(self, symbols: list = None):
 
@@ -289,19 +347,160 @@ class KLineQuery:
     ds: DataSource = None
     sdt: str = '19900101'  # 起始日期
     edt: str = '20221231'
+    chunk_size: int = 500  # 批量查询时单次查询的股票数量，避免SQL超过服务端 max_query_size 限制
+    columns: list = None  # 查询字段，默认全部字段
+    price: str = None  # 价格类型，None: 原始Decimal，float: float64，int: 放大100倍的int64
+    fmt: str = 'df'  # 返回格式，df: pd.DataFrame，np: np.ndarray，arrow: pyarrow.Table
+    freq: str = None  # 周期，None: ds.dtype，5min/15min/30min/60min/W/M: 服务端聚合的多周期K线，参照 db.bars
+    fq: FQ = None  # 复权方式，None: ds.fq，PRE: 前复权，POST: 后复权，在服务端关联 quant.ts_adj 计算，参照 db.adjust
+    disk_cache: bool = False  # 是否使用本地列式缓存，仅用于原始周期的不复权查询，参照 db.local_cache
+    mem_cache: bool = False  # 是否使用进程内查询缓存，重叠的日期段只查询缺少的部分，参照 db.query_cache
 
     def __post_init__(self):
         assert self.ds, "ds 数据源不能为空"
         self.ds.dtype = self.ds.dtype if self.ds.dtype else DAY
         assert self.edt >= self.sdt, "结束日期必须大于开始日期！"
+        assert not self.freq or self.freq in BARS, f"freq 仅支持：{list(BARS)}"
+        self.store = KlineStore(self.ds) if self.disk_cache else None
+        self.position = None  # stream 已返回的最后一行 (code, date)，中断后作为 after 参数继续读取
+
+    @property
+    def use_store(self) -> bool:
+        return self.store is not None and not self.freq and (self.fq or self.ds.fq) is NONE
+
+    def _fetch_arrow(self, symbols: list[str], sdt: str, edt: str) -> dict:
+        """
+        查询缓存的获取函数：全部字段，Arrow 格式，按股票切分
+        """
+        if self.use_store:
+            return self.store.get(symbols, sdt, edt, None, self.price, 'arrow')
+        res = {}
+        for i in range(0, len(symbols), self.chunk_size):
+            data = self.ds.sel_kline_for_symbols(symbols[i:i + self.chunk_size], sdt, edt,
+                                                 None, self.price, 'arrow', self.freq, self.fq)
+            res.update(self._split_by_code(data, 'arrow'))
+        return res
+
+    def _from_mem(self, symbols: list[str], sdt: str, edt: str, columns: list[str] = None) -> dict:
+        prefix = (self.ds.db_tab, self.freq, (self.fq or self.ds.fq).sql, self.price)
+        tables = query_cache.get(prefix, symbols, sdt, edt, self._fetch_arrow)
+        return {code: convert(t, self.ds.dtype.sql, columns, None, self.fmt) for code, t in tables.items()}
 
     def get_kline(self, symbol):
         t1 = time.time()
-        df = self.ds.sel_kline_for_symbol(symbol, self.sdt, self.edt)
+        if self.mem_cache:
+            df = self._from_mem([symbol], self.sdt, self.edt, self.columns).get(symbol)
+            if df is not None:
+                log.debug(f"从查询缓存读取{symbol}-{self.ds.dtype.sql}-{self.sdt}~{self.edt}完成，"
+                          f"共计耗时：{time.time() - t1} 秒")
+                return df
+        if self.use_store:
+            df = self.store.get([symbol], self.sdt, self.edt, self.columns, self.price, self.fmt).get(symbol)
+            if df is not None:
+                log.debug(f"从本地缓存读取{symbol}-{self.ds.dtype.sql}-{self.sdt}~{self.edt}完成，"
+                          f"共计耗时：{time.time() - t1} 秒")
+                return df
+        df = self.ds.sel_kline_for_symbol(symbol, self.sdt, self.edt, self.columns, self.price, self.fmt, self.freq,
+                                          self.fq)
         t2 = time.time() - t1
         log.debug(f"查询{symbol}-{self.ds.dtype.sql}-{self.sdt}~{self.edt}完成，共计耗时：{t2} 秒")
         return df
 
+    def get_klines(self, symbols: list[str], sdt: str = None, edt: str = None) -> dict[str, pd.DataFrame]:
+        """
+        批量查询多支股票K线，按 chunk_size 自动分批，每批只访问一次数据库
+        :param symbols: list 股票代码 ['600001.SH', '000001.SZ', ...]
+        :param sdt: str 开始时间，默认使用 self.sdt
+        :param edt: str 结束时间，默认使用 self.edt
+        :return: dict {'600001.SH': pd.DataFrame, ...}，未查到数据的股票不在结果中
+        """
+        sdt, edt = sdt or self.sdt, edt or self.edt
+        columns = self.columns
+        if columns and 'code' not in columns:
+            columns = ['code'] + list(columns)
+        t1 = time.time()
+        if self.mem_cache:
+            res = self._from_mem(symbols, sdt, edt, columns)
+            log.debug(f"从查询缓存批量读取{len(symbols)}支-{self.ds.dtype.sql}-{sdt}~{edt}完成，"
+                      f"获取到{len(res)}支，共计耗时：{time.time() - t1} 秒")
+            return res
+        if self.use_store:
+            res = self.store.get(symbols, sdt, edt, columns, self.price, self.fmt)
+            log.debug(f"从本地缓存批量读取{len(symbols)}支-{self.ds.dtype.sql}-{sdt}~{edt}完成，"
+                      f"获取到{len(res)}支，共计耗时：{time.time() - t1} 秒")
+            return res
+        res = {}
+        for i in range(0, len(symbols), self.chunk_size):
+            data = self.ds.sel_kline_for_symbols(symbols[i:i + self.chunk_size], sdt, edt,
+                                                 columns, self.price, self.fmt, self.freq, self.fq)
+            res.update(self._split_by_code(data))
+        t2 = time.time() - t1
+        log.debug(f"批量查询{len(symbols)}支-{self.ds.dtype.sql}-{sdt}~{edt}完成，"
+                  f"获取到{len(res)}支，共计耗时：{t2} 秒")
+        return res
+
+    def stream(self, symbols: list[str] = None, sdt: str = None, edt: str = None, chunk_rows: int = 65536,
+               after: tuple[str, str] = None):
+        """
+        流式读取大范围K线，按 code,date 顺序逐块返回，内存占用只与块大小相关，不经过本地缓存及查询缓存
+        :param symbols: list 股票代码，None 表示全部股票（复权查询需要指定）
+        :param sdt: str 开始时间，默认使用 self.sdt
+        :param edt: str 结束时间，默认使用 self.edt
+        :param chunk_rows: int 每块的最大行数
+        :param after: tuple (code, date) 从该位置之后继续读取，通常为中断前的 self.position
+        :return: generator 按 self.fmt 返回每块数据，每块返回后 self.position 更新为该块最后一行
+        """
+        sdt, edt = sdt or self.sdt, edt or self.edt
+        columns = self.columns
+        if columns:
+            # 记录读取位置需要 code 及 date
+            columns = [c for c in ('code', 'date') if c not in columns] + list(columns)
+        kind = BARS[self.freq].src.split('_')[-1] if self.freq else self.ds.dtype.sql
+        date_fmt = '%Y-%m-%d %H:%M:%S' if kind == 'min' else '%Y-%m-%d'
+        # 分批查询时按代码排序，保证各批之间的顺序
+        chunks = [None]
+        if symbols:
+            symbols = sorted(s for s in symbols if not after or s >= after[0])
+            chunks = [symbols[i:i + self.chunk_size] for i in range(0, len(symbols), self.chunk_size)]
+
+        t1, rows = time.time(), 0
+        for chunk in chunks:
+            for block in self.ds.sel_kline_stream(chunk, sdt, edt, columns, self.price, self.fmt, self.freq,
+                                                  self.fq, chunk_rows, after):
+                if not len(block):
+                    continue
+                if self.fmt == 'arrow':
+                    code, date = block.column('code')[-1].as_py(), block.column('date')[-1].as_py()
+                elif self.fmt == 'np':
+                    code, date = block['code'][-1], block['date'][-1]
+                else:
+                    code, date = block['code'].iat[-1], block['date'].iat[-1]
+                self.position = (str(code), pd.Timestamp(date).strftime(date_fmt))
+                rows += len(block)
+                yield block
+        log.debug(f"流式读取{self.ds.dtype.sql}-{sdt}~{edt}完成，共{rows}条，耗时：{time.time() - t1} 秒")
+
+    def _split_by_code(self, data, fmt: str = None) -> dict:
+        """
+        将按 code 排序的查询结果切分为 {code: 数据}，np/arrow 格式使用切片，不复制数据
+        :param data: pd.DataFrame | np.ndarray | pyarrow.Table
+        :param fmt: str 数据格式，默认 self.fmt
+        :return: dict
+        """
+        fmt = fmt or self.fmt
+        if fmt == 'df':
+            return {code: tmp.reset_index(drop=True) for code, tmp in data.groupby('code', sort=False)}
+
+        codes = data.column('code').to_numpy() if fmt == 'arrow' else data['code']
+        if not len(codes):
+            return {}
+        _, starts = np.unique(codes, return_index=True)
+        bounds = np.append(np.sort(starts), len(codes))
+        keys = codes[bounds[:-1]]
+        if fmt == 'arrow':
+            return {k: data.slice(s, e - s) for k, s, e in zip(keys, bounds[:-1], bounds[1:])}
+        return {k: data[s:e] for k, s, e in zip(keys, bounds[:-1], bounds[1:])}
+
 
 def load_errs_cache(err_cache_name: str):
     """
@@ -323,7 +522,12 @@ def load_errs_cache(err_cache_name: str):
     kd.load_cache()
 
     err_ls = cache.get()
-    kd.download(err_ls)
+    try:
+        kd.download(err_ls)
+    except DownloadStopped:
+        # 未完成的任务已保存到新的错误列表
+        cache.remove()
+        raise
     cache.remove()
 
 
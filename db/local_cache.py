@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/8/008 20:30
+# @Author : 不归
+# @FileName: local_cache.py
+"""
+K线本地列式缓存（可选）：按 表/股票/年 保存为 Arrow IPC 文件，读取时内存映射，不经过数据库
+- 路径：%userprofile%/.czsc/kline/{db_tab}/{code}/{year}.arrow，同目录 meta.json 记录已缓存的 {'sdt', 'edt'}
+- 首次读取某支股票时缓存数据库中的全部历史；数据库最大日期前移后，只重新获取最后一年及之后的数据
+- 下载任务写入某个日期段后删除对应年份的文件（invalidate），下次读取时重新获取
+缓存保存原始字段（Decimal 价格），读取时按 columns/price/fmt 转换，与直接查询数据库的结果一致。
+"""
+import shutil
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from orjson import orjson
+
+from conf.constants import *
+from db.source.base import DECIMAL_COLS, NONE, PRICE_COLS, DataSource
+from libs.cache import home
+
+ROOT = home / ".czsc/kline"
+CHUNK_SIZE = 200  # 补充缓存时单次查询的股票数量
+CHECK_TTL = 60  # 秒，同一支股票在该时间内不再检查数据库最大日期，重复读取只访问本地文件
+
+
+def _dir(db_tab: str, code: str) -> Path:
+    return ROOT / db_tab / code
+
+
+def _read_meta(path: Path) -> dict:
+    try:
+        return orjson.loads((path / "meta.json").read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def _write_meta(path: Path, meta: dict):
+    tmp = path / "meta.tmp"
+    tmp.write_bytes(orjson.dumps(meta))
+    os.replace(tmp, path / "meta.json")
+
+
+def invalidate(db_tab: str, codes: list[str], sdt: str, edt: str):
+    """
+    下载任务写入后，删除涉及年份的缓存文件；写入早于已缓存开始日期的数据时同时前移开始日期，下次读取时补充
+    :param db_tab: str 表名
+    :param codes: list 股票代码
+    :param sdt: str 写入的开始日期
+    :param edt: str 写入的结束日期
+    """
+    if not (ROOT / db_tab).exists():
+        return
+    for code in codes:
+        path = _dir(db_tab, code)
+        meta = _read_meta(path)
+        if not meta:
+            continue
+        for y in range(int(sdt[:4]), int(edt[:4]) + 1):
+            (path / f"{y}.arrow").unlink(missing_ok=True)
+        if sdt < meta['sdt']:
+            _write_meta(path, {**meta, 'sdt': sdt})
+
+
+def convert(table: pa.Table, kind: str, columns: list[str] = None, price: str = None, fmt: str = 'df'):
+    """
+    将缓存的原始数据转换为与数据库查询相同的结果，参照 DataSource._select_fields
+    """
+    if columns:
+        table = table.select(columns)
+    if price:
+        for col in table.column_names:
+            if col not in DECIMAL_COLS.get(kind, ()):
+                continue
+            arr = pc.cast(table.column(col), pa.float64())
+            if price == 'int' and col in PRICE_COLS:
+                arr = pc.cast(pc.round(pc.multiply(arr, 100)), pa.int64())
+            table = table.set_column(table.schema.get_field_index(col), col, arr)
+    if fmt == 'arrow':
+        return table
+    # LowCardinality 的 code 为字典编码，转换为普通字符串，与 query_df 的结果一致
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+    df = table.to_pandas(date_as_object=False)
+    return df.to_records(index=False) if fmt == 'np' else df
+
+
+@dataclass
+class KlineStore:
+    """
+    :param ds: DataSource 数据源，使用其 dtype 对应的表及查询方法
+    :param ttl: int 检查数据库最大日期的间隔秒数
+    """
+    ds: DataSource = None
+    ttl: int = CHECK_TTL
+
+    def __post_init__(self):
+        self.checked: dict[tuple, float] = {}  # {(db_tab, code): 检查时间}
+
+    @property
+    def db_tab(self) -> str:
+        return self.ds.db_tab
+
+    def _db_range(self, symbols: list[str]) -> dict[str, tuple[str, str]]:
+        """
+        数据库中每支股票的最小、最大日期，参照 DataSource.sel_progress
+        """
+        codes = ','.join(f"'{s}'" for s in symbols)
+        fields = "code, formatDateTime(min({0}), '%Y%m%d') AS sdt, formatDateTime(max({1}), '%Y%m%d') AS edt"
+        try:
+            df = DataSource._query_clickhouse(f"SELECT {fields.format('sdt', 'edt')} FROM {self.db_tab}_summary "
+                                              f"WHERE code IN ({codes}) GROUP BY code")
+        except Exception:
+            df = pd.DataFrame()
+        if df.empty:
+            df = DataSource._query_clickhouse(f"SELECT {fields.format('date', 'date')} FROM {self.db_tab} "
+                                              f"WHERE code IN ({codes}) GROUP BY code")
+        return {c: (s, e) for c, s, e in zip(df['code'], df['sdt'], df['edt'])}
+
+    def _todo(self, code: str, db_sdt: str, db_edt: str) -> list[tuple[int, int]]:
+        """
+        需要从数据库获取的年份，合并为连续区间 [(开始年, 结束年), ...]
+        """
+        path = _dir(self.db_tab, code)
+        meta = _read_meta(path)
+        if not meta or db_sdt < meta['sdt']:
+            shutil.rmtree(path, ignore_errors=True)
+            years = range(int(db_sdt[:4]), int(db_edt[:4]) + 1)
+        else:
+            last = int(meta['edt'][:4]) if db_edt > meta['edt'] else None
+            years = [y for y in range(int(meta['sdt'][:4]), int(db_edt[:4]) + 1)
+                     if y == last or y > int(meta['edt'][:4]) or not (path / f"{y}.arrow").exists()]
+        runs = []
+        for y in years:
+            if runs and runs[-1][1] == y - 1:
+                runs[-1][1] = y
+            else:
+                runs.append([y, y])
+        return [tuple(r) for r in runs]
+
+    def _save(self, code: str, table: pa.Table, run: tuple[int, int], db_sdt: str, db_edt: str):
+        """
+        按年写入缓存文件，没有数据的年份写入空文件，避免重复查询
+        """
+        path = _dir(self.db_tab, code)
+        path.mkdir(parents=True, exist_ok=True)
+        years = pc.year(table.column('date')).to_numpy() if table.num_rows else np.array([], dtype=np.int64)
+        for y in range(run[0], run[1] + 1):
+            idx = np.flatnonzero(years == y)
+            part = table.take(pa.array(idx)) if len(idx) else table.slice(0, 0)
+            tmp = path / f"{y}.tmp"
+            with pa.OSFile(str(tmp), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(part)
+            os.replace(tmp, path / f"{y}.arrow")
+        meta = _read_meta(path)
+        _write_meta(path, {'sdt': min(meta.get('sdt', db_sdt), db_sdt), 'edt': db_edt})
+
+    def sync(self, symbols: list[str]):
+        """
+        补充缓存：缺失的年份、数据库最大日期前移后的最后一年及之后的数据，相同区间的股票合并查询
+        :param symbols: list 股票代码
+        """
+        t1 = time.time()
+        symbols = [s for s in symbols if t1 - self.checked.get((self.db_tab, s), 0) > self.ttl]
+        if not symbols:
+            return
+        ranges = self._db_range(symbols)
+        groups: dict[tuple, list] = {}
+        for code, (s, e) in ranges.items():
+            for run in self._todo(code, s, e):
+                groups.setdefault(run, []).append(code)
+
+        for run, codes in groups.items():
+            for i in range(0, len(codes), CHUNK_SIZE):
+                chunk = codes[i:i + CHUNK_SIZE]
+                # 分钟数据按 date BETWEEN 查询时结束日期为0点，取下一年1月1日以包含12月31日的数据
+                table = self.ds.sel_kline_for_symbols(chunk, f"{run[0]}0101", f"{run[1] + 1}0101", fmt='arrow',
+                                                      fq=NONE)
+                # 查询结果按 code,date 排序，按边界切片
+                col = table.column('code')
+                if pa.types.is_dictionary(col.type):
+                    col = col.cast(pa.string())
+                codes_arr = col.to_numpy().astype(str)
+                uniq, starts = np.unique(codes_arr, return_index=True)
+                bounds = dict(zip(uniq, starts))
+                counts = dict(zip(uniq, np.bincount(np.searchsorted(uniq, codes_arr), minlength=len(uniq))))
+                for code in chunk:
+                    part = table.slice(bounds[code], counts[code]) if code in bounds else table.slice(0, 0)
+                    self._save(code, part, run, *ranges[code])
+        self.checked.update({(self.db_tab, s): t1 for s in symbols})
+        if groups:
+            log.debug(f"已补充{self.db_tab}本地缓存：{len(ranges)}支股票，{len(groups)}个区间，"
+                      f"耗时{time.time() - t1:.3f}秒")
+
+    def _complete(self, code: str, sdt: str, edt: str) -> bool:
+        """
+        [sdt, edt] 与已缓存日期段重叠的年份文件是否都存在
+        """
+        path = _dir(self.db_tab, code)
+        meta = _read_meta(path)
+        if not meta:
+            return True
+        years = range(int(max(sdt, meta['sdt'])[:4]), int(min(edt, meta['edt'])[:4]) + 1)
+        return all((path / f"{y}.arrow").exists() for y in years)
+
+    def read(self, code: str, sdt: str, edt: str) -> pa.Table | None:
+        """
+        内存映射读取 [sdt, edt] 的缓存数据，日期边界与数据库查询的 date BETWEEN 一致
+        """
+        path = _dir(self.db_tab, code)
+        tables = []
+        for y in range(int(sdt[:4]), int(edt[:4]) + 1):
+            f = path / f"{y}.arrow"
+            if f.exists():
+                tables.append(pa.ipc.open_file(pa.memory_map(str(f), 'r')).read_all())
+        if not tables:
+            return None
+        table = pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+        dates = table.column('date').to_numpy()
+        lo = np.searchsorted(dates, np.datetime64(pd.Timestamp(sdt)).astype(dates.dtype), 'left')
+        hi = np.searchsorted(dates, np.datetime64(pd.Timestamp(edt)).astype(dates.dtype), 'right')
+        return table.slice(lo, hi - lo)
+
+    def get(self, symbols: list[str], sdt: str, edt: str, columns: list[str] = None, price: str = None,
+            fmt: str = 'df') -> dict:
+        """
+        读取多支股票K线，先补充缓存再读取本地文件
+        :return: dict {'600001.SH': 数据, ...}，未查到数据的股票不在结果中
+        """
+        self.sync(symbols)
+        # 检查间隔内被下载任务删除的年份，立即补充
+        missing = [c for c in symbols if not self._complete(c, sdt, edt)]
+        if missing:
+            for c in missing:
+                self.checked.pop((self.db_tab, c), None)
+            self.sync(missing)
+        res = {}
+        for code in symbols:
+            table = self.read(code, sdt, edt)
+            if table is not None and table.num_rows:
+                res[code] = convert(table, self.ds.dtype.sql, columns, price, fmt)
+        return res
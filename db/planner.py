@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/9/28/028 20:30
+# @Author : 不归
+# @FileName: planner.py
+"""
+下载规划：用 numpy 一次性计算全部股票的缺口（按交易日），并把（股票 × 日期段）装箱为尽量填满 ds.limit 行的请求。
+日期统一使用 int64 的 YYYYMMDD，如：20230415，与交易日历 TradeCal.days 一致。
+数据源支持按交易日获取全市场数据（ds.by_date）时，日线及复权因子的短缺口（如每日增量更新）按交易日请求更少时改为按交易日请求。
+"""
+import time
+
+import numpy as np
+
+from conf.constants import *
+from db.source.base import ByDate, DataSource, MIN
+from db.trade_cal import TradeCal
+from libs.dtTools import delta_datetime
+
+MIN_ROWS = 240  # 分钟数据每个交易日的行数
+BY_DATE_DAYS = 10  # 缺口不超过该交易日数的股票才考虑按交易日请求，参照 _by_date
+
+
+def _flatten(codes: np.ndarray, over_map: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    将每支股票已完成的日期段展开为数组
+    :return: (owner, iv) owner为日期段所属股票的下标，iv为 shape=(n, 2) 的 [sdt, edt]
+    """
+    ivs = [over_map.get(c) or () for c in codes]
+    lens = np.fromiter((len(iv) for iv in ivs), dtype=np.int64, count=len(ivs))
+    flat = [d for iv in ivs for pair in iv for d in pair]
+    iv = np.array(flat, dtype=str).astype(np.int64).reshape(-1, 2)
+    return np.repeat(np.arange(len(codes)), lens), iv
+
+
+def find_gaps(codes: np.ndarray, start: np.ndarray, edt: int, over_map: dict):
+    """
+    计算每支股票 [start, edt] 中未完成的日期段，结果与 libs.tools.diff_intervals 一致
+    :param codes: np.ndarray 股票代码
+    :param start: np.ndarray 每支股票的开始日期
+    :param edt: int 结束日期
+    :param over_map: dict 已完成的日期段 {'code': [['sdt', 'edt'], ...]}
+    :return: (owner, gs, ge, s_cov, e_cov) 缺口所属股票下标、缺口首尾日期、首尾是否为已完成日期段的边界
+    """
+    owner, iv = _flatten(codes, over_map)
+    iv_s, iv_e = iv[:, 0], iv[:, 1]
+    n = len(owner)
+
+    first = np.ones(n, dtype=bool)
+    first[1:] = owner[1:] != owner[:-1]
+    last = np.ones(n, dtype=bool)
+    last[:-1] = owner[1:] != owner[:-1]
+
+    # 日期段之前的缺口：(上一段结束日期 或 开始日期, 本段开始日期)
+    prev_end = np.where(first, start[owner], np.roll(iv_e, 1))
+    inner_s = np.maximum(prev_end, start[owner])
+    inner_s_cov = ~first & (prev_end >= start[owner])
+    inner_e = np.minimum(iv_s, edt)
+    inner_e_cov = iv_s <= edt
+
+    # 最后一段之后的缺口：(最后一段结束日期 或 开始日期, 结束日期)
+    last_end = np.full(len(codes), -1, dtype=np.int64)
+    last_end[owner[last]] = iv_e[last]
+    tail_s = np.maximum(last_end, start)
+    tail_s_cov = last_end >= start
+
+    g_owner = np.concatenate([owner, np.arange(len(codes))])
+    gs = np.concatenate([inner_s, tail_s])
+    ge = np.concatenate([inner_e, np.full(len(codes), edt, dtype=np.int64)])
+    s_cov = np.concatenate([inner_s_cov, tail_s_cov])
+    e_cov = np.concatenate([inner_e_cov, np.zeros(len(codes), dtype=bool)])
+
+    ok = gs < ge
+    return g_owner[ok], gs[ok], ge[ok], s_cov[ok], e_cov[ok]
+
+
+def _split(days: np.ndarray, gs: np.ndarray, ge: np.ndarray, per: int) -> tuple:
+    """
+    按交易日把每个缺口切分为多段，每段最多跨 per 个交易日，相邻段共用边界日期
+    :return: (rep, sdt, edt) rep为切分后每段对应的缺口下标
+    """
+    li = np.searchsorted(days, gs, 'left')
+    lt = np.searchsorted(days, ge, 'left')  # 小于结束日期的交易日
+    k = np.maximum((lt - li - 1) // per, 0) + 1
+    rep = np.repeat(np.arange(len(gs)), k)
+    j = np.arange(len(rep)) - np.repeat(np.cumsum(k) - k, k)
+
+    top = len(days) - 1
+    sdt = np.where(j == 0, gs[rep], days[np.minimum(li[rep] + j * per, top)])
+    edt = np.where(j == k[rep] - 1, ge[rep], days[np.minimum(li[rep] + (j + 1) * per, top)])
+    return rep, sdt, edt
+
+
+def _single(codes: np.ndarray, sdt: np.ndarray, edt: np.ndarray) -> list:
+    """单支股票的请求列表，日期整体转为字符串，避免逐个转换"""
+    return list(zip(([c] for c in codes.tolist()), sdt.astype('U8').tolist(), edt.astype('U8').tolist()))
+
+
+def _pack(cal: TradeCal, codes: np.ndarray, gs: np.ndarray, ge: np.ndarray, rows: np.ndarray, limit: int) -> list:
+    """
+    多支股票共用同一日期段请求时装箱：相同日期段按 limit // 行数 分组，各日期段剩余的不满组再按日期合并
+    """
+    res, rest = [], []
+    key = gs * 10 ** 8 + ge
+    uniq, idx, inv = np.unique(key, return_index=True, return_inverse=True)
+    order = np.argsort(inv, kind='stable')
+    bounds = np.append(0, np.cumsum(np.bincount(inv, minlength=len(uniq))))
+    for u in range(len(uniq)):
+        group = codes[order[bounds[u]:bounds[u + 1]]].tolist()
+        s, e, n = gs[idx[u]], ge[idx[u]], rows[idx[u]]
+        per = max(limit // max(n, 1), 1)
+        full = len(group) // per * per
+        res.extend((group[i:i + per], str(s), str(e)) for i in range(0, full, per))
+        if full < len(group):
+            rest.append((s, e, group[full:]))
+
+    # 不满的分组按开始日期排序，合并后的日期段行数不超过 limit 时合并
+    cur = None
+    for s, e, group in sorted(rest, key=lambda x: (x[0], x[1])):
+        if cur:
+            us, ue = min(cur[0], s), max(cur[1], e)
+            if (len(cur[2]) + len(group)) * cal.count(str(us), str(ue)) <= limit:
+                cur = (us, ue, cur[2] + group)
+                continue
+            res.append((cur[2], str(cur[0]), str(cur[1])))
+        cur = (s, e, group)
+    if cur:
+        res.append((cur[2], str(cur[0]), str(cur[1])))
+    return res
+
+
+def _by_date(days: np.ndarray, codes: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> list:
+    """
+    按交易日请求：每个交易日一个请求，包含该日需要下载的全部股票，开始日期与结束日期相同，数据源一次获取当日全市场数据
+    :param lo: np.ndarray 每个缺口第一个需要下载的交易日下标
+    :param hi: np.ndarray 每个缺口最后一个需要下载的交易日下标+1
+    :return: list [(ByDate(['000001.SZ', '600000.SH', ...]), '20231010', '20231010'), ...]
+    """
+    n = hi - lo
+    rep = np.repeat(np.arange(len(lo)), n)
+    di = lo[rep] + np.arange(len(rep)) - np.repeat(np.cumsum(n) - n, n)
+    order = np.argsort(di, kind='stable')
+    uniq, idx = np.unique(di[order], return_index=True)
+    groups = np.split(codes[rep][order], idx[1:])
+    return [(ByDate(g.tolist()), str(days[u]), str(days[u])) for u, g in zip(uniq, groups)]
+
+
+def plan(symbols: list, over_map: dict, sdt: str, edt: str, ds: DataSource, cal: TradeCal) -> list:
+    """
+    根据股票列表及已完成进度，规划下载请求
+    :param symbols: list [['code', 'sdt'], ['300642.SZ', '20170421'], ...] sdt为上市日期
+    :param over_map: dict 已完成的日期段 {'code': [['sdt', 'edt'], ...]}
+    :param sdt: str 开始日期
+    :param edt: str 结束日期
+    :param ds: DataSource 数据源，使用其 dtype、limit、source_date
+    :param cal: TradeCal 交易日历
+    :return: list [(['code'], 'sdt', 'edt'), (['601882.SH'], '20200621', '20201103'),  ...]
+    """
+    t1 = time.time()
+    # 如果是分钟，日期自动+1，避免当日数据获取不到
+    if ds.dtype is MIN:
+        edt = delta_datetime(strdt=edt, _format=dt_format, days=1)
+    e = int(edt)
+    days = cal.days
+
+    codes = np.array([s[0] for s in symbols], dtype=object)
+    opendt = np.array([s[1] for s in symbols], dtype=str).astype(np.int64)
+    if (opendt > e).any():
+        log.warning(f"上市时间 > 结束时间：{codes[opendt > e].tolist()},{edt=}")
+    codes, opendt = codes[opendt <= e], opendt[opendt <= e]
+    # 增加(数据源，上市时间，开始时间)判断
+    start = np.maximum(opendt, max(int(ds.source_date), int(sdt)))
+
+    owner, gs, ge, s_cov, e_cov = find_gaps(codes, start, e, over_map)
+
+    # 缺口中未入库的交易日数量，首尾为已入库的交易日时不计入；分钟数据的已完成日期为最大日期+1，开始日期并未入库
+    top = len(days) - 1
+    li = np.searchsorted(days, gs, 'left')
+    ri = np.searchsorted(days, ge, 'right')
+    rows = ri - li
+    # [lo, hi) 为缺口中需要下载的交易日下标
+    lo = li + (s_cov & (days[np.minimum(li, top)] == gs)) if ds.dtype is not MIN else li
+    hi = ri - (e_cov & (days[np.maximum(ri - 1, 0)] == ge))
+    ok = hi > lo
+    owner, gs, ge, rows, lo, hi = owner[ok], gs[ok], ge[ok], rows[ok], lo[ok], hi[ok]
+    gap_codes = codes[owner]
+
+    if ds.dtype is MIN:
+        # 分钟数据单支股票请求，按交易日切分
+        rep, s_arr, e_arr = _split(days, gs, ge, max(ds.limit // MIN_ROWS - 1, 1))
+        down_list = _single(gap_codes[rep], s_arr, e_arr)
+    else:
+        # 单支股票超过 limit 的缺口按交易日切分，其余装箱
+        big = rows > ds.limit
+        rep, s_arr, e_arr = _split(days, gs[big], ge[big], max(ds.limit - 1, 1))
+        down_list = _single(gap_codes[big][rep], s_arr, e_arr)
+        packed = _pack(cal, gap_codes[~big], gs[~big], ge[~big], rows[~big], ds.limit)
+        short = ~big & (hi - lo <= BY_DATE_DAYS)
+        if getattr(ds, 'by_date', False) and short.any():
+            # 缺口较短的股票改为按交易日请求，总请求数更少时采用
+            rest = ~big & ~short
+            dated = _by_date(days, gap_codes[short], lo[short], hi[short])
+            dated += _pack(cal, gap_codes[rest], gs[rest], ge[rest], rows[rest], ds.limit)
+            if len(dated) < len(packed):
+                log.debug(f"{short.sum()}个缺口改为按交易日请求，请求数{len(packed)} -> {len(dated)}")
+                packed = dated
+        down_list.extend(packed)
+
+    log.debug(f"下载规划完成：{len(codes)}支股票，{len(gs)}个缺口，{len(down_list)}个请求，"
+              f"耗时{time.time() - t1:.4f}秒")
+    return down_list
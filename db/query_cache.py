@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/9/009 21:00
+# @Author : 不归
+# @FileName: query_cache.py
+"""
+K线查询的进程内缓存：每个 (表, 周期, 股票, 复权, 价格类型) 只保存已获取过的最大连续日期段
+- 请求的日期段被已缓存的日期段包含时直接切片返回
+- 部分重叠时只获取缺少的头部、尾部，合并后扩大缓存的日期段
+- 按 Arrow 表占用的字节数限制总大小，超出时淘汰最久未使用的股票；可选过期时间
+日期边界与数据库查询的 date BETWEEN 一致，[sdt, edt] 均按当日0点比较。
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from conf.constants import *
+
+
+def _ts(dt: str, dates: np.ndarray) -> np.datetime64:
+    return np.datetime64(pd.Timestamp(dt)).astype(dates.dtype)
+
+
+@dataclass
+class Entry:
+    sdt: str
+    edt: str
+    table: pa.Table
+    dates: np.ndarray  # 日期列的 numpy 副本，用于二分查找
+    ts: float = field(default_factory=time.time)
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes + self.dates.nbytes
+
+    def slice(self, sdt: str, edt: str) -> pa.Table:
+        lo = np.searchsorted(self.dates, _ts(sdt, self.dates), 'left')
+        hi = np.searchsorted(self.dates, _ts(edt, self.dates), 'right')
+        return self.table.slice(lo, hi - lo)
+
+
+class RangeCache:
+    """
+    :param max_bytes: int 缓存占用的最大字节数
+    :param ttl: float 过期秒数，0 表示不过期
+    """
+
+    def __init__(self, max_bytes: int = None, ttl: float = None):
+        self.max_bytes = max_bytes or int(float(os.getenv("query_cache_mb", 512)) * 2 ** 20)
+        self.ttl = float(os.getenv("query_cache_ttl", 0)) if ttl is None else ttl
+        self.data: OrderedDict[tuple, Entry] = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counter = {'hits': 0, 'partial': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def _pop(self, key: tuple):
+        entry = self.data.pop(key)
+        self.bytes -= entry.nbytes
+
+    def _lookup(self, key: tuple) -> Entry | None:
+        entry = self.data.get(key)
+        if entry and self.ttl and time.time() - entry.ts > self.ttl:
+            self._pop(key)
+            self.counter['expired'] += 1
+            return None
+        if entry:
+            self.data.move_to_end(key)
+        return entry
+
+    def _store(self, key: tuple, entry: Entry):
+        if key in self.data:
+            self._pop(key)
+        if entry.nbytes > self.max_bytes:
+            return
+        self.data[key] = entry
+        self.bytes += entry.nbytes
+        while self.bytes > self.max_bytes:
+            self._pop(next(iter(self.data)))
+            self.counter['evictions'] += 1
+
+    def get(self, prefix: tuple, symbols: list[str], sdt: str, edt: str,
+            fetch: Callable[[list[str], str, str], dict]) -> dict[str, pa.Table]:
+        """
+        读取多支股票 [sdt, edt] 的数据，缺少的部分按相同日期段合并调用 fetch 获取
+        :param prefix: tuple 缓存键中股票代码之外的部分，如：('quant.ts_day', None, 'none', 'float')
+        :param symbols: list 股票代码
+        :param fetch: 获取函数 fetch(codes, sdt, edt) -> {'code': pa.Table}，结果按 date 排序
+        :return: dict {'code': pa.Table}，没有数据的股票不在结果中
+        """
+        pieces: dict[tuple, list] = {}  # {(sdt, edt): [code, ...]}
+        with self.lock:
+            for code in symbols:
+                entry = self._lookup(prefix + (code,))
+                if entry is None:
+                    self.counter['misses'] += 1
+                    pieces.setdefault((sdt, edt), []).append(code)
+                    continue
+                if entry.sdt <= sdt and edt <= entry.edt:
+                    self.counter['hits'] += 1
+                    continue
+                self.counter['partial'] += 1
+                # 与已缓存的日期段相连，中间的空缺一并获取，保持连续
+                if sdt < entry.sdt:
+                    pieces.setdefault((sdt, entry.sdt), []).append(code)
+                if edt > entry.edt:
+                    pieces.setdefault((entry.edt, edt), []).append(code)
+
+        fetched = {(p, c): t for p, codes in pieces.items() for c, t in fetch(codes, *p).items()}
+        requested = {(p, c) for p, codes in pieces.items() for c in codes}
+
+        res = {}
+        with self.lock:
+            for code in symbols:
+                key = prefix + (code,)
+                entry = self.data.get(key)
+                if entry is None or not (entry.sdt <= sdt and edt <= entry.edt):
+                    entry = self._merge(entry, code, sdt, edt, fetched, requested)
+                    if entry is None:
+                        continue
+                    self._store(key, entry)
+                table = entry.slice(sdt, edt)
+                if table.num_rows:
+                    res[code] = table
+        return res
+
+    @staticmethod
+    def _merge(entry: Entry | None, code: str, sdt: str, edt: str, fetched: dict, requested: set) -> Entry | None:
+        """
+        合并已缓存的数据与新获取的头部、尾部，头部只保留早于原开始日期的行，尾部只保留晚于原结束日期的行；
+        获取期间缓存被其他线程替换时，只扩大实际获取过的一侧
+        """
+        if entry is None:
+            table = fetched.get(((sdt, edt), code))
+            if table is None:
+                return None
+            return Entry(sdt, edt, table, table.column('date').to_numpy())
+
+        tables, dates = [], []
+        new_sdt = min(sdt, entry.sdt) if ((sdt, entry.sdt), code) in requested else entry.sdt
+        new_edt = max(edt, entry.edt) if ((entry.edt, edt), code) in requested else entry.edt
+        head = fetched.get(((sdt, entry.sdt), code))
+        if head is not None and head.num_rows:
+            d = head.column('date').to_numpy()
+            n = np.searchsorted(d, _ts(entry.sdt, d), 'left')
+            tables.append(head.slice(0, n))
+            dates.append(d[:n])
+        tables.append(entry.table)
+        dates.append(entry.dates)
+        tail = fetched.get(((entry.edt, edt), code))
+        if tail is not None and tail.num_rows:
+            d = tail.column('date').to_numpy()
+            n = np.searchsorted(d, _ts(entry.edt, d), 'right')
+            tables.append(tail.slice(n))
+            dates.append(d[n:])
+        # 保留原获取时间，过期时间从最早获取的数据开始计算
+        return Entry(new_sdt, new_edt, pa.concat_tables(tables), np.concatenate(dates), entry.ts)
+
+    def invalidate(self, db_tab: str = None, code: str = None):
+        """
+        删除缓存，默认全部删除
+        """
+        with self.lock:
+            for key in [k for k in self.data if (not db_tab or k[0] == db_tab) and (not code or k[-1] == code)]:
+                self._pop(key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.counter['hits'] + self.counter['partial'] + self.counter['misses']
+            return {**self.counter, 'entries': len(self.data), 'bytes': self.bytes,
+                    'hit_rate': self.counter['hits'] / total if total else 0.0}
+
+    def report(self):
+        s = self.stats()
+        log.info(f"查询缓存：命中{s['hits']}次，部分命中{s['partial']}次，未命中{s['misses']}次，"
+                 f"命中率{s['hit_rate']:.1%}，淘汰{s['evictions']}次，过期{s['expired']}次，"
+                 f"{s['entries']}支股票，占用{s['bytes'] / 2 ** 20:.1f}MB")
+        return s
+
+
+query_cache = RangeCache()
@@ -9,16 +9,21 @@
 import traceback
 from collections import namedtuple
 from dataclasses import dataclass
-from datetime import datetime
 from http.client import RemoteDisconnected
 
 import pandas as pd
+import pyarrow as pa
 from clickhouse_connect.driver import ProgrammingError
-from clickhouse_connect.driver.exceptions import OperationalError
+from clickhouse_connect.driver.exceptions import DatabaseError, OperationalError
 from urllib3.exceptions import ProtocolError
 
 from conf.constants import *
+from db import dedup
 from db.db_conn import get_conn
+from db.insert import insert
+from db.source.normalize import date_range, normalize
+from libs import metrics, trace
+from libs.dtTools import delta_datetime
 
 """
 将不同数据源的频率封装在此页面上
@@ -36,6 +41,23 @@ PRE = FQ('pre', 1, 'front', 'qfq')
 POST = FQ('post', 2, 'back', 'hfq')
 
 
+class ByDate(list):
+    """
+    按交易日下载任务的股票列表，由 planner 生成，数据源据此一次获取当日全市场数据，与开始、结束日期相同的普通任务区分；
+    保存到错误列表后还原为普通 list，重新下载时按股票获取
+    """
+
+"""
+各表中以 Decimal 存储的字段，查询时按需转换为 float64 或放大100倍的 int64，避免返回逐个单元格的 Python Decimal 对象
+"""
+PRICE_COLS = ('open', 'high', 'low', 'close')
+DECIMAL_COLS = {
+    'day': PRICE_COLS,
+    'min': PRICE_COLS + ('volume', 'amount'),
+    'adj': (),
+}
+
+
 @dataclass
 class DataSource:
     """
@@ -47,38 +69,98 @@ class DataSource:
     limit: int = 32400  # 单次获取行限制,建议设置为240的倍数
     thread_num: int = 4  # 默认允许的多线程数量
     source_date: str = "19900101"  # 默认数据源提供的初始时间
+    specs = None  # 原始数据到入库格式的转换规则 {'day': {...}, 'min': {...}, 'adj': {...}}，参照 normalize
+    limiter = None  # 数据源接口限流器 RateLimiter，进程内共享
+    by_date = False  # 日线及复权因子是否支持按交易日一次获取全市场数据，参照 planner
 
     def set_source(self):
         raise NotImplementedError
 
     def _to_clickhouse(self, db_tab, dataf):
-        with get_conn() as conn:
-            try:
-                conn.insert_df(db_tab, dataf)
-            except ProgrammingError as e:
-                ex_str = traceback.format_exc()
-                log.error(ex_str)
-                print(e)
-                dataf.to_csv(f"errs/insert_{db_tab}.csv")
-                return 0
-            except (OperationalError, RemoteDisconnected, ProtocolError) as e:
-                log.error("服务器过热, 断开连接...")
-                return 0
-            except Exception as e:
-                ex_str = traceback.format_exc()
-                log.error(ex_str)
-                print(e)
-                dataf.to_csv(BASE_PATH / f"errs/insert_{db_tab}.csv")
-                exit()
+        # 异常在连接上下文之外处理，连接出错时由 get_conn 关闭该连接，不再放回连接池
+        try:
+            with get_conn() as conn, trace.span('insert'):
+                insert(conn, db_tab, dataf)
+                dedup.touch(db_tab, dataf)
+        except ProgrammingError as e:
+            ex_str = traceback.format_exc()
+            log.error(ex_str)
+            print(e)
+            dataf.to_csv(f"errs/insert_{db_tab}.csv")
+            return 0
+        except (OperationalError, RemoteDisconnected, ProtocolError) as e:
+            log.error("服务器过热, 断开连接...")
+            return 0
+        except Exception as e:
+            ex_str = traceback.format_exc()
+            log.error(ex_str)
+            print(e)
+            dataf.to_csv(BASE_PATH / f"errs/insert_{db_tab}.csv")
+            return 0
         return 1
 
     @staticmethod
-    def _query_clickhouse(sql: str) -> pd.DataFrame:
-        with get_conn() as conn:
-            res = conn.query_df(sql)
+    def _query_clickhouse(sql: str, fmt: str = 'df'):
+        """
+        查询数据库
+        :param sql: str 查询语句
+        :param fmt: str 返回格式，df: pd.DataFrame，np: np.ndarray，arrow: pyarrow.Table
+        :return: 按 fmt 返回对应的结果
+        """
+        with get_conn() as conn, metrics.query_seconds.time(fmt):
+            if fmt == 'arrow':
+                res = conn.query_arrow(sql)
+            elif fmt == 'np':
+                res = conn.query_np(sql)
+            else:
+                res = conn.query_df(sql)
             log.debug(f"查询【{sql}】完成")
         return res
 
+    @staticmethod
+    def _stream_clickhouse(sql: str, fmt: str = 'df', settings: dict = None):
+        """
+        流式查询数据库，逐块返回，占用的内存与块大小相关，与结果总行数无关
+        :param sql: str 查询语句
+        :param fmt: str 每块的格式，df: pd.DataFrame，np: np.ndarray，arrow: pyarrow.Table
+        :param settings: dict 查询设置，如：{'max_block_size': 65536}
+        :return: generator 每块的结果，提前结束迭代时关闭连接上的数据流
+        """
+        with get_conn() as conn:
+            if fmt == 'arrow':
+                stream = conn.query_arrow_stream(sql, settings=settings)
+            elif fmt == 'np':
+                stream = conn.query_np_stream(sql, settings=settings)
+            else:
+                stream = conn.query_df_stream(sql, settings=settings)
+            with stream:
+                for block in stream:
+                    yield pa.Table.from_batches([block]) if isinstance(block, pa.RecordBatch) else block
+            log.debug(f"流式查询【{sql}】完成")
+
+    def _select_fields(self, columns: list[str] | None = None, price: str | None = None, kind: str = None) -> str:
+        """
+        拼接查询字段，对 Decimal 字段做类型转换
+        :param columns: list 需要查询的字段，默认全部字段
+        :param price: str 价格类型，None: 原始Decimal，float: float64，int: 放大100倍的int64
+        :param kind: str 字段类型参照的表，day/min/adj，默认当前数据类型
+        :return: str 例如："date, code, toFloat64(close) AS close"
+        """
+        if not columns and not price:
+            return "*"
+        if not columns:
+            columns = ['date', 'code', 'open', 'high', 'low', 'close', 'volume', 'amount']
+        decimal_cols = DECIMAL_COLS.get(kind or self.dtype.sql, ())
+        fields = []
+        for col in columns:
+            if not price or col not in decimal_cols:
+                fields.append(col)
+            elif price == 'int' and col in PRICE_COLS:
+                fields.append(f"toInt64({col} * 100) AS {col}")
+            else:
+                fields.append(f"toFloat64({col}) AS {col}")
+        return ", ".join(fields)
+
     @staticmethod
     def _command_clickhouse(sql: str):
         with get_conn() as conn:
@@ -86,22 +168,153 @@ class DataSource:
             log.debug(f"执行【{sql}】完成")
         return res
 
+    def sel_progress(self) -> pd.DataFrame:
+        """
+        汇总数据库中每支股票已入库的日期范围，优先读取物化视图维护的汇总表 {db_tab}_summary，
+        汇总表不存在或为空时对原表做一次 GROUP BY 查询
+        :return: pd.DataFrame columns=['code', 'sdt', 'edt', 'num']，sdt/edt 为8位字符串日期，
+                 num 为累计写入行数，含重复写入的行，不能作为去重后的行数使用，参照 script/summary.sql
+        """
+        fields = "code, formatDateTime(min({0}), '%Y%m%d') AS sdt, " \
+                 "formatDateTime(max({1}), '%Y%m%d') AS edt, {2} AS num"
+        try:
+            sql = f"SELECT {fields.format('sdt', 'edt', 'sum(num)')} FROM {self.db_tab}_summary GROUP BY code"
+            df = self._query_clickhouse(sql)
+        except DatabaseError as e:
+            log.warning(f"读取汇总表{self.db_tab}_summary失败，改为汇总原表：{e}")
+            df = pd.DataFrame()
+        if df.empty:
+            sql = f"SELECT {fields.format('date', 'date', 'count()')} FROM {self.db_tab} GROUP BY code"
+            df = self._query_clickhouse(sql)
+        return df
+
+    def sel_holes(self) -> pd.DataFrame:
+        """
+        按交易日历查找每支股票已入库数据中间缺失的日期段（包括停牌），依赖 quant.trade_cal
+        :return: pd.DataFrame columns=['code', 'sdt', 'edt']，sdt/edt 为缺失段前后两个已入库的日期
+        """
+        sql = f"""
+        SELECT code, formatDateTime(prev, '%Y%m%d') AS sdt, formatDateTime(day, '%Y%m%d') AS edt
+        FROM (
+            SELECT code, day, n, lagInFrame(day) OVER w AS prev, lagInFrame(n) OVER w AS prev_n
+            FROM (SELECT DISTINCT code, toDate(date) AS day FROM {self.db_tab}) AS d
+            INNER JOIN (SELECT date AS day, row_number() OVER (ORDER BY date) AS n FROM quant.trade_cal FINAL) AS c
+            USING day
+            WINDOW w AS (PARTITION BY code ORDER BY day ROWS BETWEEN 1 PRECEDING AND CURRENT ROW)
+        )
+        WHERE prev_n > 0 AND n - prev_n > 1
+        ORDER BY code, day
+        """
+        try:
+            return self._query_clickhouse(sql)
+        except DatabaseError as e:
+            log.warning(f"查找{self.db_tab}缺失日期段失败：{e}")
+            return pd.DataFrame(columns=['code', 'sdt', 'edt'])
+
     @staticmethod
     def get_symbols_info() -> pd.DataFrame:
-        sql = "SELECT code,sdt FROM quant.codes FINAL WHERE status=1"
+        final, settings = dedup.final_clause("quant.codes")
+        sql = f"SELECT code,sdt FROM quant.codes {final} WHERE status=1{settings}"
         res = DataSource._query_clickhouse(sql)
         return res
 
-    def update_hist(self, symbols: list[str], sdt: datetime, edt: datetime) -> pd.DataFrame:
+    @property
+    def db_tab(self) -> str:
+        """当前数据类型对应的数据库表名"""
         raise NotImplementedError
 
-    def update_adjust(self, symbols: list[str], sdt: datetime, edt: datetime) -> pd.DataFrame:
+    def fetch(self, symbols: list[str], sdt: str, edt: str) -> list[pd.DataFrame]:
+        """
+        从数据源获取原始数据
+        :return: list 原始数据，未获取到数据时为空列表
+        """
         raise NotImplementedError
 
+    def transform(self, frames: list[pd.DataFrame], symbols: list[str], sdt: str, edt: str) \
+            -> tuple[pd.DataFrame | None, str | int]:
+        """
+        按 self.specs 将原始数据整理为入库格式，并检查日期是否超出请求范围
+        :param frames: list fetch 获取的原始数据
+        :return: (df, max_edt)，df为None时表示无需入库，max_edt为0表示失败
+        """
+        if not frames:
+            log.warning(f"未找到数据,可能是停牌{symbols, sdt, edt}")
+            return None, edt
+
+        metrics.rows_fetched.inc(self.dtype.sql, n=sum(len(f) for f in frames))
+        with metrics.transform_seconds.time(self.dtype.sql), trace.span('transform'):
+            df = normalize(frames, self.dtype, self.specs[self.dtype.sql])
+        if df.empty:
+            log.warning(f"{symbols}.{self.dtype.sql}.{sdt}~{edt}整理后没有数据，请确认。")
+            return None, 0
+        log.info(f"{symbols}.{self.dtype.sql}.{sdt}~{edt}获取到{df.shape[0]}条数据")
+
+        min_tag, max_tag = date_range(df)
+        # 此处代码主要用于判断数据是否有误，如QMT当时的错误脏数据。
+        if max_tag > edt or min_tag < sdt:
+            df.to_csv(f"zang_{symbols}_{self.dtype.sql}.csv", index=False)
+            log.error(f"查询结果出错，{edt=}-{sdt=},{min_tag=}-{max_tag=}")
+            return None, 0
+
+        if self.dtype is MIN:
+            # 分钟数据按日期请求时不包含结束日期当天，已完成日期为最大日期+1
+            return df, delta_datetime(strdt=max_tag, _format=dt_format, days=1)
+        return df, max_tag
+
+    def get_hist(self, symbols: list[str], sdt: str, edt: str) -> tuple[pd.DataFrame | None, str | int]:
+        """
+        获取K线并整理为入库格式，不写入数据库
+        :return: (df, max_edt)，df为None时表示无需入库，max_edt为0表示失败
+        """
+        return self.transform(self.fetch(symbols, sdt, edt), symbols, sdt, edt)
+
+    def get_adjust(self, symbols: list[str], sdt: str, edt: str) -> tuple[pd.DataFrame | None, str | int]:
+        """
+        获取复权因子并整理为入库格式，与K线共用 fetch/transform，按 dtype 区分
+        """
+        return self.get_hist(symbols, sdt, edt)
+
+    def update_hist(self, symbols: list[str], sdt: str, edt: str) -> str | int:
+        """
+        获取K线并写入数据库
+        :return: 成功返回str格式的最大日期（已完成进度），失败为0
+        """
+        df, max_edt = self.get_hist(symbols, sdt, edt)
+        if df is None:
+            return max_edt
+        return max_edt if self._to_clickhouse(self.db_tab, df) else 0
+
+    def update_adjust(self, symbols: list[str], sdt: str, edt: str) -> str | int:
+        """
+        获取复权因子并写入数据库
+        :return: 成功返回str格式的最大日期（已完成进度），失败为0
+        """
+        df, max_edt = self.get_adjust(symbols, sdt, edt)
+        if df is None:
+            return max_edt
+        return max_edt if self._to_clickhouse(self.db_tab, df) else 0
+
     def update_symbols_info(self):
         raise NotImplementedError
 
-    def sel_kline_for_symbol(self, symbol: str, sdt: str, edt: str):
+    def get_trade_cal(self, sdt: str, edt: str) -> list[str]:
+        """
+        获取交易日历
+        :return: list 交易日 ['19901219', '19901220', ...]
+        """
+        raise NotImplementedError
+
+    def sel_kline_for_symbol(self, symbol: str, sdt: str, edt: str, columns: list[str] = None,
+                             price: str = None, fmt: str = 'df', freq: str = None, fq: FQ = None):
+        raise NotImplementedError
+
+    def sel_kline_for_symbols(self, symbols: list[str], sdt: str, edt: str, columns: list[str] = None,
+                              price: str = None, fmt: str = 'df', freq: str = None, fq: FQ = None):
+        raise NotImplementedError
+
+    def sel_kline_stream(self, symbols: list[str] | None, sdt: str, edt: str, columns: list[str] = None,
+                         price: str = None, fmt: str = 'df', freq: str = None, fq: FQ = None,
+                         chunk_rows: int = 65536, after: tuple[str, str] = None):
         raise NotImplementedError
 
     def __str__(self) -> str:
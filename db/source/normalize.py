@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/2/002 15:10
+# @Author : 不归
+# @FileName: normalize.py
+"""
+各数据源原始数据的统一整理：一次合并、向量化解析日期、按 quant.ts_* 表结构转换类型。
+数据源只需提供转换规则 spec，例如 TS 日线：
+    {'rename': {'ts_code': 'code', 'trade_date': 'date', 'vol': 'volume'},
+     'time_format': '%Y%m%d', 'scale': {'volume': 100, 'amount': 1000}}
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from conf.constants import *
+
+"""
+入库格式，与 script/init.sql 中 quant.ts_* 的字段顺序及类型对应：Decimal(9, 2) -> float64（保留2位小数），UInt64 -> uint64
+"""
+SCHEMAS = {
+    'day': {'date': 'datetime64[ns]', 'code': 'object', 'open': 'float64', 'high': 'float64', 'low': 'float64',
+            'close': 'float64', 'volume': 'uint64', 'amount': 'uint64'},
+    'min': {'date': 'datetime64[ns]', 'code': 'object', 'open': 'float64', 'high': 'float64', 'low': 'float64',
+            'close': 'float64', 'volume': 'float64', 'amount': 'float64'},
+    'adj': {'date': 'datetime64[ns]', 'code': 'object', 'num': 'float64'},
+}
+PRICE_COLS = ['open', 'high', 'low', 'close']
+
+
+def normalize(frames: list[pd.DataFrame], dtype, spec: dict) -> pd.DataFrame:
+    """
+    将数据源返回的多个原始DataFrame整理为入库格式
+    :param frames: list 原始数据
+    :param dtype: Dtype 数据类型，决定入库格式
+    :param spec: dict 转换规则，rename: 字段映射，time_format: 日期格式，scale: 需要放大的字段及倍数
+    :return: pd.DataFrame 按 code,date 排序
+    """
+    schema = SCHEMAS[dtype.sql]
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        return pd.DataFrame({k: pd.Series(dtype=v) for k, v in schema.items()})
+
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    df = df.rename(columns=spec.get('rename', {}))[list(schema)]
+    # 删掉全为空值的行
+    df = df.dropna(axis=0, how='all', subset=list(schema)[2:])
+
+    df['date'] = pd.to_datetime(df['date'], format=spec.get('time_format'))
+    for col, n in spec.get('scale', {}).items():
+        df[col] = df[col] * n
+
+    if 'amount' in schema:
+        # 自动处理amount空值
+        df['amount'] = df['amount'].fillna(df['close'] * df['volume'])
+
+    for col, tp in schema.items():
+        if col in PRICE_COLS:
+            df[col] = df[col].astype('float64').round(2)
+        elif tp == 'uint64':
+            df[col] = df[col].fillna(0).round().astype('uint64')
+        elif tp == 'float64':
+            df[col] = df[col].astype('float64')
+
+    return df.sort_values(by=["code", "date"], ignore_index=True)
+
+
+def date_range(df: pd.DataFrame) -> tuple[str, str]:
+    """
+    :return: (最小日期, 最大日期)，8位字符串格式
+    """
+    return df['date'].min().strftime(dt_format), df['date'].max().strftime(dt_format)
+
+
+if __name__ == '__main__':
+    from db.source.base import DAY, MIN
+    from db.source.ts import TS_SPECS
+
+    # 每行耗时基准：模拟TS原始数据，200支股票一批
+    for dt, n in [(DAY, 5000), (MIN, 7920)]:
+        rng = np.random.default_rng(0)
+        time_field = ("trade_date", "trade_time")[dt is MIN]
+        dates = pd.date_range("2020-01-01 09:31", periods=n, freq="min" if dt is MIN else "D")
+        dates = dates.strftime(("%Y%m%d", "%Y-%m-%d %H:%M:%S")[dt is MIN])
+        raw = [pd.DataFrame({
+            'ts_code': f"{i:06d}.SZ", time_field: dates,
+            'open': rng.uniform(1, 100, n), 'high': rng.uniform(1, 100, n), 'low': rng.uniform(1, 100, n),
+            'close': rng.uniform(1, 100, n), 'vol': rng.uniform(0, 1e6, n), 'amount': rng.uniform(0, 1e8, n),
+        }) for i in range(200)]
+        rows = n * len(raw)
+
+        t1 = time.perf_counter()
+        normalize(raw, dt, TS_SPECS[dt.sql])
+        t2 = time.perf_counter() - t1
+        print(f"{dt.sql}: {rows}行，共耗时{t2:.3f}秒，每行{t2 / rows * 1e9:.0f}纳秒")
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/13/013 20:20
+# @Author : 不归
+# @FileName: sim.py
+"""
+模拟数据源：不访问网络，按TS接口格式生成确定性的日线、分钟线及复权因子，用于下载引擎的离线压测
+- 继承 TSSource，只替换 self.pro（及分钟线 pro_bar），分批、重试、停牌判断及数据整理与真实数据源一致
+- 可配置接口延迟分布、每分钟调用配额（超出时与TS一样抛出异常）、出错及空结果比例、停牌股票比例
+- 同一股票同一日期的数据与请求的日期范围无关，重复下载结果相同
+- dry_run 时只统计写入的行数，不访问数据库；否则写入 {db} 库中与 quant 结构相同的表，不影响真实数据
+用法参照 __main__：传入 cal=ds.trade_cal() 及 symbols=ds.symbols()，避免从数据库读取交易日历及股票列表。
+"""
+import math
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from conf.constants import *
+from db.source.base import DAY
+from db.source.ts import TS_LIMITS, TS_SPECS, TSSource
+from db.trade_cal import CAL_SDT, TradeCal
+from libs.dtTools import now_str
+from libs.limiter import RateLimiter
+
+CAL_EDT = "20301231"
+LATENCY_DISTS = ('const', 'uniform', 'exp', 'lognormal')
+_MIN_TIMES = pd.date_range("09:31", periods=120, freq="min").append(pd.date_range("13:01", periods=120, freq="min"))
+_MIN_OFFSETS = (_MIN_TIMES - _MIN_TIMES.normalize()).values  # 每个交易日240个分钟相对0点的偏移
+
+
+def _noise(i: np.ndarray | int, t: np.ndarray, salt: int = 0) -> np.ndarray:
+    """
+    由股票序号及时间序号确定的 [0, 1) 伪随机数，与请求范围无关
+    """
+    x = (np.int64(i) * 73856093) ^ (t.astype(np.int64) * 19349663) ^ (salt * 83492791)
+    return (x % 10007) / 10007
+
+
+class SimPro:
+    """
+    模拟 tushare pro_api 对象，参数与TS接口一致
+    """
+
+    def __init__(self, sim: 'SimulatedSource'):
+        self.sim = sim
+
+    def daily(self, ts_code: str = None, start_date: str = None, end_date: str = None, trade_date: str = None,
+              **kwargs) -> pd.DataFrame:
+        return self.sim.call('daily', 'day', ts_code, start_date or trade_date, end_date or trade_date)
+
+    def adj_factor(self, ts_code: str = None, start_date: str = None, end_date: str = None, trade_date: str = None,
+                   **kwargs) -> pd.DataFrame:
+        return self.sim.call('adj_factor', 'adj', ts_code, start_date or trade_date, end_date or trade_date)
+
+    def pro_bar(self, ts_code: str, start_date: str, end_date: str, **kwargs) -> pd.DataFrame:
+        return self.sim.call('pro_bar', 'min', ts_code, start_date, end_date)
+
+    def suspend_d(self, suspend_type: str = 'S', ts_code: str = None, trade_date: str = None,
+                  start_date: str = None, end_date: str = None, **kwargs) -> pd.DataFrame:
+        self.sim.check_quota('suspend_d')
+        return self.sim.suspended(ts_code, trade_date or start_date, trade_date or end_date)
+
+    def trade_cal(self, start_date: str, end_date: str, **kwargs) -> pd.DataFrame:
+        self.sim.check_quota('trade_cal')
+        days = self.sim.days[(self.sim.days >= int(start_date)) & (self.sim.days <= int(end_date))]
+        return pd.DataFrame({'exchange': 'SSE', 'cal_date': days.astype(str), 'is_open': 1})
+
+    def stock_basic(self, list_status: str = 'L', **kwargs) -> pd.DataFrame:
+        if list_status != 'L':
+            return pd.DataFrame(columns=['ts_code', 'name', 'list_date', 'delist_date'])
+        codes, list_dates = zip(*self.sim.symbols())
+        return pd.DataFrame({'ts_code': codes, 'name': [f"模拟{c[:6]}" for c in codes],
+                             'list_date': list_dates, 'delist_date': None})
+
+
+@dataclass
+class SimulatedSource(TSSource):
+    """
+    :param n_codes: int 股票数量
+    :param seed: int 随机种子，决定出错、空结果的序列
+    :param latency: str 接口延迟分布，const/uniform/exp/lognormal
+    :param latency_mean: float 平均延迟秒数
+    :param latency_sigma: float 对数正态分布的形状参数，越大长尾越明显
+    :param quota: dict 各接口每分钟最多调用次数，同时用于客户端限流及模拟的服务端配额，默认与TS相同，参照 TS_LIMITS
+    :param error_rate: float 接口抛出异常的比例
+    :param empty_rate: float 接口返回空结果的比例
+    :param suspend_rate: float 有停牌区间的股票比例
+    :param dry_run: bool 是否只统计写入行数，不访问数据库
+    :param db: str 非 dry_run 时写入的数据库，需先按 init.sql 建立同结构的表
+    """
+    n_codes: int = 5000
+    seed: int = 0
+    latency: str = 'lognormal'
+    latency_mean: float = 0.05
+    latency_sigma: float = 0.5
+    quota: dict = None
+    error_rate: float = 0.01
+    empty_rate: float = 0.0
+    suspend_rate: float = 0.05
+    dry_run: bool = True
+    db: str = "sim"
+    counter: dict = field(default_factory=lambda: {'calls': 0, 'errors': 0, 'empty': 0, 'quota': 0, 'rows': 0,
+                                                   'written': 0})
+
+    def __post_init__(self):
+        assert self.latency in LATENCY_DISTS, f"latency 仅支持：{LATENCY_DISTS}"
+        self.thread_num = int(os.getenv("sim_thread_num", self.thread_num))
+        self.quota = {**TS_LIMITS, **(self.quota or {})}
+        # 客户端限流与模拟的服务端配额使用同一配置
+        self.limiter = RateLimiter(prefix="sim_limit_", defaults=self.quota)
+        self.specs = TS_SPECS
+        self.by_date = True
+        self.pro = SimPro(self)
+        self.rng = random.Random(self.seed)
+        self.lock = threading.Lock()
+        self.windows: dict[str, deque] = {}  # 各接口最近一分钟的调用时间
+
+        dts = np.arange(np.datetime64(pd.Timestamp(CAL_SDT).date()), np.datetime64(pd.Timestamp(CAL_EDT).date()))
+        self.dates = dts[np.is_busday(dts)]
+        self.days = pd.DatetimeIndex(self.dates).strftime(dt_format).astype(np.int64).to_numpy()
+        # 上市日期及停牌区间按股票序号确定：(上市日序号, 停牌开始序号, 停牌结束序号)
+        idx = np.arange(self.n_codes)
+        top = int(np.searchsorted(self.days, int(now_str(dt_format)))) - 250
+        self.list_idx = (_noise(idx, idx, 1) * top).astype(np.int64)
+        s = self.list_idx + (_noise(idx, idx, 2) * (top - self.list_idx)).astype(np.int64)
+        has = _noise(idx, idx, 3) < self.suspend_rate
+        e = s + 5 + (_noise(idx, idx, 4) * 55).astype(np.int64)
+        self.suspend = np.where(has[:, None], np.stack([s, e], 1), -1)
+
+    @property
+    def db_tab(self) -> str:
+        return f"{self.db}.ts_{self.dtype.sql}"
+
+    def _pro_bar(self, **kwargs) -> pd.DataFrame:
+        return self.pro.pro_bar(**kwargs)
+
+    @staticmethod
+    def code(i: int) -> str:
+        return f"{i:06d}.{'SH' if i % 2 else 'SZ'}"
+
+    def symbols(self) -> list[list[str]]:
+        """
+        带上市日期的股票列表，用于 KlineBase.download_*(symbols=...)
+        :return: list [['000000.SZ', '20180625'], ...]
+        """
+        return [[self.code(i), str(self.days[d])] for i, d in enumerate(self.list_idx)]
+
+    def trade_cal(self) -> TradeCal:
+        """用于 KlineBase(cal=...)，不读取本地缓存及数据库"""
+        return TradeCal(ds=self, days=self.days)
+
+    def check_quota(self, endpoint: str):
+        """
+        超过每分钟调用配额时与TS一样抛出异常
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.counter['calls'] += 1
+            q = self.windows.setdefault(endpoint, deque())
+            while q and now - q[0] > 60:
+                q.popleft()
+            if len(q) >= self.quota.get(endpoint, 500):
+                self.counter['quota'] += 1
+                raise Exception(f"抱歉，您每分钟最多访问该接口{self.quota[endpoint]}次")
+            q.append(now)
+
+    def _latency(self) -> float:
+        if self.latency_mean <= 0:
+            return 0
+        with self.lock:
+            if self.latency == 'const':
+                return self.latency_mean
+            if self.latency == 'uniform':
+                return self.rng.uniform(0, 2 * self.latency_mean)
+            if self.latency == 'exp':
+                return self.rng.expovariate(1 / self.latency_mean)
+            mu = math.log(self.latency_mean) - self.latency_sigma ** 2 / 2
+            return self.rng.lognormvariate(mu, self.latency_sigma)
+
+    def call(self, endpoint: str, kind: str, ts_code: str, sdt: str, edt: str) -> pd.DataFrame:
+        """
+        模拟一次接口调用：配额检查、延迟、按比例出错或返回空结果，否则生成数据
+        :param ts_code: str 逗号分隔的股票代码，为None时返回全部股票（按交易日获取）
+        """
+        self.check_quota(endpoint)
+        time.sleep(self._latency())
+        with self.lock:
+            r = self.rng.random()
+        if r < self.error_rate:
+            with self.lock:
+                self.counter['errors'] += 1
+            raise ConnectionError(f"模拟接口{endpoint}出错")
+        if r < self.error_rate + self.empty_rate:
+            with self.lock:
+                self.counter['empty'] += 1
+            return pd.DataFrame()
+        codes = ts_code.split(',') if ts_code else [self.code(i) for i in range(self.n_codes)]
+        df = self.generate(kind, codes, sdt, edt)
+        with self.lock:
+            self.counter['rows'] += len(df)
+        return df
+
+    def _trading(self, i: int, lo: int, hi: int) -> np.ndarray:
+        """
+        股票在交易日序号 [lo, hi) 中上市后且未停牌的序号
+        """
+        t = np.arange(max(lo, self.list_idx[i]), hi)
+        s, e = self.suspend[i]
+        return t[(t < s) | (t >= e)]
+
+    def generate(self, kind: str, codes: list[str], sdt: str, edt: str) -> pd.DataFrame:
+        """
+        生成TS格式的原始数据，按日期倒序，与TS一致；分钟线不包含结束日期当天
+        :param kind: str day/min/adj
+        """
+        lo = int(np.searchsorted(self.days, int(sdt), 'left'))
+        hi = int(np.searchsorted(self.days, int(edt), 'left' if kind == 'min' else 'right'))
+        frames = []
+        for code in codes:
+            i = int(code[:6])
+            if i >= self.n_codes:
+                continue
+            t = self._trading(i, lo, hi)
+            if not len(t):
+                continue
+            if kind == 'adj':
+                num = 1 + np.floor(t / 500 + _noise(i, np.zeros(1), 5)) * 0.1
+                frames.append(pd.DataFrame({'ts_code': code, 'trade_date': self.days[t].astype(str),
+                                            'adj_factor': np.round(num, 3)}))
+                continue
+            base = 5 + i % 97
+            close = base * (1 + 0.3 * np.sin(t / 40 + i) + 0.02 * _noise(i, t))
+            if kind == 'day':
+                frames.append(self._bars(code, 'trade_date', self.days[t].astype(str), close, i, t, 100))
+                continue
+            # 分钟线：每个交易日240根，在日线收盘价附近波动
+            tm = (t[:, None] * 240 + np.arange(240)[None, :]).ravel()
+            close_m = np.repeat(close, 240) * (1 + 0.005 * np.sin(tm / 7) + 0.002 * _noise(i, tm, 6))
+            dates = (self.dates[t].astype('datetime64[ns]')[:, None] + _MIN_OFFSETS[None, :]).ravel()
+            frames.append(self._bars(code, 'trade_time', pd.DatetimeIndex(dates).strftime("%Y-%m-%d %H:%M:%S"),
+                                     close_m, i, tm, 1))
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True).iloc[::-1].reset_index(drop=True)
+
+    @staticmethod
+    def _bars(code: str, time_field: str, dates, close: np.ndarray, i: int, t: np.ndarray, lot: int) -> pd.DataFrame:
+        """
+        由收盘价生成OHLC及成交量，日线 vol 单位为手、amount 单位为千元，分钟线 vol 单位为股、amount 单位为元
+        """
+        close = np.round(close, 2)
+        open_ = np.round(close * (1 + 0.01 * (_noise(i, t, 7) - 0.5)), 2)
+        vol = np.round(1e3 + _noise(i, t, 8) * 1e5)
+        return pd.DataFrame({
+            'ts_code': code, time_field: dates, 'open': open_,
+            'high': np.round(np.maximum(open_, close) * 1.01, 2), 'low': np.round(np.minimum(open_, close) * 0.99, 2),
+            'close': close, 'vol': vol, 'amount': np.round(close * vol * lot / (1000 if lot == 100 else 1), 3),
+        })
+
+    def suspended(self, ts_code: str | None, sdt: str, edt: str) -> pd.DataFrame:
+        """
+        [sdt, edt] 内的停牌记录，参照TS suspend_d
+        """
+        lo = int(np.searchsorted(self.days, int(sdt), 'left'))
+        hi = int(np.searchsorted(self.days, int(edt), 'right'))
+        idx = [int(ts_code[:6])] if ts_code else range(self.n_codes)
+        rows = []
+        for i in idx:
+            s, e = self.suspend[i] if i < self.n_codes else (-1, -1)
+            for t in range(max(s, lo), min(e, hi)):
+                rows.append((self.code(i), str(self.days[t]), 'S'))
+        return pd.DataFrame(rows, columns=['ts_code', 'trade_date', 'suspend_type'])
+
+    def _to_clickhouse(self, db_tab, dataf):
+        if not self.dry_run:
+            # 股票列表等写入 quant 库的数据同样改为写入模拟库
+            return super()._to_clickhouse(db_tab.replace("quant.", f"{self.db}.", 1), dataf)
+        with self.lock:
+            self.counter['written'] += len(dataf)
+        return 1
+
+    def sel_progress(self) -> pd.DataFrame:
+        if self.dry_run:
+            return pd.DataFrame(columns=['code', 'sdt', 'edt', 'num'])
+        return super().sel_progress()
+
+    def sel_holes(self) -> pd.DataFrame:
+        if self.dry_run:
+            return pd.DataFrame(columns=['code', 'sdt', 'edt'])
+        return super().sel_holes()
+
+    def report(self) -> dict:
+        with self.lock:
+            c = dict(self.counter)
+        log.info(f"模拟数据源：调用{c['calls']}次，出错{c['errors']}次，空结果{c['empty']}次，超出配额{c['quota']}次，"
+                 f"生成{c['rows']}行，写入{c['written']}行")
+        return c
+
+
+if __name__ == '__main__':
+    from db.kline import KlineBase
+
+    # 压测：比较不同线程数下的每秒任务数，dry_run 不访问数据库
+    for n in (4, 8, 16):
+        ds = SimulatedSource(n_codes=500, thread_num=n, latency_mean=0.05, error_rate=0.01)
+        kd = KlineBase(ds=ds, cal=ds.trade_cal(), pipeline=False)
+        ds.dtype = DAY
+        kd.load_cache()
+        kd.cache.reset({})
+        kd.over_map = kd.cache.data
+        down_list = kd.pre(ds.symbols())
+        t1 = time.time()
+        kd.download(down_list)
+        cost = time.time() - t1
+        ds.report()
+        print(f"{n=}: {len(down_list)}个任务，耗时{cost:.1f}秒，{len(down_list) / cost:.1f}个任务/秒")
@@ -7,22 +7,61 @@ Tushare数据源的实现类
 """
 import time
 from dataclasses import dataclass
-from datetime import datetime
 
 import numpy as np
 import pandas as pd
 import tushare as ts
 
 from conf.constants import *
-from db.source.base import ADJ, DAY, DataSource, MIN
-from libs.dtTools import delta_datetime, now_str, str2datetime, timetag2datetime
+from db import dedup
+from db.adjust import adjust_sql
+from db.bars import BARS, query_sql
+from db.source.base import ADJ, ByDate, DAY, DataSource, FQ, MIN, NONE
+from libs import metrics, trace
+from libs.dtTools import now_str
+from libs.limiter import RateLimiter
+
+"""
+TS各接口每分钟默认调用次数，可在.env中用 ts_limit_{接口名} 覆盖，如：ts_limit_pro_bar=500
+"""
+TS_LIMITS = {
+    'pro_bar': 500,
+    'daily': 500,
+    'adj_factor': 500,
+    'suspend_d': 200,
+    'trade_cal': 100,
+}
+limiter = RateLimiter(prefix="ts_limit_", defaults=TS_LIMITS)
+
+"""
+TS日线及复权因子接口单次调用返回的最大行数，按交易日获取全市场数据达到该行数时可能被截断
+"""
+TS_ROW_LIMITS = {
+    'daily': 6000,
+    'adj_factor': 6000,
+}
+
+"""
+TS原始数据到入库格式的转换规则，日线 vol 单位为手，amount 单位为千元
+"""
+TS_SPECS = {
+    'day': {'rename': {'ts_code': 'code', 'trade_date': 'date', 'vol': 'volume'},
+            'time_format': '%Y%m%d', 'scale': {'volume': 100, 'amount': 1000}},
+    'min': {'rename': {'ts_code': 'code', 'trade_time': 'date', 'vol': 'volume'},
+            'time_format': '%Y-%m-%d %H:%M:%S'},
+    'adj': {'rename': {'ts_code': 'code', 'trade_date': 'date', 'adj_factor': 'num'},
+            'time_format': '%Y%m%d'},
+}
 
 
 @dataclass
 class TSSource(DataSource):
 
     def __post_init__(self):
-        self.thread_num = 4
+        self.thread_num = int(os.getenv("ts_thread_num", 4))
+        self.limiter = limiter
+        self.specs = TS_SPECS
+        self.by_date = True
 
         ts_token = os.getenv("ts_token")
         assert ts_token, "请在.env配置中设置 TS_TOKEN"
@@ -33,34 +72,67 @@ class TSSource(DataSource):
         self.source_date = ("19900101", "20090101")[self.dtype is MIN]
         self.limit = (5900, 7920)[self.dtype is MIN]
 
-    def _get_ts(self, symbol, sdt, edt):
+    def _pro_bar(self, **kwargs) -> pd.DataFrame:
+        """分钟线接口，pro_bar 为 tushare 模块函数，不在 self.pro 上"""
+        return ts.pro_bar(**kwargs)
+
+    def _get_ts(self, symbol, sdt, edt, by_date: bool = False):
+        """
+        :param by_date: bool 日线及复权因子按交易日 edt 获取全市场数据，忽略 symbol 及 sdt
+        """
         log.debug(f"开始访问ts接口:{symbol=},{sdt=},{edt=}")
+        kw = {'trade_date': edt} if by_date else {'ts_code': symbol, 'start_date': sdt, 'end_date': edt}
+        endpoint = ('pro_bar', 'daily', 'adj_factor')[[MIN, DAY, ADJ].index(self.dtype)]
         for n in range(1, 4):
             try:
-                if self.dtype in [MIN]:
-                    df = ts.pro_bar(ts_code=symbol, adj=self.fq.ts, freq=self.dtype.ts, start_date=sdt, end_date=edt)
-                elif self.dtype in [DAY]:
-                    df = self.pro.daily(ts_code=symbol, start_date=sdt, end_date=edt)
-                elif self.dtype in [ADJ]:
-                    df = self.pro.adj_factor(ts_code=symbol, start_date=sdt, end_date=edt)
-                time.sleep(60 / 1000 * self.thread_num)
+                with trace.span('rate_limit'):
+                    self.limiter.acquire(endpoint)
+                with metrics.vendor_seconds.time(endpoint), trace.span(f'vendor.{endpoint}'):
+                    if self.dtype in [MIN]:
+                        df = self._pro_bar(ts_code=symbol, adj=self.fq.ts, freq=self.dtype.ts, start_date=sdt,
+                                           end_date=edt)
+                    elif self.dtype in [DAY]:
+                        df = self.pro.daily(**kw)
+                    elif self.dtype in [ADJ]:
+                        df = self.pro.adj_factor(**kw)
             except Exception as e:
                 log.error(e)
                 log.error(f"获取{symbol}数据出错，稍后进行第{n}次重试...")
-                time.sleep(1)
+                metrics.vendor_errors.inc(endpoint)
+                metrics.vendor_retries.inc(endpoint) if n < 3 else None
+                with trace.span('retry_wait'):
+                    time.sleep(1)
             else:
                 return df
         log.error(f"获取{symbol=},{sdt=},{edt=}数据出错，重试3次失败！")
 
-    def update_hist(self, symbols: list[str], sdt: datetime, edt: datetime):
-
-        # print('当前函数名称:', inspect.stack())
+    @property
+    def db_tab(self) -> str:
+        return f"quant.ts_{self.dtype.sql}"
 
+    def fetch(self, symbols: list[str], sdt: str, edt: str) -> list[pd.DataFrame]:
+        """
+        从TS获取原始数据，日线及复权因子每次最多2000支股票，分钟线逐支获取；
+        规划器生成的按交易日任务（symbols 为 ByDate）一次获取当日全市场数据后筛选
+        :param symbols: list 股票代码
+        :param sdt: str 开始时间
+        :param edt: str 结束时间
+        :return: list 原始数据
+        """
         log.info(f"正在获取{symbols}.{self.dtype.sql}数据，时间范围{sdt}~{edt}请稍后...")
         err_ls = []
-        df = pd.DataFrame()
-
-        if self.dtype is DAY:
+        frames = []
+
+        if self.dtype is not MIN and isinstance(symbols, ByDate):
+            df_ = self._get_ts(None, sdt, edt, by_date=True)
+            cap = TS_ROW_LIMITS[('daily', 'adj_factor')[self.dtype is ADJ]]
+            # 全市场为空（数据尚未更新）或达到接口单次行数上限（可能被截断）时，按股票重新获取
+            if isinstance(df_, pd.DataFrame) and 0 < len(df_) < cap:
+                df_ = df_[df_['ts_code'].isin(symbols)]
+                return [df_] if not df_.empty else []
+            log.warning(f"按交易日获取{edt}.{self.dtype.sql}数据失败或可能不完整，改为按股票获取")
+
+        if self.dtype is not MIN:
             n = 2000
             for s in [symbols[i:i + n] for i in range(0, len(symbols), n)]:
                 str_symbols = ','.join(s)
@@ -68,66 +140,22 @@ class TSSource(DataSource):
                 if not isinstance(df_, pd.DataFrame) or df_.empty:
                     err_ls.append((symbols, sdt, edt))
                     continue
-                df = pd.concat([df, df_], ignore_index=True)
+                frames.append(df_)
         else:
             for symbol in symbols:
                 df_ = self._get_ts(symbol, sdt, edt)
                 if not isinstance(df_, pd.DataFrame) or df_.empty:
-                    tp = self.pro.suspend_d(suspend_type='S', start_date=sdt, end_date=edt, ts_code=symbol)
+                    self.limiter.acquire('suspend_d')
+                    with trace.span('vendor.suspend_d'):
+                        tp = self.pro.suspend_d(suspend_type='S', start_date=sdt, end_date=edt, ts_code=symbol)
                     if tp.empty:
                         err_ls.append(([symbol], sdt, edt))
                     continue
-                df = pd.concat([df, df_], ignore_index=True)
-
-        if df.empty:
-            log.warning(f"未找到数据,可能是停牌{symbols, sdt, edt}")
-            return edt
+                frames.append(df_)
 
         if err_ls:
             log.warning(f"部分数据未找到，请关注：{err_ls}")
-
-        time_field = ("trade_date", "trade_time")[self.dtype is MIN]
-        df = df[['ts_code', time_field, 'open', 'high', 'low', 'close', 'vol', 'amount']]
-        df.rename(columns={time_field: "date", "ts_code": "code", "vol": "volume"}, inplace=True)
-
-        if self.dtype is MIN:
-            df['date'] = df['date'].apply(str2datetime, _format="%Y-%m-%d %H:%M:%S")
-        else:
-            df['date'] = pd.to_datetime(df['date'])
-            df['volume'] = df['volume'] * 100
-            df['amount'] = df['amount'] * 1000
-
-        # 删掉全为空值的行
-        df.dropna(axis=0, how='all')
-        # 自动处理amount空值
-        df['amount'] = df['amount'].fillna(df['close'] * df['volume'])
-
-        if not df.shape[0]:
-            sql = f"SELECT * FROM quant.ts_{self.dtype.sql} Final where code='{symbols}' " \
-                  f"AND	`date` BETWEEN toDateTime('{sdt}') and toDateTime('{edt}')"
-            log.warning(f"{symbols}未从TS找到数据，请确认。\n{sql}\n")
-            return 0
-
-        log.info(f"{symbols}.{self.dtype.sql}.{sdt}~{edt}获取到{df.shape[0]}条数据")
-
-        # df["date"] = df["date"].dt.tz_localize('Asia/Shanghai')
-        df.sort_values(by=["code", "date"], inplace=True, ascending=False)
-        max_tag = timetag2datetime(df.max().date.value).strftime(dt_format)
-        min_tag = timetag2datetime(df.min().date.value).strftime(dt_format)
-
-        # 此处代码主要用于判断数据是否有误，如QMT当时的错误脏数据。
-        if max_tag > edt or min_tag < sdt:
-            df.to_csv(f"zang_{symbols}_{self.dtype.sql}.csv", index=False)
-            log.error(
-                f"查询结果出错，{edt=}-{sdt=},{min_tag=}-{max_tag=}")
-            return 0
-
-        db_tab = f"quant.ts_{self.dtype.sql}"
-        if super()._to_clickhouse(db_tab, df):
-            if self.dtype is MIN:
-                return delta_datetime(strdt=max_tag, _format=dt_format, days=1)
-            return max_tag
-        return 0
+        return frames
 
     def update_symbols_info(self):
         """
@@ -136,6 +164,7 @@ class TSSource(DataSource):
         """
         df = self.pro.stock_basic(exchange='', list_status='L', fields='ts_code,name,list_date,delist_date')
         df1 = self.pro.stock_basic(exchange='', list_status='D', fields='ts_code,name,list_date,delist_date')
+        self.limiter.acquire('suspend_d')
         tp = self.pro.suspend_d(suspend_type='S', trade_date=now_str("%Y%m%d"))
         tp_code = np.array(tp.ts_code).tolist()
         assert not df.empty, "update_symbols_info 时未获取到数据"
@@ -148,51 +177,101 @@ class TSSource(DataSource):
         db_tab = "quant.codes"
         return super()._to_clickhouse(db_tab, df)
 
-    def update_adjust(self, symbols: list[str], sdt: datetime, edt: datetime):
-
-        err_ls = []
-        df = pd.DataFrame()
-        n = 2000
-        for s in [symbols[i:i + n] for i in range(0, len(symbols), n)]:
-            str_symbols = ','.join(s)
-            df_ = self._get_ts(str_symbols, sdt, edt)
-            if not isinstance(df_, pd.DataFrame) or df_.empty:
-                err_ls.append((symbols, sdt, edt))
-                continue
-            df = pd.concat([df, df_], ignore_index=True)
-
-        if df.empty:
-            log.warning(f"未找到数据,可能是停牌{symbols, sdt, edt}")
-            return edt
-
-        if err_ls:
-            log.warning(f"部分数据未找到，请关注：{err_ls}")
-
-        log.info(f"{symbols}.{self.dtype.sql}.{sdt}~{edt}获取到{df.shape[0]}条数据")
-
-        df.rename(columns={"trade_date": "date", "ts_code": "code", "adj_factor": "num"}, inplace=True)
-        df['date'] = pd.to_datetime(df['date'])
-
-        df.sort_values(by=["code", "date"], inplace=True, ascending=False)
-        max_tag = timetag2datetime(df.max().date.value).strftime(dt_format)
-        min_tag = timetag2datetime(df.min().date.value).strftime(dt_format)
-
-        # 此处代码主要用于判断数据是否有误，如QMT当时的错误脏数据。
-        if max_tag > edt or min_tag < sdt:
-            df.to_csv(f"脏_{symbols}_{self.dtype.sql}.csv", index=False)
-            log.error(
-                f"查询结果出错，{edt=}-{sdt=},{min_tag=}-{max_tag=}")
-            return 0
+    def get_trade_cal(self, sdt: str, edt: str) -> list[str]:
+        """
+        获取上交所交易日历，沪深交易所交易日相同
+        :return: list 交易日 ['19901219', '19901220', ...]
+        """
+        self.limiter.acquire('trade_cal')
+        df = self.pro.trade_cal(exchange='SSE', start_date=sdt, end_date=edt, is_open='1')
+        return sorted(df['cal_date'].tolist())
 
+    def _kline_sql(self, symbols: list[str] | None, sdt: str, edt: str, columns: list[str] = None,
+                   price: str = None, freq: str = None, fq: FQ = None, after: tuple[str, str] = None) -> str:
+        """
+        拼接K线查询，参数参照 sel_kline_for_symbols，结果按 code,date 排序
+        :param symbols: list 股票代码，None 表示全部股票
+        :param after: tuple (code, date) 只查询排在该位置之后的数据，date 为数据库可识别的日期字符串
+        :return: str 查询语句
+        """
         db_tab = f"quant.ts_{self.dtype.sql}"
-        if super()._to_clickhouse(db_tab, df):
-            return max_tag
-        return 0
-
-    def sel_kline_for_symbol(self, symbol: str, sdt: str, edt: str):
+        final, settings = dedup.final_clause(db_tab, symbols, sdt, edt) if not freq else ('', '')
         sdt = sdt[:4] + '-' + sdt[4:6] + '-' + sdt[6:]
         edt = edt[:4] + '-' + edt[4:6] + '-' + edt[6:]
+        where = f"date BETWEEN '{sdt}' AND '{edt}'"
+        if symbols:
+            where = f"code IN ({','.join(repr(s) for s in symbols)}) AND {where}"
+        if after:
+            # 按 code,date 排序时位于 after 之后的行
+            where += f" AND (code > '{after[0]}' OR (code = '{after[0]}' AND date > '{after[1]}'))"
+        fq = fq or self.fq
+        kind = BARS[freq].src.split('_')[-1] if freq else self.dtype.sql
+        if fq is not NONE and kind != 'adj':
+            assert symbols, "复权查询需要指定股票代码"
+            assert freq not in ('W', 'M'), "周线、月线内可能发生除权，不支持复权查询"
+            raw = query_sql(BARS[freq], '*', where) if freq else f"SELECT * FROM {db_tab} {final} WHERE {where}"
+            sql = adjust_sql(raw, kind, fq, symbols, columns, price) + settings
+        elif freq:
+            fields = self._select_fields(columns, price, kind)
+            sql = query_sql(BARS[freq], fields, where)
+        else:
+            fields = self._select_fields(columns, price)
+            sql = f"SELECT {fields} FROM {db_tab} {final} WHERE {where} ORDER BY code, date{settings}"
+        return sql
+
+    def sel_kline_for_symbol(self, symbol: str, sdt: str, edt: str, columns: list[str] = None,
+                             price: str = None, fmt: str = 'df', freq: str = None, fq: FQ = None):
+        """
+        单支股票查询
+        :param symbol: str 股票代码
+        :param sdt: str 开始时间 "19900101"
+        :param edt: str 结束时间
+        :param columns: list 需要查询的字段，默认全部字段
+        :param price: str 价格类型，None: 原始Decimal，float: float64，int: 放大100倍的int64
+        :param fmt: str 返回格式，df/np/arrow
+        :param freq: str 周期，None: 当前数据类型，5min/15min/30min/60min/W/M: 读取服务端聚合表
+        :param fq: FQ 复权方式，默认 self.fq，PRE/POST 时关联 quant.ts_adj 在服务端复权，参照 db.adjust
+        :return: 按 fmt 返回对应的结果
+        """
+        if freq or (fq or self.fq) is not NONE:
+            return self.sel_kline_for_symbols([symbol], sdt, edt, columns, price, fmt, freq, fq)
         db_tab = f"quant.ts_{self.dtype.sql}"
-        sql = f"SELECT * FROM {db_tab} final WHERE code='{symbol}' AND date BETWEEN '{sdt}' AND '{edt}'"
-        df = super()._query_clickhouse(sql)
+        final, settings = dedup.final_clause(db_tab, [symbol], sdt, edt)
+        sdt = sdt[:4] + '-' + sdt[4:6] + '-' + sdt[6:]
+        edt = edt[:4] + '-' + edt[4:6] + '-' + edt[6:]
+        fields = self._select_fields(columns, price)
+        sql = f"SELECT {fields} FROM {db_tab} {final} WHERE code='{symbol}' AND date BETWEEN '{sdt}' AND '{edt}'" \
+              f"{settings}"
+        df = super()._query_clickhouse(sql, fmt)
+        return df
+
+    def sel_kline_for_symbols(self, symbols: list[str], sdt: str, edt: str, columns: list[str] = None,
+                              price: str = None, fmt: str = 'df', freq: str = None, fq: FQ = None):
+        """
+        多支股票一次查询，结果按 code,date 排序
+        :param symbols: list 股票代码 ['600001.SH', '000001.SZ', ...]
+        :param sdt: str 开始时间 "19900101"
+        :param edt: str 结束时间
+        :param columns: list 需要查询的字段，默认全部字段，按code分组时必须包含code
+        :param price: str 价格类型，None: 原始Decimal，float: float64，int: 放大100倍的int64
+        :param fmt: str 返回格式，df/np/arrow
+        :param freq: str 周期，None: 当前数据类型，5min/15min/30min/60min/W/M: 读取服务端聚合表
+        :param fq: FQ 复权方式，默认 self.fq，PRE/POST 时关联 quant.ts_adj 在服务端复权，参照 db.adjust
+        :return: 按 fmt 返回对应的结果
+        """
+        sql = self._kline_sql(symbols, sdt, edt, columns, price, freq, fq)
+        df = super()._query_clickhouse(sql, fmt)
         return df
+
+    def sel_kline_stream(self, symbols: list[str] | None, sdt: str, edt: str, columns: list[str] = None,
+                         price: str = None, fmt: str = 'df', freq: str = None, fq: FQ = None,
+                         chunk_rows: int = 65536, after: tuple[str, str] = None):
+        """
+        流式查询，按 code,date 顺序逐块返回，参数参照 sel_kline_for_symbols
+        :param symbols: list 股票代码，None 表示全部股票
+        :param chunk_rows: int 每块的最大行数（服务端 max_block_size）
+        :param after: tuple (code, date) 从该位置之后继续读取
+        :return: generator 按 fmt 返回每块的结果
+        """
+        sql = self._kline_sql(symbols, sdt, edt, columns, price, freq, fq, after)
+        return super()._stream_clickhouse(sql, fmt, {'max_block_size': chunk_rows})
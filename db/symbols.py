@@ -11,6 +11,7 @@ import numpy as np
 import pandas as pd
 
 from conf.constants import *
+from db import dedup
 from db.source.base import DataSource
 from db.source.ts import TSSource
 from libs.cache import Cache
@@ -31,6 +32,7 @@ class Symbols:
         :return: list 更新后的信息
         """
         if self.ds.update_symbols_info():
+            dedup.optimize("quant.codes")
             self.cache.remove()
             log.success(f"从数据源{self.ds}更新symbols已完成,已删除本地缓存。")
         return self.infos
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/9/26/026 21:05
+# @Author : 不归
+# @FileName: trade_cal.py
+"""
+交易日历：从数据源获取一次后，保存到本地缓存及 quant.trade_cal 表，用于按交易日计算下载缺口及分页。
+"""
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from conf.constants import *
+from db.source.base import DataSource
+from libs.cache import Cache
+from libs.dtTools import now_str
+
+CAL_SDT = "19901219"  # 沪市第一个交易日
+CREATE_SQL = "CREATE TABLE IF NOT EXISTS quant.trade_cal (`date` Date) ENGINE = ReplacingMergeTree ORDER BY date"
+
+
+@dataclass
+class TradeCal:
+    """
+    交易日历，days 为升序的 int64 数组，如：[19901219, 19901220, ...]
+    加载顺序：本地缓存 -> 数据库 -> 数据源，缓存最后一天早于今天时视为过期；都获取不到时按工作日计算。
+    """
+    ds: DataSource = None
+    days: np.ndarray = None
+    cache = Cache("trade_cal")
+
+    def load(self):
+        today = now_str(dt_format)
+        days = self.cache.get()
+        if not days or days[-1] < today:
+            days = self._from_db(today) or self._from_source(today)
+
+        if days:
+            self.days = np.array(days, dtype=np.int64)
+        else:
+            log.warning("未获取到交易日历，按工作日计算交易日。")
+            dts = np.arange(np.datetime64(f"{CAL_SDT[:4]}-01-01"), np.datetime64(f"{today[:4]}-12-31"))
+            dts = dts[np.is_busday(dts)]
+            self.days = pd.DatetimeIndex(dts).strftime(dt_format).astype(np.int64).to_numpy()
+        return self
+
+    def _from_db(self, today: str) -> list:
+        sql = "SELECT formatDateTime(date, '%Y%m%d') AS date FROM quant.trade_cal FINAL ORDER BY date"
+        try:
+            days = DataSource._query_clickhouse(sql)['date'].tolist()
+        except Exception as e:
+            log.warning(f"从数据库读取交易日历失败：{e}")
+            return []
+        if not days or days[-1] < today:
+            return []
+        self.cache.set(days)
+        return days
+
+    def _from_source(self, today: str) -> list:
+        if not self.ds:
+            return []
+        try:
+            days = self.ds.get_trade_cal(CAL_SDT, f"{today[:4]}1231")
+        except NotImplementedError:
+            return []
+        if not days:
+            return []
+        self.cache.set(days)
+        DataSource._command_clickhouse(CREATE_SQL)
+        self.ds._to_clickhouse("quant.trade_cal", pd.DataFrame({'date': pd.to_datetime(days)}))
+        log.success(f"已从数据源{self.ds}更新交易日历，共{len(days)}个交易日。")
+        return days
+
+    def count(self, sdt: str, edt: str) -> int:
+        """
+        [sdt, edt] 之间的交易日数量，包含首尾
+        """
+        return int(np.searchsorted(self.days, int(edt), 'right') - np.searchsorted(self.days, int(sdt), 'left'))
+
+    def last(self, dt: str) -> str:
+        """
+        小于等于 dt 的最后一个交易日
+        """
+        i = np.searchsorted(self.days, int(dt), 'right') - 1
+        return str(self.days[max(i, 0)])
+
+    def join(self, intervals: list) -> list:
+        """
+        合并之间没有交易日的相邻日期段，如按交易日下载的 [['20231009', '20231009'], ['20231010', '20231010']]
+        :param intervals: list 已合并排序的日期段，首尾日期均已完成（日线、复权因子）
+        :return: list 合并后的日期段
+        """
+        res = []
+        for s, e in intervals:
+            # 上一段结束日期之后的第一个交易日不早于 s，即两段之间没有交易日
+            if res and np.searchsorted(self.days, int(s)) <= np.searchsorted(self.days, int(res[-1][1]), 'right'):
+                res[-1][1] = max(res[-1][1], e)
+            else:
+                res.append([s, e])
+        return res
+
+    def offset(self, dt: str, n: int) -> str:
+        """
+        大于等于 dt 的第一个交易日之后第 n 个交易日，超出日历时返回日历最后一天
+        """
+        i = np.searchsorted(self.days, int(dt), 'left') + n
+        return str(self.days[min(i, len(self.days) - 1)])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/9/20/020 21:15
+# @Author : 不归
+# @FileName: writer.py
+"""
+批量写入器：下载线程只负责获取数据并放入队列，独立的写入线程把多支股票的小批数据合并成大批次写入clickhouse，
+减少小分区（parts）数量，下载线程无需等待入库。
+"""
+import threading
+import time
+from dataclasses import dataclass
+from queue import Empty, Queue
+from typing import Callable
+
+import pandas as pd
+
+from conf.constants import *
+from db.source.base import DataSource
+from libs import trace
+
+WRITER_NUM = 2  # 写入线程数量
+MAX_ROWS = 500000  # 单次写入的最大行数，达到后立即写入
+MAX_WAIT = 5  # 单次写入的最大等待秒数，达到后立即写入
+MAX_BYTES = 512 * 1024 * 1024  # 队列中等待写入数据的内存上限，超过后下载线程阻塞等待
+
+_STOP = object()
+
+
+@dataclass
+class WriteTask:
+    db_tab: str
+    df: pd.DataFrame
+    nbytes: int
+    callback: Callable[[bool], None] = None
+
+
+class BatchWriter:
+    """
+    有界内存的批量写入器，用法：
+        writer = BatchWriter(ds).start()
+        writer.put("quant.ts_day", df, callback=lambda ok: ...)
+        writer.close()
+    callback 在数据写入成功（ok=True）或失败（ok=False）后才会被调用，用于记录下载进度。
+    """
+
+    def __init__(self, ds: DataSource, writer_num: int = WRITER_NUM, max_rows: int = MAX_ROWS,
+                 max_wait: float = MAX_WAIT, max_bytes: int = MAX_BYTES):
+        self.ds = ds
+        self.writer_num = writer_num
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.max_bytes = max_bytes
+        self.q = Queue()
+        self.pending = 0  # 已放入队列但未写入完成的字节数
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.writer_num):
+            t = threading.Thread(target=self._run, name=f"writer-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+        log.info(f"批量写入已启动：{self.writer_num=}, {self.max_rows=}, {self.max_wait=}, {self.max_bytes=}")
+        return self
+
+    def put(self, db_tab: str, df: pd.DataFrame, callback: Callable[[bool], None] = None):
+        """
+        放入待写入数据，队列内存超过 max_bytes 时阻塞，单个数据超过上限时等待队列清空后放入
+        :param db_tab: str 表名
+        :param df: pd.DataFrame 已整理为入库格式的数据
+        :param callback: 写入结束后的回调，参数为是否写入成功
+        """
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending == 0 or self.pending + nbytes <= self.max_bytes)
+            self.pending += nbytes
+        self.q.put(WriteTask(db_tab, df, nbytes, callback))
+
+    def close(self):
+        """写入剩余数据并等待所有写入线程结束"""
+        for _ in self.threads:
+            self.q.put(_STOP)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        log.info("批量写入已结束。")
+
+    def _run(self):
+        buf: dict[str, list[WriteTask]] = {}
+        rows: dict[str, int] = {}
+        first: dict[str, float] = {}
+
+        while True:
+            try:
+                task = self.q.get(timeout=0.5)
+            except Empty:
+                task = None
+
+            if task is _STOP:
+                for tab in list(buf):
+                    self._flush(tab, buf.pop(tab))
+                return
+
+            if task:
+                if task.db_tab not in buf:
+                    buf[task.db_tab], rows[task.db_tab], first[task.db_tab] = [], 0, time.time()
+                buf[task.db_tab].append(task)
+                rows[task.db_tab] += len(task.df)
+
+            now = time.time()
+            for tab in list(buf):
+                if rows[tab] >= self.max_rows or now - first[tab] >= self.max_wait:
+                    self._flush(tab, buf.pop(tab))
+
+    def _flush(self, db_tab: str, tasks: list[WriteTask]):
+        ok = False
+        try:
+            df = pd.concat([t.df for t in tasks], ignore_index=True)
+            # 合并写入不属于单个下载任务，作为单独的任务追踪
+            with trace.task(f"批量写入{db_tab}({len(tasks)}批)"):
+                ok = bool(self.ds._to_clickhouse(db_tab, df))
+            log.debug(f"批量写入{db_tab}：合并{len(tasks)}批，共{len(df)}条，{ok=}")
+        except BaseException as e:
+            # 包括 SystemExit，写入线程不能退出，否则回调不执行、内存不释放，下载线程将一直阻塞
+            log.exception(f"批量写入{db_tab}出错，{len(tasks)}批数据加入错误列表：{e!r}")
+        finally:
+            for t in tasks:
+                if t.callback:
+                    try:
+                        t.callback(ok)
+                    except Exception as e:
+                        log.error(f"写入回调出错：{e}")
+
+            with self.cond:
+                self.pending -= sum(t.nbytes for t in tasks)
+                self.cond.notify_all()
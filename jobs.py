@@ -8,29 +8,39 @@ from czsc import fsa
 from pyinstrument import Profiler
 
 from conf.constants import *
-from db.kline import KlineBase, load_errs_cache
+from db.kline import DownloadStopped, KlineBase, load_errs_cache
 from db.source.ts import TSSource
 from db.symbols import Symbols
+from libs.metrics import registry
 from libs.tools import get_err_cache_names
 
 
 def update_kline_job(**kwargs):
-    err_ls = get_err_cache_names()
-    for e in err_ls:
-        load_errs_cache(e)
+    # 配置 metrics_port 时可在任务运行期间访问 http://127.0.0.1:{port}/metrics
+    registry.serve()
+    try:
+        err_ls = get_err_cache_names()
+        for e in err_ls:
+            load_errs_cache(e)
 
-    ds = TSSource()
-    kd = KlineBase(ds=ds)
-    symbols = Symbols(ds=ds).update()
-    kd.download_day(symbols=symbols)
-    kd.download_adj(symbols=symbols)
-    kd.download_min(symbols=symbols)
+        ds = TSSource()
+        kd = KlineBase(ds=ds)
+        symbols = Symbols(ds=ds).update()
+        kd.download_day(symbols=symbols)
+        kd.download_adj(symbols=symbols)
+        kd.download_min(symbols=symbols)
+    except DownloadStopped as e:
+        # 手动终止后不再下载其余数据类型，也不推送完成消息
+        log.error(f"更新数据任务已终止：{e}")
+        registry.dump()
+        return
+    metrics_file = registry.dump()
 
     if kwargs.get('feishu_app_id') and kwargs.get('feishu_app_secret'):
         fsa.push_message(f"更新数据任务完成：{KlineBase}！", **kwargs)
         files = ["error", "warning"]
         file_ls = [BASE_PATH / f'logs/{x}_{datetime.now():%Y-%m-%d}.log'
-                   for x in files]
+                   for x in files] + [metrics_file]
         for path in file_ls:
             if path.stat().st_size:
                 fsa.push_message(path, msg_type='file', **kwargs)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/9/24/024 10:20
+# @Author : 不归
+# @FileName: journal.py
+"""
+下载进度日志：每完成一个任务只追加一行记录，达到一定行数后在后台线程压缩为快照。
+- 快照：%userprofile%/.czsc/{name}.json，格式 {'code': [['sdt', 'edt'], ...], ...}，兼容旧格式 [{'code': ['sdt', 'edt']}, n]
+- 日志：%userprofile%/.czsc/{name}.journal，每行一条 [['code', ...], 'sdt', 'edt']
+每支股票保存已完成的日期段列表，中断后可以准确续传中间缺失的部分。
+同一路径只应有一个 Journal 追加写入，使用 get_journal 获取；下载结束后 close，进程退出时自动关闭未关闭的日志。
+"""
+import atexit
+import os
+import threading
+
+from orjson import orjson
+
+from conf.constants import *
+from libs.cache import Cache
+from libs.tools import merge_interval
+
+COMPACT_SIZE = 5000  # 日志达到该行数后自动压缩
+
+
+class Journal:
+    def __init__(self, name: str, compact_size: int = COMPACT_SIZE):
+        self.snap = Cache(name)
+        self.path = self.snap.path.with_suffix('.journal')
+        self.old_path = self.snap.path.with_suffix('.journal.1')
+        self.compact_size = compact_size
+        self.data: dict[str, list] = {}
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()  # 同一时间只允许一个压缩任务
+        self.compacting: threading.Thread | None = None
+        self._load()
+        self.f = open(self.path, 'ab')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load(self):
+        snap = self.snap.get()
+        if isinstance(snap, list) and len(snap) == 2 and isinstance(snap[0], dict):
+            # 旧格式：[{'code': ['sdt', 'edt']}, n]
+            snap = {k: [list(v)] for k, v in snap[0].items()}
+        self.data = snap or {}
+
+        # 先回放压缩中断时遗留的旧日志，再回放当前日志，重复回放结果不变
+        for path in (self.old_path, self.path):
+            if not path.exists():
+                continue
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        codes, sdt, edt = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        log.warning(f"进度日志存在不完整记录，已跳过：{path}")
+                        continue
+                    self._merge(codes, sdt, edt)
+                    self.lines += 1
+
+    def _merge(self, codes: list, sdt: str, edt: str):
+        for code in codes:
+            self.data[code] = merge_interval(self.data.get(code, []), sdt, edt)
+
+    def get(self, code: str, default=None) -> list:
+        """
+        :param code: str 股票代码
+        :return: list 已完成的日期段 [['sdt', 'edt'], ...]
+        """
+        return self.data.get(code, default)
+
+    def add(self, codes: list, sdt: str, edt: str):
+        """
+        记录已完成的日期段
+        :param codes: list 股票代码
+        :param sdt: str 开始日期
+        :param edt: str 已完成的最大日期
+        """
+        with self.lock:
+            self._merge(codes, sdt, edt)
+            if self.f is None:
+                # close 之后继续记录时重新打开
+                self.f = open(self.path, 'ab')
+            self.f.write(orjson.dumps([codes, sdt, edt]) + b'\n')
+            self.f.flush()
+            self.lines += 1
+            if self.lines >= self.compact_size and not self.compacting:
+                self.compacting = threading.Thread(target=self.compact, daemon=True)
+                self.compacting.start()
+
+    def reset(self, data: dict):
+        """
+        用新的进度整体替换当前进度，并立即压缩
+        :param data: dict {'code': [['sdt', 'edt'], ...], ...}
+        """
+        with self.lock:
+            self.data = data
+        self.compact()
+
+    def compact(self):
+        """
+        压缩日志：锁内切换日志文件并复制进度，锁外写入快照，写入完成后删除旧日志
+        """
+        with self.compact_lock:
+            with self.lock:
+                data = {k: [list(v) for v in vs] for k, vs in self.data.items()}
+                opened = self.f is not None
+                if opened:
+                    self.f.close()
+                os.replace(self.path, self.old_path)
+                self.f = open(self.path, 'ab') if opened else None
+                self.lines = 0
+
+            tmp = self.snap.path.with_suffix('.tmp')
+            with open(tmp, 'wb') as f:
+                f.write(orjson.dumps(data))
+            os.replace(tmp, self.snap.path)
+            Path.unlink(self.old_path)
+            self.compacting = None
+        log.debug(f"进度日志已压缩：{self.snap.path}，共{len(data)}条")
+
+    def close(self):
+        """
+        等待后台压缩结束并关闭日志文件，可重复调用；关闭后调用 add 会重新打开
+        """
+        compacting = self.compacting
+        if compacting:
+            compacting.join()
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+_journals: dict[Path, Journal] = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(name: str) -> Journal:
+    """
+    获取进度日志，同一路径返回同一个 Journal，避免多个文件句柄同时追加写入
+    :param name: str 日志名称，参照 Cache
+    """
+    path = Cache(name).path
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = Journal(name)
+        return _journals[path]
+
+
+@atexit.register
+def _close_all():
+    for journal in list(_journals.values()):
+        journal.close()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/9/22/022 20:40
+# @Author : 不归
+# @FileName: limiter.py
+"""
+令牌桶限流器，进程内所有线程共享，按接口分别限流，并统计因限流产生的等待时间
+"""
+import threading
+import time
+
+from conf.constants import *
+from libs import metrics
+
+
+class TokenBucket:
+    """
+    令牌桶，rate 为每秒生成的令牌数，capacity 为允许的突发调用数。
+    线程在锁内预约令牌，锁外等待，多个线程等待时按预约顺序依次放行。
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: int = 1) -> float:
+        """
+        获取令牌，不足时等待
+        :param n: int 需要的令牌数
+        :return: float 本次等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """
+    按接口名称管理令牌桶，每分钟调用次数优先从环境变量 {prefix}{接口名} 读取，例如：ts_limit_daily=500
+    """
+
+    def __init__(self, prefix: str = "", defaults: dict = None, default: int = 500):
+        self.prefix = prefix
+        self.defaults = defaults or {}
+        self.default = default
+        self.buckets: dict[str, TokenBucket] = {}
+        self.calls: dict[str, int] = {}
+        self.waits: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def per_minute(self, endpoint: str) -> int:
+        return int(os.getenv(f"{self.prefix}{endpoint}", self.defaults.get(endpoint, self.default)))
+
+    def _bucket(self, endpoint: str) -> TokenBucket:
+        with self.lock:
+            if endpoint not in self.buckets:
+                num = self.per_minute(endpoint)
+                # 突发量按每秒配额计算，避免整分钟的配额在开始时集中消耗；
+                # 桶初始是满的，生成速率扣除突发量，任意60秒内的调用次数不超过 num（突发量 + 60秒生成的令牌）
+                capacity = max(num / 60, 1)
+                self.buckets[endpoint] = TokenBucket(max(num - capacity, 1) / 60, capacity)
+                self.calls[endpoint], self.waits[endpoint] = 0, 0.0
+                log.debug(f"接口{endpoint}限流：{num}次/分钟")
+            return self.buckets[endpoint]
+
+    def acquire(self, endpoint: str) -> float:
+        """
+        调用接口前获取许可
+        :param endpoint: str 接口名称，如 daily、pro_bar
+        :return: float 本次等待的秒数
+        """
+        wait = self._bucket(endpoint).acquire()
+        metrics.rate_limit_wait.observe(wait, endpoint)
+        with self.lock:
+            self.calls[endpoint] += 1
+            self.waits[endpoint] += wait
+        return wait
+
+    def stats(self) -> dict:
+        """
+        :return: dict {'daily': {'calls': 100, 'wait': 1.5}, ...}
+        """
+        with self.lock:
+            return {k: {'calls': self.calls[k], 'wait': round(self.waits[k], 3)} for k in self.calls}
+
+    def report(self):
+        for k, v in self.stats().items():
+            log.info(f"接口{k}共调用{v['calls']}次，限流等待{v['wait']}秒")
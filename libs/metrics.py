@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/14/014 21:10
+# @Author : 不归
+# @FileName: metrics.py
+"""
+下载任务各阶段的计数器、直方图及仪表，进程内所有线程共享：
+- render 输出 Prometheus 文本格式，serve 在本地启动 HTTP /metrics 端口（环境变量 metrics_port，未配置时不启动）
+- summary 汇总为 dict，dump 在任务结束时写入 logs/metrics_{日期}.json，便于对比不同版本的吞吐量
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from orjson import orjson
+
+from conf.constants import *
+
+"""
+直方图默认分桶（秒），覆盖从连接池等待的毫秒级到分钟数据接口的数十秒
+"""
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: dict[tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: tuple) -> tuple:
+        assert len(labels) == len(self.labels), f"{self.name} 需要标签：{self.labels}"
+        return tuple(str(v) for v in labels)
+
+    def _label_str(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labels, key)] + ([extra] if extra else [])
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def summary(self) -> dict:
+        raise NotImplementedError
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """
+    只增不减的累计值，如调用次数、行数、字节数
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, n: float = 1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{self._label_str(k)} {v}" for k, v in self.values.items()]
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {",".join(k) or "all": round(v, 6) for k, v in self.values.items()}
+
+
+class Gauge(Counter):
+    """
+    可增可减的当前值，如剩余任务数
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, *labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, *labels, n: float = 1):
+        self.inc(*labels, n=-n)
+
+
+class Histogram(Metric):
+    """
+    耗时等分布，按 buckets 累计各区间的次数，另外记录总和、次数及最大值
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            h['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            h['sum'] += value
+            h['count'] += 1
+            h['max'] = max(h['max'], value)
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        记录代码块的耗时，出错时同样记录
+        """
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t1, *labels)
+
+    def _quantile(self, h: dict, q: float) -> float:
+        # 按分桶上限估计，不超过最大值
+        rank, acc = q * h['count'], 0
+        for i, c in enumerate(h['counts']):
+            acc += c
+            if acc >= rank:
+                return min(self.buckets[i], round(h['max'], 6)) if i < len(self.buckets) else round(h['max'], 6)
+        return h['max']
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for k, h in self.values.items():
+                acc = 0
+                for le, c in zip(self.buckets + ('+Inf',), h['counts']):
+                    acc += c
+                    le = f'le="{le}"'
+                    lines.append(f"{self.name}_bucket{self._label_str(k, le)} {acc}")
+                lines.append(f"{self.name}_sum{self._label_str(k)} {h['sum']}")
+                lines.append(f"{self.name}_count{self._label_str(k)} {h['count']}")
+        return lines
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {",".join(k) or "all": {'count': h['count'], 'sum': round(h['sum'], 6),
+                                           'mean': round(h['sum'] / h['count'], 6) if h['count'] else 0,
+                                           'p50': self._quantile(h, 0.5), 'p95': self._quantile(h, 0.95),
+                                           'max': round(h['max'], 6)}
+                    for k, h in self.values.items()}
+
+
+class Registry:
+    """
+    指标注册表，同名指标只创建一次
+    """
+
+    def __init__(self, prefix: str = "qds_"):
+        self.prefix = prefix
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _get(self, cls, name: str, doc: str, labels: tuple, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(self.prefix + name, doc, labels, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name: str, doc: str, labels: tuple = ()) -> Counter:
+        return self._get(Counter, name, doc, labels)
+
+    def gauge(self, name: str, doc: str, labels: tuple = ()) -> Gauge:
+        return self._get(Gauge, name, doc, labels)
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = BUCKETS) -> Histogram:
+        return self._get(Histogram, name, doc, labels, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        :return: str Prometheus 文本格式
+        """
+        lines = []
+        for m in list(self.metrics.values()):
+            lines += [f"# HELP {m.name} {m.doc}", f"# TYPE {m.name} {m.kind}", *m.samples()]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """
+        :return: dict {指标名: {标签: 值}}，如：
+                 {'vendor_seconds': {'daily': {'count': 10, 'sum': 1.2, ...}}, 'rows_fetched_total': {'day': 1000}}
+        """
+        return {name: s for name, m in list(self.metrics.items()) if (s := m.summary())}
+
+    def reset(self):
+        for m in list(self.metrics.values()):
+            m.reset()
+
+    def serve(self, port: int = None) -> ThreadingHTTPServer | None:
+        """
+        在后台线程启动 HTTP 服务，GET /metrics 返回 Prometheus 文本
+        :param port: int 端口，默认读取环境变量 metrics_port，未配置时不启动
+        """
+        port = port or int(os.getenv("metrics_port") or 0)
+        if not port or self.server:
+            return self.server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        log.info(f"指标服务已启动：http://127.0.0.1:{port}/metrics")
+        return self.server
+
+    def dump(self, path: Path = None) -> Path:
+        """
+        将汇总写入 JSON 文件
+        :param path: Path 文件路径，默认 logs/metrics_{日期}.json
+        """
+        path = Path(path or BASE_PATH / f"logs/metrics_{datetime.now():%Y-%m-%d}.json")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'metrics': self.summary()}
+        path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        log.info(f"指标汇总已写入：{path}")
+        return path
+
+
+registry = Registry()
+
+"""
+各阶段的指标，由对应模块记录
+"""
+vendor_seconds = registry.histogram("vendor_seconds", "数据源接口调用耗时（秒）", ('endpoint',))
+vendor_errors = registry.counter("vendor_errors_total", "数据源接口调用出错次数", ('endpoint',))
+vendor_retries = registry.counter("vendor_retries_total", "数据源接口重试次数", ('endpoint',))
+rate_limit_wait = registry.histogram("rate_limit_wait_seconds", "接口限流等待时间（秒）", ('endpoint',))
+rows_fetched = registry.counter("rows_fetched_total", "从数据源获取的原始行数", ('dtype',))
+transform_seconds = registry.histogram("transform_seconds", "整理为入库格式的耗时（秒）", ('dtype',))
+insert_seconds = registry.histogram("insert_seconds", "写入数据库的耗时（秒）", ('table', 'mode'))
+insert_rows = registry.counter("insert_rows_total", "写入数据库的行数", ('table',))
+insert_bytes = registry.counter("insert_bytes_total", "写入数据库的字节数（写入前的内存大小）", ('table',))
+query_seconds = registry.histogram("query_seconds", "查询数据库的耗时（秒）", ('fmt',))
+pool_wait = registry.histogram("pool_wait_seconds", "从连接池获取连接的等待时间（秒）")
+tasks_done = registry.counter("tasks_total", "已结束的下载任务数", ('dtype', 'result'))
+tasks_left = registry.gauge("tasks_left", "剩余的下载任务数", ('dtype',))
+
+if __name__ == '__main__':
+    serve_port = 9108
+    registry.serve(serve_port)
+    for i in range(100):
+        with vendor_seconds.time('daily'):
+            time.sleep(0.001 * (i % 7))
+        rows_fetched.inc('day', n=5000)
+    tasks_left.set(3, 'day')
+    print(registry.render())
+    print(registry.summary())
@@ -39,6 +39,46 @@ def diff_date(old_start, old_end, new_start, new_end):
         return [(new_start, old_start), (old_end, new_end)]
 
 
+def merge_interval(intervals: list, sdt: str, edt: str) -> list:
+    """
+    将新的日期段并入已有日期段，重叠或首尾相接的日期段合并为一段
+    :param intervals: list 已排序的日期段 [['19900101', '20000101'], ['20100101', '20230101'], ...]
+    :param sdt: str 8位字符串时间，"19900101"
+    :param edt: str 8位字符串时间，"19900101"
+    :return: list 合并后的日期段
+    """
+    res = []
+    for s, e in sorted([*intervals, [sdt, edt]]):
+        if res and s <= res[-1][1]:
+            res[-1][1] = max(res[-1][1], e)
+        else:
+            res.append([s, e])
+    return res
+
+
+def diff_intervals(intervals: list, sdt: str, edt: str) -> list:
+    """
+    计算[sdt, edt]中未被已有日期段覆盖的部分，包括日期段之间的空洞，与diff_date一致，相邻日期段共用边界日期
+    :param intervals: list 已合并排序的日期段 [['19900101', '20000101'], ['20100101', '20230101'], ...]
+    :param sdt: str 8位字符串时间，"19900101"
+    :param edt: str 8位字符串时间，"19900101"
+    :return: list [('20000101', '20100101'), ...]
+    """
+    res = []
+    cur = sdt
+    for s, e in intervals:
+        if e < cur:
+            continue
+        if s >= edt:
+            break
+        if s > cur:
+            res.append((cur, s))
+        cur = max(cur, e)
+    if cur < edt:
+        res.append((cur, edt))
+    return res
+
+
 def diff_date2(old_end, new_end):
     """
     根据2个日期计算去重部分，节约资源，以上方法的精简版，只保留结束日期。
@@ -53,18 +93,19 @@ def diff_date2(old_end, new_end):
         return [old_end, new_end]
 
 
-def paging(date_kind: tuple, dtype: Dtype, limit: int) -> int:
+def paging(date_kind: tuple, dtype: Dtype, limit: int, days: int = None) -> int:
     """
     - 模拟分页防止数据过大,等待时间过长，pg为计算出来的翻页数量
     - 根据日期差及周期，计算分页参数，向上取整
     :param date_kind:  格式（'19900101','20230415'）
     :param dtype: 用于数据类型判断，如：day,min,adj。 注意：对象的内容比较，用is方法
     :param limit: 数据源最大获取行数限制
+    :param days: 日期段内的交易日数量，为空时按自然日计算
     :return: int 最小为1，大于1，代表单次下载可以覆盖完整周期数据，否则需要分段
     """
 
     sdt, edt = date_kind
-    day = howdays(sdt, edt) + 1
+    day = max(days, 1) if days is not None else howdays(sdt, edt) + 1
     if dtype in [DAY, ADJ]:
         return math.ceil(limit / day)
     elif dtype is MIN:
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/15/015 20:50
+# @Author : 不归
+# @FileName: trace.py
+"""
+下载任务的耗时追踪，定位拖慢整体进度的单个任务：
+- tracer.task 标记一个下载任务，当前任务保存在 contextvars 中，同一线程内的 tracer.span 自动归属到该任务
+- 各阶段（限流等待、接口调用、整理、获取连接、入库等）记录开始时间及耗时，没有当前任务时 span 不做任何记录
+- report 输出最慢的N个任务及其各阶段耗时、各阶段累计耗时；只保留最慢的N个任务，内存占用与任务数无关
+- 配置 trace_dir 时保留全部阶段，export 导出为 Chrome Trace Event 格式，可用 chrome://tracing 或 Perfetto 打开
+"""
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from orjson import orjson
+
+from conf.constants import *
+
+TOP_N = 20  # 报告中列出的最慢任务数量
+
+
+@dataclass
+class TaskTrace:
+    name: str
+    start: float = field(default_factory=time.perf_counter)
+    total: float = 0.0
+    spans: list = field(default_factory=list)  # [(阶段, 开始时间, 耗时, 线程id), ...]
+
+    def phases(self) -> dict[str, float]:
+        res = {}
+        for phase, _, dur, _ in self.spans:
+            res[phase] = res.get(phase, 0.0) + dur
+        return res
+
+
+_current: ContextVar[TaskTrace | None] = ContextVar('trace_task', default=None)
+
+
+class Tracer:
+    """
+    :param top: int 保留的最慢任务数量
+    :param keep: bool 是否保留全部阶段用于导出，默认配置 trace_dir 时保留
+    """
+
+    def __init__(self, top: int = TOP_N, keep: bool = None):
+        self.top = top
+        self._keep = keep
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.keep = bool(os.getenv("trace_dir")) if self._keep is None else self._keep
+            self.t0 = time.perf_counter()
+            self.slowest: list[tuple] = []  # 小顶堆 [(总耗时, 序号, TaskTrace), ...]
+            self.phase_total: dict[str, list] = {}  # {阶段: [累计耗时, 次数]}
+            self.task_num, self.task_time = 0, 0.0
+            self.events: list[dict] = []
+
+    @contextmanager
+    def task(self, name):
+        """
+        追踪一个下载任务，结束（含出错）时汇总
+        :param name: 任务名称，如 (['000001.SZ'], '20230101', '20230201')
+        """
+        tt = TaskTrace(str(name))
+        token = _current.set(tt)
+        try:
+            yield tt
+        finally:
+            _current.reset(token)
+            tt.total = time.perf_counter() - tt.start
+            self._finish(tt)
+
+    @contextmanager
+    def span(self, phase: str):
+        """
+        记录当前任务中一个阶段的耗时
+        :param phase: str 阶段名称，如 vendor.daily、transform、insert
+        """
+        tt = _current.get()
+        if tt is None:
+            yield
+            return
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            tt.spans.append((phase, t1, time.perf_counter() - t1, threading.get_ident()))
+
+    def _finish(self, tt: TaskTrace):
+        phases = tt.phases()
+        with self.lock:
+            self.task_num += 1
+            self.task_time += tt.total
+            for phase, dur in phases.items():
+                s = self.phase_total.setdefault(phase, [0.0, 0])
+                s[0] += dur
+                s[1] += 1
+            item = (tt.total, next(self.seq), tt)
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+            if self.keep:
+                tid = tt.spans[0][3] if tt.spans else threading.get_ident()
+                self.events.append(self._event(tt.name, 'task', tt.start, tt.total, tid))
+                self.events.extend(self._event(p, tt.name, t, d, tid) for p, t, d, tid in tt.spans)
+            # 未进入最慢列表且无需导出的任务不再保留阶段明细
+            if not self.keep and item not in self.slowest:
+                tt.spans = []
+
+    def _event(self, name: str, cat: str, start: float, dur: float, tid: int) -> dict:
+        return {'name': name, 'cat': cat, 'ph': 'X', 'ts': round((start - self.t0) * 1e6, 1),
+                'dur': round(dur * 1e6, 1), 'pid': os.getpid(), 'tid': tid}
+
+    def report(self, n: int = None) -> dict:
+        """
+        输出最慢的任务及各阶段累计耗时
+        :param n: int 列出的任务数量，默认全部保留的任务
+        :return: dict {'slowest': [{'task': ..., 'total': 1.2, 'phases': {...}}, ...], 'phases': {...}}
+        """
+        with self.lock:
+            items = sorted(self.slowest, reverse=True)[:n or self.top]
+            phase_total = {k: list(v) for k, v in self.phase_total.items()}
+            task_num, task_time = self.task_num, self.task_time
+        if not task_num:
+            return {}
+        slowest = [{'task': tt.name, 'total': round(total, 3),
+                    'phases': {k: round(v, 3) for k, v in sorted(tt.phases().items(), key=lambda x: -x[1])}}
+                   for total, _, tt in items]
+        phases = {k: {'seconds': round(s, 3), 'count': c, 'share': round(s / task_time, 4) if task_time else 0}
+                  for k, (s, c) in sorted(phase_total.items(), key=lambda x: -x[1][0])}
+
+        log.info(f"共追踪{task_num}个任务，累计耗时{task_time:.1f}秒，最慢的{len(slowest)}个任务：")
+        for i, s in enumerate(slowest, 1):
+            detail = "，".join(f"{k}: {v}秒" for k, v in s['phases'].items())
+            log.info(f"{i:>2}. {s['task']} 耗时{s['total']}秒（{detail}）")
+        log.info("各阶段累计耗时：" + "，".join(f"{k}: {v['seconds']}秒/{v['count']}次（{v['share']:.1%}）"
+                                         for k, v in phases.items()))
+        return {'slowest': slowest, 'phases': phases}
+
+    def export(self, path: Path) -> Path | None:
+        """
+        导出全部阶段为 Chrome Trace Event 格式的 JSON 文件
+        :param path: Path 文件路径
+        """
+        with self.lock:
+            events = list(self.events)
+        if not events:
+            return None
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(orjson.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+        log.info(f"已导出{len(events)}个追踪事件：{path}")
+        return path
+
+
+tracer = Tracer()
+task = tracer.task
+span = tracer.span
+
+if __name__ == '__main__':
+    tracer = Tracer(keep=True)
+    task, span = tracer.task, tracer.span
+    for i in range(30):
+        with task((['%06d.SZ' % i], '20230101', '20230201')):
+            with span('vendor.daily'):
+                time.sleep(0.001 * (i % 5))
+            with span('transform'):
+                time.sleep(0.001)
+    tracer.report(5)
+    print(tracer.export(BASE_PATH / "logs/trace_demo.json"))
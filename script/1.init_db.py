@@ -1,8 +1,8 @@
 from db.source.base import DataSource as ds
 
 
-def create_databases():
-    with open('init.sql', 'r', encoding='utf-8') as file:
+def run_sql_file(name: str):
+    with open(name, 'r', encoding='utf-8') as file:
         sql = file.read()
     sql = sql.replace('\n', ' ')
     sql_commands = sql.split(';')
@@ -13,16 +13,26 @@ def create_databases():
             ds._command_clickhouse(command)
 
 
-def insert_test():
-    with open('test_data.sql', 'r', encoding='utf-8') as file:
-        sql = file.read()
-    sql = sql.replace('\n', ' ')
-    sql_commands = sql.split(';')
+def create_databases():
+    run_sql_file('init.sql')
 
-    for command in sql_commands:
-        command = command.strip()
-        if command:  # 确保 SQL 语句不为空
-            ds._command_clickhouse(command)
+
+def create_summary():
+    """
+    创建（或重建）下载进度汇总表及物化视图，已有数据库单独运行此函数即可
+    """
+    run_sql_file('summary.sql')
+
+
+def create_bars():
+    """
+    创建多周期K线聚合表及物化视图，由 db/bars.py 生成，物化视图只聚合创建之后写入的数据，已有数据用 bars.rebuild 重建
+    """
+    run_sql_file('bars.sql')
+
+
+def insert_test():
+    run_sql_file('test_data.sql')
 
 
 def create_test():
@@ -40,5 +50,7 @@ def create_test():
 
 if __name__ == '__main__':
     create_databases()
+    create_summary()
+    create_bars()
     # insert_test()
     # create_test()
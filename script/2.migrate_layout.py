@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/4/004 20:40
+# @Author : 不归
+# @FileName: 2.migrate_layout.py
+"""
+将 quant.ts_day / ts_min / ts_adj 从旧结构（PARTITION BY code，ORDER BY (date, code)）迁移到新结构：
+- 分钟按月分区，日线及复权因子按年分区，分区数量从每表5000+降到几十到几百个
+- ORDER BY (code, date)，单支股票查询只扫描对应的数据块
+- code 使用 LowCardinality(String)，日期使用 DoubleDelta、价格使用 Delta、其余字段使用 ZSTD 压缩
+迁移步骤：
+1. 创建 {tab}_new，按新表的分区逐个 INSERT ... SELECT ... FINAL 并行复制，复制在服务端完成
+2. 逐个分区对比新旧表的行数及校验和，不一致的分区删除后重新复制（同时补上复制期间新写入的数据）
+3. EXCHANGE TABLES 原子交换新旧表，旧表保留为 {tab}_old 以便回滚，确认无误后手动删除
+4. 重建下载进度汇总表的物化视图（summary.sql）及多周期K线的物化视图（bars.sql），并整表重建多周期K线
+迁移期间可以继续查询；校验到交换之间的写入不会被复制，建议在下载任务空闲时运行。
+"""
+import time
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+from conf.constants import *
+from db import bars, dedup
+from db.bars import BARS
+from db.source.base import DataSource as ds
+
+THREAD_NUM = 4  # 并行复制的分区数量
+RETRY = 2  # 校验不一致时重新复制的次数
+
+_CODEC_DATE = "CODEC(DoubleDelta, ZSTD(1))"
+_CODEC_PRICE = "CODEC(Delta, ZSTD(1))"
+_KLINE_COLS = f"""
+    `code` LowCardinality(String),
+    `open` Decimal(9, 2) {_CODEC_PRICE},
+    `high` Decimal(9, 2) {_CODEC_PRICE},
+    `low` Decimal(9, 2) {_CODEC_PRICE},
+    `close` Decimal(9, 2) {_CODEC_PRICE},"""
+
+"""
+新表结构，与 init.sql 保持一致：(字段定义, 分区表达式)
+"""
+LAYOUTS = {
+    'ts_day': (f"""
+    `date` Date {_CODEC_DATE},{_KLINE_COLS}
+    `volume` UInt64 CODEC(T64, ZSTD(1)),
+    `amount` UInt64 CODEC(T64, ZSTD(1))""", "toYear(date)"),
+    'ts_min': (f"""
+    `date` DateTime {_CODEC_DATE},{_KLINE_COLS}
+    `volume` Decimal(18, 2) CODEC(ZSTD(1)),
+    `amount` Decimal(18, 2) CODEC(ZSTD(1))""", "toYYYYMM(date)"),
+    'ts_adj': (f"""
+    `date` Date {_CODEC_DATE},
+    `code` LowCardinality(String),
+    `num` Float64 CODEC(Gorilla, ZSTD(1))""", "toYear(date)"),
+}
+
+VALUE_COLS = {
+    'ts_day': "open, high, low, close, volume, amount",
+    'ts_min': "open, high, low, close, volume, amount",
+    'ts_adj': "num",
+}
+
+# 旧表按 code 分区，FINAL 无需跨分区合并
+SETTINGS = "SETTINGS do_not_merge_across_partitions_select_final = 1"
+
+
+def create_sql(tab: str, name: str = None) -> str:
+    cols, part = LAYOUTS[tab]
+    return f"""CREATE TABLE IF NOT EXISTS quant.{name or tab}
+({cols}
+)
+ENGINE = ReplacingMergeTree
+PARTITION BY {part}
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192"""
+
+
+def get_chunks(tab: str) -> list[int]:
+    """
+    旧表中存在的新分区值，如：[2009, 2010, ...] 或 [200901, 200902, ...]
+    """
+    part = LAYOUTS[tab][1]
+    res = ds._query_clickhouse(f"SELECT DISTINCT {part} AS p FROM quant.{tab} ORDER BY p")
+    return [int(p) for p in res['p']]
+
+
+def checksum(db_tab: str, tab: str, key: int) -> tuple[int, int]:
+    """
+    分区内去重后的行数及校验和，code 统一转为 String 以兼容新旧类型
+    """
+    part = LAYOUTS[tab][1]
+    sql = f"SELECT count() AS n, sum(cityHash64(date, toString(code), {VALUE_COLS[tab]})) AS h " \
+          f"FROM {db_tab} FINAL WHERE {part} = {key} {SETTINGS}"
+    res = ds._query_clickhouse(sql)
+    return int(res['n'][0]), int(res['h'][0])
+
+
+def copy_chunk(tab: str, key: int) -> tuple[int, bool]:
+    """
+    复制并校验一个分区，不一致时删除新表中的该分区后重试
+    :return: (分区值, 是否一致)
+    """
+    part = LAYOUTS[tab][1]
+    for i in range(RETRY + 1):
+        if i:
+            log.warning(f"{tab} 分区 {key} 校验不一致，第{i}次重新复制")
+            ds._command_clickhouse(f"ALTER TABLE quant.{tab}_new DROP PARTITION {key}")
+        ds._command_clickhouse(f"INSERT INTO quant.{tab}_new SELECT * FROM quant.{tab} FINAL "
+                               f"WHERE {part} = {key} {SETTINGS}")
+        if checksum(f"quant.{tab}", tab, key) == checksum(f"quant.{tab}_new", tab, key):
+            return key, True
+    return key, False
+
+
+def verify(tab: str, pool: ThreadPool) -> bool:
+    """
+    交换前再次逐个分区校验，复制期间有新写入的分区重新复制
+    """
+    old, new = set(get_chunks(tab)), set(get_chunks(f"{tab}_new"))
+    bad = sorted(old ^ new)
+    for key, ok in pool.imap_unordered(lambda k: (k, checksum(f"quant.{tab}", tab, k) ==
+                                                  checksum(f"quant.{tab}_new", tab, k)), sorted(old & new)):
+        bad += [] if ok else [key]
+    for key in bad:
+        if key not in old:
+            ds._command_clickhouse(f"ALTER TABLE quant.{tab}_new DROP PARTITION {key}")
+    res = pool.map(lambda k: copy_chunk(tab, k), [k for k in bad if k in old])
+    return all(ok for _, ok in res)
+
+
+def migrate(tab: str, thread_num: int = THREAD_NUM) -> bool:
+    """
+    迁移单个表，已是新结构时跳过
+    :param tab: str 表名，ts_day/ts_min/ts_adj
+    :param thread_num: int 并行复制的分区数量
+    :return: bool 是否完成交换
+    """
+    t1 = time.time()
+    key = ds._command_clickhouse(f"SELECT sorting_key FROM system.tables WHERE database = 'quant' AND name = '{tab}'")
+    if key == "code, date":
+        log.info(f"quant.{tab} 已是新结构，跳过")
+        return True
+    if ds._command_clickhouse(f"EXISTS TABLE quant.{tab}_old"):
+        log.error(f"quant.{tab}_old 已存在，请确认上次迁移的旧表可以删除后再运行")
+        return False
+
+    ds._command_clickhouse(create_sql(tab, f"{tab}_new"))
+    done = set(get_chunks(f"{tab}_new"))  # 中断后再次运行时跳过已复制的分区，由 verify 统一校验
+    chunks = [k for k in get_chunks(tab) if k not in done]
+    log.info(f"开始迁移 quant.{tab}：共{len(chunks) + len(done)}个分区，待复制{len(chunks)}个")
+
+    with ThreadPool(thread_num) as pool:
+        for n, (k, ok) in enumerate(pool.imap_unordered(lambda c: copy_chunk(tab, c), chunks), 1):
+            log.debug(f"quant.{tab} 分区 {k} 复制{'完成' if ok else '校验不一致'}（{n}/{len(chunks)}）")
+        if not verify(tab, pool):
+            log.error(f"quant.{tab} 校验未通过，未交换，可重新运行")
+            return False
+
+    ds._command_clickhouse(f"EXCHANGE TABLES quant.{tab} AND quant.{tab}_new")
+    ds._command_clickhouse(f"RENAME TABLE quant.{tab}_new TO quant.{tab}_old")
+    log.success(f"quant.{tab} 迁移完成，耗时{time.time() - t1:.1f}秒，旧表保留为 quant.{tab}_old")
+    return True
+
+
+def run_sql_file(name: str):
+    sql = Path(__file__).with_name(name).read_text(encoding='utf-8').replace('\n', ' ')
+    for command in sql.split(';'):
+        if command.strip():
+            ds._command_clickhouse(command.strip())
+
+
+def rebuild_summary():
+    """
+    物化视图按表名绑定原表，交换后删除重建，并重新汇总进度
+    """
+    for tab in LAYOUTS:
+        ds._command_clickhouse(f"DROP VIEW IF EXISTS quant.{tab}_summary_mv")
+    run_sql_file('summary.sql')
+
+
+def rebuild_bars():
+    """
+    多周期K线的物化视图同样绑定原表，交换后删除重建；重建视图前后写入的数据由整表重建补齐
+    """
+    for b in BARS.values():
+        ds._command_clickhouse(f"DROP VIEW IF EXISTS {b.tab}_mv")
+    run_sql_file('bars.sql')
+    for src in sorted({b.src for b in BARS.values()}):
+        bars.rebuild(src, dedup.partition_key(src), None)
+
+
+if __name__ == '__main__':
+    if all([migrate(t) for t in LAYOUTS]):
+        rebuild_summary()
+        rebuild_bars()
+    # 确认无误后删除旧表
+    # for t in LAYOUTS:
+    #     ds._command_clickhouse(f"DROP TABLE IF EXISTS quant.{t}_old")
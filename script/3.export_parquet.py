@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+# @Time : 2023/10/11/011 21:20
+# @Author : 不归
+# @FileName: 3.export_parquet.py
+"""
+导出 K线及复权因子到 Parquet 数据集，目录及增量规则参照 db.export
+导出目录默认 %userprofile%/.czsc/parquet，可通过环境变量 export_path 修改，拷贝整个目录到回测集群即可
+"""
+from conf.constants import *
+from db.export import DEFAULT_BY, EXPORT_PATH, export
+
+if __name__ == '__main__':
+    # 分区方式：year/month/code，full=True 忽略清单全部重新导出
+    results = {tab: export(tab, by, EXPORT_PATH) for tab, by in DEFAULT_BY.items()}
+    log.info("导出结果：" + "，".join(f"{tab} {'行数一致' if ok else '行数不一致'}" for tab, ok in results.items()))
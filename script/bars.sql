@@ -0,0 +1,131 @@
+CREATE TABLE IF NOT EXISTS quant.ts_min5
+(
+    `date` DateTime,
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), DateTime),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), DateTime),
+    `volume` SimpleAggregateFunction(sum, Decimal(38, 2)),
+    `amount` SimpleAggregateFunction(sum, Decimal(38, 2))
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(date)
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_min5_mv TO quant.ts_min5 AS
+SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT toStartOfDay(date) + toIntervalMinute(if(greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 5 - 1, 5), 1) * 5 <= 120, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 5 - 1, 5), 1) * 5 + 570, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 5 - 1, 5), 1) * 5 + 660)) AS bar, date AS t, code, open, high, low, close, volume, amount FROM quant.ts_min)
+GROUP BY code, bar;
+
+CREATE TABLE IF NOT EXISTS quant.ts_min15
+(
+    `date` DateTime,
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), DateTime),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), DateTime),
+    `volume` SimpleAggregateFunction(sum, Decimal(38, 2)),
+    `amount` SimpleAggregateFunction(sum, Decimal(38, 2))
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(date)
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_min15_mv TO quant.ts_min15 AS
+SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT toStartOfDay(date) + toIntervalMinute(if(greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 15 - 1, 15), 1) * 15 <= 120, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 15 - 1, 15), 1) * 15 + 570, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 15 - 1, 15), 1) * 15 + 660)) AS bar, date AS t, code, open, high, low, close, volume, amount FROM quant.ts_min)
+GROUP BY code, bar;
+
+CREATE TABLE IF NOT EXISTS quant.ts_min30
+(
+    `date` DateTime,
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), DateTime),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), DateTime),
+    `volume` SimpleAggregateFunction(sum, Decimal(38, 2)),
+    `amount` SimpleAggregateFunction(sum, Decimal(38, 2))
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(date)
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_min30_mv TO quant.ts_min30 AS
+SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT toStartOfDay(date) + toIntervalMinute(if(greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 30 - 1, 30), 1) * 30 <= 120, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 30 - 1, 30), 1) * 30 + 570, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 30 - 1, 30), 1) * 30 + 660)) AS bar, date AS t, code, open, high, low, close, volume, amount FROM quant.ts_min)
+GROUP BY code, bar;
+
+CREATE TABLE IF NOT EXISTS quant.ts_min60
+(
+    `date` DateTime,
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), DateTime),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), DateTime),
+    `volume` SimpleAggregateFunction(sum, Decimal(38, 2)),
+    `amount` SimpleAggregateFunction(sum, Decimal(38, 2))
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(date)
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_min60_mv TO quant.ts_min60 AS
+SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT toStartOfDay(date) + toIntervalMinute(if(greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 60 - 1, 60), 1) * 60 <= 120, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 60 - 1, 60), 1) * 60 + 570, greatest(intDiv(if(toHour(date) * 60 + toMinute(date) <= 690, toHour(date) * 60 + toMinute(date) - 570, toHour(date) * 60 + toMinute(date) - 660) + 60 - 1, 60), 1) * 60 + 660)) AS bar, date AS t, code, open, high, low, close, volume, amount FROM quant.ts_min)
+GROUP BY code, bar;
+
+CREATE TABLE IF NOT EXISTS quant.ts_week
+(
+    `date` Date,
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), Date),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), Date),
+    `volume` SimpleAggregateFunction(sum, UInt64),
+    `amount` SimpleAggregateFunction(sum, UInt64)
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYear(date)
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_week_mv TO quant.ts_week AS
+SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT toMonday(date) AS bar, date AS t, code, open, high, low, close, volume, amount FROM quant.ts_day)
+GROUP BY code, bar;
+
+CREATE TABLE IF NOT EXISTS quant.ts_month
+(
+    `date` Date,
+    `code` LowCardinality(String),
+    `open` AggregateFunction(argMin, Decimal(9, 2), Date),
+    `high` SimpleAggregateFunction(max, Decimal(9, 2)),
+    `low` SimpleAggregateFunction(min, Decimal(9, 2)),
+    `close` AggregateFunction(argMax, Decimal(9, 2), Date),
+    `volume` SimpleAggregateFunction(sum, UInt64),
+    `amount` SimpleAggregateFunction(sum, UInt64)
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYear(date)
+ORDER BY (code, date)
+SETTINGS index_granularity = 8192;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_month_mv TO quant.ts_month AS
+SELECT bar AS date, code, argMinState(open, t) AS open, max(high) AS high, min(low) AS low,
+argMaxState(close, t) AS close, sum(volume) AS volume, sum(amount) AS amount
+FROM (SELECT toStartOfMonth(date) AS bar, date AS t, code, open, high, low, close, volume, amount FROM quant.ts_day)
+GROUP BY code, bar;
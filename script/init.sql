@@ -15,50 +15,46 @@ SETTINGS index_granularity = 8192;
 
 CREATE TABLE quant.ts_day
 (
-    `date` Date,
-    `code` String,
-    `open` Decimal(9, 2),
-    `high` Decimal(9, 2),
-    `low` Decimal(9, 2),
-    `close` Decimal(9, 2),
-    `volume` UInt64,
-    `amount` UInt64
+    `date` Date CODEC(DoubleDelta, ZSTD(1)),
+    `code` LowCardinality(String),
+    `open` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `high` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `low` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `close` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `volume` UInt64 CODEC(T64, ZSTD(1)),
+    `amount` UInt64 CODEC(T64, ZSTD(1))
 )
 ENGINE = ReplacingMergeTree
-PARTITION BY code
-PRIMARY KEY date
-ORDER BY (date, code)
+PARTITION BY toYear(date)
+ORDER BY (code, date)
 SETTINGS index_granularity = 8192;
 
 CREATE TABLE quant.ts_min
 (
-    `date` DateTime,
-    `code` String,
-    `open` Decimal(9, 2),
-    `high` Decimal(9, 2),
-    `low` Decimal(9, 2),
-    `close` Decimal(9, 2),
-    `volume` Decimal(18, 2),
-    `amount` Decimal(18, 2)
+    `date` DateTime CODEC(DoubleDelta, ZSTD(1)),
+    `code` LowCardinality(String),
+    `open` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `high` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `low` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `close` Decimal(9, 2) CODEC(Delta, ZSTD(1)),
+    `volume` Decimal(18, 2) CODEC(ZSTD(1)),
+    `amount` Decimal(18, 2) CODEC(ZSTD(1))
 )
 ENGINE = ReplacingMergeTree
-PARTITION BY code
-PRIMARY KEY date
-ORDER BY (date, code)
+PARTITION BY toYYYYMM(date)
+ORDER BY (code, date)
 SETTINGS index_granularity = 8192;
 
 
 CREATE TABLE quant.ts_adj
 (
-
-    `date` Date,
-    `code` String,
-    `num` Float64
+    `date` Date CODEC(DoubleDelta, ZSTD(1)),
+    `code` LowCardinality(String),
+    `num` Float64 CODEC(Gorilla, ZSTD(1))
 )
 ENGINE = ReplacingMergeTree
-PARTITION BY code
-PRIMARY KEY date
-ORDER BY (date, code)
+PARTITION BY toYear(date)
+ORDER BY (code, date)
 SETTINGS index_granularity = 8192;
 
 
@@ -74,3 +70,12 @@ ENGINE = ReplacingMergeTree
 PRIMARY KEY username
 ORDER BY username
 SETTINGS index_granularity = 8192;
+
+
+CREATE TABLE quant.trade_cal
+(
+    `date` Date
+)
+ENGINE = ReplacingMergeTree
+ORDER BY date
+SETTINGS index_granularity = 8192;
@@ -0,0 +1,72 @@
+/*
+下载进度汇总表，sdt/edt 为每支股票已入库的最小、最大日期，min/max 重复计算结果不变。
+num 为物化视图按写入批次累计的行数，重复下载、重叠写入的行会重复计入，不是原表去重后的行数，仅供参考。
+执行顺序：先清空汇总表，再创建物化视图，最后从原表 FINAL 回填。物化视图创建之后写入的数据由物化视图记录，
+之前写入的数据由回填读取，两者之间没有遗漏；回填期间写入的数据只会使 num 重复计入
+*/
+
+CREATE TABLE IF NOT EXISTS quant.ts_day_summary
+(
+    `code` String,
+    `sdt` SimpleAggregateFunction(min, Date),
+    `edt` SimpleAggregateFunction(max, Date),
+    `num` SimpleAggregateFunction(sum, UInt64)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY code;
+
+CREATE TABLE IF NOT EXISTS quant.ts_min_summary
+(
+    `code` String,
+    `sdt` SimpleAggregateFunction(min, DateTime),
+    `edt` SimpleAggregateFunction(max, DateTime),
+    `num` SimpleAggregateFunction(sum, UInt64)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY code;
+
+CREATE TABLE IF NOT EXISTS quant.ts_adj_summary
+(
+    `code` String,
+    `sdt` SimpleAggregateFunction(min, Date),
+    `edt` SimpleAggregateFunction(max, Date),
+    `num` SimpleAggregateFunction(sum, UInt64)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY code;
+
+TRUNCATE TABLE quant.ts_day_summary;
+
+TRUNCATE TABLE quant.ts_min_summary;
+
+TRUNCATE TABLE quant.ts_adj_summary;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_day_summary_mv TO quant.ts_day_summary AS
+SELECT code, min(date) AS sdt, max(date) AS edt, count() AS num
+FROM quant.ts_day
+GROUP BY code;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_min_summary_mv TO quant.ts_min_summary AS
+SELECT code, min(date) AS sdt, max(date) AS edt, count() AS num
+FROM quant.ts_min
+GROUP BY code;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS quant.ts_adj_summary_mv TO quant.ts_adj_summary AS
+SELECT code, min(date) AS sdt, max(date) AS edt, count() AS num
+FROM quant.ts_adj
+GROUP BY code;
+
+INSERT INTO quant.ts_day_summary
+SELECT code, min(date) AS sdt, max(date) AS edt, count() AS num
+FROM quant.ts_day FINAL
+GROUP BY code;
+
+INSERT INTO quant.ts_min_summary
+SELECT code, min(date) AS sdt, max(date) AS edt, count() AS num
+FROM quant.ts_min FINAL
+GROUP BY code;
+
+INSERT INTO quant.ts_adj_summary
+SELECT code, min(date) AS sdt, max(date) AS edt, count() AS num
+FROM quant.ts_adj FINAL
+GROUP BY code;